@@ -0,0 +1,319 @@
+import asyncio
+import os
+import functools
+import numpy as np
+from aiohttp import web
+from aiohttp_wsgi import WSGIHandler
+from concurrent.futures import ThreadPoolExecutor
+from flask_prometheus import monitor
+from flask_restplus import marshal
+from prometheus_client import Histogram, Gauge
+from werkzeug.exceptions import HTTPException, BadRequest
+from typing import List
+
+import core_server
+from core_server import app as flask_app, preload_indexes
+from replica_core import model
+from replica_core.async_http_client import AsyncBackendClient
+from replica_core.http_client import BackendError
+from replica_core.serialization import compile_model, dumps
+
+# asyncio serving mode : the proxy-heavy endpoints (image searches, distance matrix, graph, transition gifs) are
+# served by coroutines waiting on the search server and elasticsearch without holding a thread, the database
+# stages run in a bounded thread pool, and every other route is forwarded to the Flask application.
+# Arguments are parsed and answers marshalled with the parsers and models of core_server, and the stages which
+# do not wait on a backend are the functions of core_server, so that both modes answer the same way.
+
+ASYNC_REQUEST_LATENCY = Histogram('replica_async_request_latency_seconds',
+                                  'Latency of the requests served by the async endpoints', ['route'])
+ASYNC_REQUESTS_IN_FLIGHT = Gauge('replica_async_requests_in_flight',
+                                 'Number of requests being served by the async endpoints')
+
+# Blocking work (Neo4j calls, marshalling of large answers) is done in a bounded number of threads
+executor = ThreadPoolExecutor(max_workers=flask_app.config.get('ASYNC_DB_WORKERS', 32))
+wsgi_executor = ThreadPoolExecutor(max_workers=flask_app.config.get('ASYNC_WSGI_WORKERS', 16))
+
+search_client = AsyncBackendClient('search', flask_app.config['REPLICA_SEARCH_URL'],
+                                   pool_size=flask_app.config.get('ASYNC_BACKEND_POOL_SIZE', 100), timeout=30)
+elastic_client = AsyncBackendClient('elasticsearch', flask_app.config['ELASTICSEARCH_URL'],
+                                    pool_size=flask_app.config.get('ASYNC_BACKEND_POOL_SIZE', 100), timeout=10)
+
+
+def run_in_executor(fn, *args, **kwargs) -> asyncio.Future:
+    return asyncio.get_event_loop().run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+
+_flights = dict()  # key -> asyncio.Future
+
+
+async def single_flight(key, coroutine_function):
+    """
+    Concurrent calls with the same key share a single run of `coroutine_function()`, which is not cancelled by
+    a client going away
+    """
+    future = _flights.get(key)
+    if future is None:
+        future = _flights[key] = asyncio.ensure_future(coroutine_function())
+        future.add_done_callback(lambda f: _flights.pop(key, None))
+    return await asyncio.shield(future)
+
+
+async def parse_args(resource, request: web.Request) -> dict:
+    """Arguments of the request parsed by the parser of the Flask-RESTPlus resource"""
+    body = await request.read()
+    with flask_app.test_request_context(request.path_qs, method=request.method, data=body,
+                                        content_type=request.content_type):
+        return resource.parser.parse_args()
+
+
+def marshal_request(data, fields, request: web.Request) -> web.Response:
+    """Same as `fast_marshal_with`, including the X-Fields mask"""
+    mask = request.headers.get(flask_app.config['RESTPLUS_MASK_HEADER'])
+    data = marshal(data, fields, mask=mask) if mask else compile_model(fields)(data)
+    return web.Response(text=dumps(data), content_type='application/json')
+
+
+async def search_server_post(route: str, args: dict, timeout: int, filtered_uids: bytes=None) -> dict:
+    try:
+        r = await search_client.post(route, data=core_server.search_request_body(args, filtered_uids),
+                                     headers=core_server.JSON_HEADERS, timeout=timeout)
+    except BackendError as e:
+        raise BadRequest('Could not connect to search server')
+    if r.status_code != 200:
+        raise BadRequest('Bad answer from the search server : {}'.format(r.json().get('message')))
+    return r.json()
+
+
+async def _elastic_request(route, method='GET', **kwargs):
+    try:
+        return await elastic_client.request(method, route, **kwargs)
+    except BackendError as e:
+        raise BadRequest('Could not connect to ElasticSearch')
+
+
+async def metadata_filtered_image_uids(metadata: dict, max_elements: int) -> bytes:
+    """
+    Same as `core_server.metadata_filtered_image_uids` (sharing its cache), the next page of elasticsearch results
+    being fetched while the previous one is mapped to image uids
+    """
+    key, image_uids = await run_in_executor(core_server.metadata_filter_lookup, metadata, max_elements)
+    if image_uids is None:
+        query, all_terms, min_date, max_date = key[:4]
+        es_results = await _elastic_request('/_search', params={'scroll': '1m'},
+                                            json=core_server.elastic_search_ids_query(query, all_terms, min_date,
+                                                                                      max_date, 10000))
+        scroll_id, mapping = None, None
+        uids = []
+        nb_elements = 0
+        try:
+            while True:
+                ids, _, scroll_id = core_server.elastic_scroll_page(es_results, scroll_id)
+                ids = ids[:max_elements - nb_elements]
+                if len(ids) == 0:
+                    break
+                nb_elements += len(ids)
+                if mapping is not None:
+                    uids.extend(await mapping)
+                mapping = run_in_executor(model.CHO.get_image_uids_from_ids, ids)
+                if nb_elements >= max_elements:
+                    break
+                es_results = await _elastic_request('/_search/scroll', json={'scroll': '1m', 'scroll_id': scroll_id})
+            if mapping is not None:
+                uids.extend(await mapping)
+        finally:
+            if scroll_id is not None:
+                try:
+                    await elastic_client.delete('/_search/scroll', json={'scroll_id': [scroll_id]}, retries=0)
+                except BackendError:
+                    pass  # Expires by itself anyway
+        image_uids = core_server.metadata_filter_store(key, uids)
+    return image_uids
+
+
+def image_search_handler(resource, route: str, max_filtered_elements: int, timeout: int,
+                         filter_empty_metadata=True, coalesce=False):
+    """
+    Handler of an image search endpoint, the async version of the `post` of the resource
+    :param filter_empty_metadata: as `core_server.image_search_request`
+    :param coalesce: as `core_server.coalesce_anonymous`, sharing its cache
+    """
+    async def search(args: dict) -> dict:
+        nb_results, metadata = core_server.image_search_request(args, filter_empty_metadata)
+        filtered_uids = await metadata_filtered_image_uids(metadata, max_filtered_elements) \
+            if metadata is not None else None
+        request_output = await search_server_post(route, args, timeout, filtered_uids)
+        return await run_in_executor(core_server.image_search_results, request_output, args['filter_duplicates'],
+                                     nb_results)
+
+    async def coalesced_search(key: tuple, args: dict) -> dict:
+        result = core_server.search_response_cache.get(key)
+        if result is None:
+            result = await search(args)
+            core_server.search_response_cache.set(key, result)
+        return result
+
+    async def handler(request: web.Request):
+        args = await parse_args(resource, request)
+        if coalesce and not request.headers.get('Authorization'):
+            key = core_server.search_request_key(request.path, args)
+            result = core_server.search_response_cache.get(key)
+            if result is None:
+                result = await single_flight(key, lambda: coalesced_search(key, args))
+        else:
+            result = await search(args)
+        return await run_in_executor(marshal_request, result, core_server.model_image_search_region, request)
+    return handler
+
+
+async def distance_matrix(request: web.Request):
+    args = await parse_args(core_server.DistanceMatrixResource, request)
+    result = await search_server_post('/api/distance_matrix', args, 30)
+    return marshal_request(result, core_server.DistanceMatrixResource.distance_matrix_model, request)
+
+
+async def graph_distance_matrix(image_uids: List[str]) -> np.ndarray:
+    """Same as `core_server.graph_distance_matrix`"""
+    matrix = await run_in_executor(core_server.cached_distance_matrix, image_uids)
+    if matrix is None:
+        request_output = await search_server_post('/api/distance_matrix', {'image_uids': image_uids}, 30)
+        matrix = await run_in_executor(core_server.store_graph_distances, image_uids, request_output)
+    return matrix
+
+
+async def graph(request: web.Request):
+    args = await parse_args(core_server.GraphResource, request)
+    image_uids, link_rows = await run_in_executor(core_server.graph_neighborhood, args)
+    result = await run_in_executor(core_server.graph_result, image_uids, link_rows)
+    # Only the images found in the database, as `GraphResource`
+    node_uids = [n['uid'] for n in result['nodes']]
+    core_server.add_graph_distances(result, await graph_distance_matrix(node_uids), args['distances_format'])
+    return await run_in_executor(marshal_request, result, core_server.GraphResource.graph_model, request)
+
+
+async def _download_transition_gif(key):
+    route, uid1, uid2 = key
+    try:
+        r = await search_client.get('{}/{}/{}'.format(route, uid1, uid2), timeout=60, metric_route=route)
+    except BackendError as e:
+        raise BadRequest('Could not connect to search server')
+    if r.status_code != 200:
+        raise BadRequest('Bad answer from the search server')
+    return r.content, r.headers['content-type']
+
+
+async def _fetch_transition_gif(key):
+    content, content_type = await _download_transition_gif(key)
+    return await run_in_executor(core_server.transition_gif_cache.set, key, content, content_type)
+
+
+async def cached_transition_gif(request: web.Request, route: str):
+    """Same as `core_server.transition_gif_response` with a cache, concurrent misses sharing one fetch"""
+    key = (route, request.match_info['uid1'], request.match_info['uid2'])
+    entry = await run_in_executor(core_server.transition_gif_cache.get, key)
+    if entry is None:
+        entry = await single_flight(key, lambda: _fetch_transition_gif(key))
+    headers = {'ETag': '"{}"'.format(entry.etag),
+               'Cache-Control': 'public, max-age={}'.format(core_server.TRANSITION_GIF_MAX_AGE)}
+    if '"{}"'.format(entry.etag) in request.headers.get('If-None-Match', ''):
+        return web.Response(status=304, headers=headers)
+    try:
+        await run_in_executor(os.stat, entry.path)
+    except FileNotFoundError:
+        # Evicted in the meantime
+        content, content_type = await _download_transition_gif(key)
+        entry = await run_in_executor(core_server.transition_gif_cache.set, key, content, content_type)
+        headers['ETag'] = '"{}"'.format(entry.etag)
+        return web.Response(body=content, headers=headers, content_type=content_type)
+    # sendfile
+    headers['Content-Type'] = entry.content_type
+    return web.FileResponse(entry.path, headers=headers)
+
+
+def transition_gif_handler(route: str):
+    """Answer of the search server, cached or streamed as by `TransitionGifResource`"""
+    async def handler(request: web.Request):
+        if core_server.transition_gif_cache.enabled:
+            return await cached_transition_gif(request, route)
+        try:
+            r = await search_client.open('GET', '{}/{}/{}'.format(route, request.match_info['uid1'],
+                                                                  request.match_info['uid2']),
+                                         timeout=60, metric_route=route)
+        except BackendError as e:
+            raise BadRequest('Could not connect to search server')
+        try:
+            response = web.StreamResponse(headers={'Content-Type': r.headers['content-type']})
+            await response.prepare(request)
+            while True:
+                chunk = await r.content.read(10000)
+                if not chunk:
+                    break
+                await response.write(chunk)
+            await response.write_eof()
+            return response
+        finally:
+            r.release()
+    return handler
+
+
+@web.middleware
+async def error_middleware(request: web.Request, handler):
+    """Errors in the same format as Flask-RESTPlus"""
+    try:
+        return await handler(request)
+    except HTTPException as e:
+        return web.json_response(getattr(e, 'data', None) or {'message': e.description}, status=e.code)
+
+
+@web.middleware
+async def metrics_middleware(request: web.Request, handler):
+    if isinstance(request.match_info.handler, WSGIHandler):
+        # Measured by the Flask application
+        return await handler(request)
+    ASYNC_REQUESTS_IN_FLIGHT.inc()
+    try:
+        with ASYNC_REQUEST_LATENCY.labels(request.match_info.route.resource.canonical).time():
+            return await handler(request)
+    finally:
+        ASYNC_REQUESTS_IN_FLIGHT.dec()
+
+
+async def _on_startup(app):
+    preload_indexes()
+    await search_client.start()
+    await elastic_client.start()
+
+
+async def _on_cleanup(app):
+    await search_client.close()
+    await elastic_client.close()
+
+
+def make_app() -> web.Application:
+    app = web.Application(middlewares=[metrics_middleware, error_middleware])
+    app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
+    app.router.add_post('/api/image/search',
+                        image_search_handler(core_server.SearchImageResource, '/api/search', 100000, 30,
+                                             filter_empty_metadata=False, coalesce=True))
+    app.router.add_post('/api/image/search_external',
+                        image_search_handler(core_server.SearchImageExternalResource, '/api/search_external',
+                                             100000, 60))
+    app.router.add_post('/api/image/search_region',
+                        image_search_handler(core_server.SearchImageRegionResource, '/api/search_region', 50000, 30,
+                                             coalesce=True))
+    app.router.add_post('/api/image/distance_matrix', distance_matrix)
+    app.router.add_post('/api/graph', graph)
+    app.router.add_get('/api/transition_gif/{uid1}/{uid2}', transition_gif_handler('/api/transition_gif'))
+    app.router.add_get('/api/transition_gif_validity/{uid1}/{uid2}',
+                       transition_gif_handler('/api/transition_gif_validity'))
+    # Everything else, including the other methods of the routes above
+    app.router.add_route('*', '/{path_info:.*}', WSGIHandler(flask_app, executor=wsgi_executor))
+    return app
+
+
+# `gunicorn async_server:app --worker-class aiohttp.GunicornWebWorker`
+app = make_app()
+
+if __name__ == '__main__':
+    monitor(flask_app, port=5010)
+    web.run_app(app, host='0.0.0.0', port=5000)
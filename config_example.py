@@ -5,4 +5,52 @@ DATABASE_URL = 'bolt://<neo4j-username>:<neo4j-password>@<neo4j-address>:7687'
 REPLICA_SEARCH_URL = 'http://<replica-search-server-address>:<port>'
 ELASTICSEARCH_URL = 'http://<elastic-search-server>:9200'
 
-LOG_FILE = '<log_file_path>'
\ No newline at end of file
+LOG_FILE = '<log_file_path>'
+# Process-local cache of nodes looked up by uid
+NODE_CACHE_SIZE = 10000
+NODE_CACHE_TTL = 60  # seconds
+
+# Seconds between two refreshes of the counts of /api/stats
+STATS_REFRESH_INTERVAL = 300
+
+# Maximum number of keep-alive connections to each backend (search server, elasticsearch)
+BACKEND_POOL_SIZE = 20
+
+# Seconds between two full rebuilds of the in-memory index of DUPLICATE clusters
+DUPLICATE_INDEX_REFRESH_INTERVAL = 600
+
+# Cache of the image uids matching a metadata filter of the image searches
+METADATA_FILTER_CACHE_SIZE = 64
+METADATA_FILTER_CACHE_TTL = 3600  # seconds
+# Seconds between two checks for a new import, which invalidates the cache above
+LAST_IMPORT_CHECK_INTERVAL = 60
+
+# Seconds a proposal checked out from the annotation queue stays reserved for the annotator
+PROPOSAL_LEASE_DURATION = 600
+# Maximum lease duration a client can ask for
+PROPOSAL_MAX_LEASE_DURATION = 3600
+# Seconds between two full reloads of the annotation queue
+PROPOSAL_QUEUE_REFRESH_INTERVAL = 3600
+
+# Seconds between two full reloads of the in-memory graph of the links used by /api/graph
+LINK_GRAPH_REFRESH_INTERVAL = 3600
+# Number of users whose personal link graph is kept in memory
+PERSONAL_LINK_GRAPH_CACHE_SIZE = 100
+PERSONAL_LINK_GRAPH_CACHE_TTL = 3600  # seconds
+
+# async_server.py : threads running the database calls and the Flask routes, connections to each backend
+ASYNC_DB_WORKERS = 32
+ASYNC_WSGI_WORKERS = 16
+ASYNC_BACKEND_POOL_SIZE = 100
+
+# On-disk cache of the transition gifs and validity results, disabled if None
+TRANSITION_GIF_CACHE_DIR = None
+TRANSITION_GIF_CACHE_SIZE = 1 << 30  # bytes
+TRANSITION_GIF_MAX_AGE = 86400  # seconds, Cache-Control of the answers
+
+# Number of image pairs whose distance is kept by /api/graph
+DISTANCE_CACHE_SIZE = 200000
+
+# Answers of the anonymous search requests, shared by identical requests in this interval
+SEARCH_RESPONSE_CACHE_SIZE = 256
+SEARCH_RESPONSE_CACHE_TTL = 10  # seconds
@@ -1,19 +1,25 @@
 import neomodel
-from flask import Flask, request, g, Response, stream_with_context
-from flask_restplus import Api, Resource, fields
+from flask import Flask, request, g, Response, stream_with_context, send_file
+from flask_restplus import Api, Resource, fields, inputs
 from flask_prometheus import monitor
 from werkzeug.exceptions import BadRequest
-import requests
 from collections import namedtuple
-from functools import partial
 import json
-from threading import Lock
+import base64
+import hashlib
+from functools import wraps
+from threading import Lock, Thread
+from typing import List, Tuple, Iterator, Optional
+import numpy as np
 try:
     import better_exceptions
 except:
     pass
 
 from replica_core import model, auth
+from replica_core.cache import registered_caches, PeriodicValue, LRUCache, FileCache, SingleFlight
+from replica_core.http_client import BackendClient, BackendError
+from replica_core.serialization import fast_marshal_with, dumps
 from replica_core.model import SerializationLevel
 
 app = Flask(__name__, static_folder='static', static_url_path='')
@@ -37,6 +43,20 @@ app.config.from_object('config')
 # app.config.from_envvar('YOURAPPLICATION_SETTINGS')
 
 neomodel.config.DATABASE_URL = app.config['DATABASE_URL']
+model.node_cache.configure(max_size=app.config.get('NODE_CACHE_SIZE'), ttl=app.config.get('NODE_CACHE_TTL'))
+
+model.duplicate_index.configure(refresh_interval=app.config.get('DUPLICATE_INDEX_REFRESH_INTERVAL'))
+model.link_graph.configure(refresh_interval=app.config.get('LINK_GRAPH_REFRESH_INTERVAL'))
+model.personal_link_graphs.configure(max_users=app.config.get('PERSONAL_LINK_GRAPH_CACHE_SIZE'),
+                                     ttl=app.config.get('PERSONAL_LINK_GRAPH_CACHE_TTL'))
+model.proposal_queue.configure(lease_duration=app.config.get('PROPOSAL_LEASE_DURATION'),
+                               max_lease_duration=app.config.get('PROPOSAL_MAX_LEASE_DURATION'),
+                               refresh_interval=app.config.get('PROPOSAL_QUEUE_REFRESH_INTERVAL'))
+
+search_client = BackendClient('search', app.config['REPLICA_SEARCH_URL'],
+                              pool_size=app.config.get('BACKEND_POOL_SIZE', 20), timeout=30)
+elastic_client = BackendClient('elasticsearch', app.config['ELASTICSEARCH_URL'],
+                               pool_size=app.config.get('BACKEND_POOL_SIZE', 20), timeout=10)
 
 classes = [model.Image, model.Collection, model.CHO, model.Group,
            model.VisualLink, model.PersonalLink, model.TripletComparison, model.User]
@@ -82,33 +102,25 @@ model_auth = api.model('Auth', {'token': fields.String(required=True,
                                                        description="JSON Web Token after successful authentication")})
 
 
+Stat = namedtuple('Stat', ['key', 'label'])
+STATS = [
+    Stat('nb_top_collections', 'Number of registered top collections'),
+    Stat('nb_collections', 'Number of indexed collections (all)'),
+    Stat('nb_elements', 'Number of indexed IIIF manifests'),
+    Stat('nb_images', 'Number of indexed IIIF images'),
+    Stat('nb_users', 'Number of registered users'),
+    Stat('nb_links', 'Number of total links')
+]
+STATS.extend([Stat('nb_{}_links'.format(t), 'Number of {} links'.format(t)) for t in model.VisualLink.Type.ALL_TYPES])
+STATS.append(Stat('nb_annotated_triplets', 'Number of annotated triplets'))
+STATS.append(Stat('nb_proposal_triplets', 'Number of proposal triplets'))
+
+database_counts = PeriodicValue('database_counts', model.utils.get_database_counts,
+                                interval=app.config.get('STATS_REFRESH_INTERVAL', 300))
+
+
 @api.route('/api/stats')
 class StatisticsResource(Resource):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-        def _fn(link_type):
-            return len(model.VisualLink.nodes.filter(type=link_type))
-
-        Stat = namedtuple('Stat', ['key', 'label', 'fn'])
-        self.stats = [
-            Stat('nb_top_collections', 'Number of registered top collections',
-                 lambda: len(model.Collection.get_top_collections())),
-            Stat('nb_collections', 'Number of indexed collections (all)', lambda: len(model.Collection.nodes)),
-            Stat('nb_elements', 'Number of indexed IIIF manifests', lambda: len(model.CHO.nodes)),
-            Stat('nb_images', 'Number of indexed IIIF images', lambda: len(model.Image.nodes)),
-            Stat('nb_users', 'Number of registered users', lambda: len(model.User.nodes)),
-            Stat('nb_links', 'Number of total links', lambda: len(model.VisualLink.nodes))
-        ]
-
-        self.stats.extend([Stat('nb_{}_links'.format(t), 'Number of {} links'.format(t), partial(_fn, t))
-                           for t in model.VisualLink.Type.ALL_TYPES])
-
-        self.stats.append(Stat('nb_annotated_triplets', 'Number of annotated triplets',
-                               lambda: len(model.TripletComparison.nodes.filter(annotated__isnull=False))))
-        self.stats.append(Stat('nb_proposal_triplets', 'Number of proposal triplets',
-                               lambda: len(model.TripletComparison.nodes.filter(annotated__isnull=True))))
-
     model_stat = api.model('Stat', {'key': fields.String(required=True),
                                     'label': fields.String(required=True),
                                     'value': fields.Integer(required=True)})
@@ -116,29 +128,77 @@ class StatisticsResource(Resource):
 
     @api.marshal_with(model_stats)
     def get(self):
+        counts = database_counts.get()
         return {
             'stats': [
                 {
                     'key': s.key,
                     'label': s.label,
-                    'value': s.fn()
-                } for s in self.stats
+                    'value': counts.get(s.key, 0)
+                } for s in STATS
                 ]
         }
 
 
+@api.route('/api/stats/cache')
+class CacheStatisticsResource(Resource):
+    model_cache_stat = api.model('CacheStat', {'name': fields.String(required=True),
+                                               'size': fields.Integer(required=True),
+                                               'max_size': fields.Integer(required=True),
+                                               'hits': fields.Integer(required=True),
+                                               'misses': fields.Integer(required=True),
+                                               'hit_rate': fields.Float(required=True)})
+    model_cache_stats = api.model('CacheStats', {'caches': fields.List(fields.Nested(model_cache_stat))})
+
+    @api.marshal_with(model_cache_stats)
+    def get(self):
+        return {'caches': [c.stats() for c in registered_caches()]}
+
+
+timeseries_cache = LRUCache('stats_timeseries', max_size=32, ttl=app.config.get('STATS_REFRESH_INTERVAL', 300))
+
+
+@api.route('/api/stats/timeseries')
+class StatisticsTimeseriesResource(Resource):
+    parser = api.parser()
+    parser.add_argument('start', type=inputs.date, help='First day (YYYY-MM-DD), from the beginning if not given')
+    parser.add_argument('end', type=inputs.date, help='Last day (YYYY-MM-DD), until today if not given')
+
+    model_day = api.model('DailyStatistics', {'date': fields.Date(required=True),
+                                              'counts': fields.Raw(required=True),
+                                              'annotations_per_user': fields.Raw(required=True)})
+    model_timeseries = api.model('StatisticsTimeseries', {'days': fields.List(fields.Nested(model_day))})
+
+    @api.expect(parser)
+    @api.marshal_with(model_timeseries)
+    def get(self):
+        """
+        Daily counts of created links (nb_links, nb_<type>_links), annotations (nb_<type>_annotations),
+        images annotated for the first time (nb_new_images), and annotations per user.
+        They are updated daily by scripts/generate_graph.py, days without any event are missing.
+        """
+        args = self.parser.parse_args()
+        start, end = [args[k].date() if args[k] else None for k in ['start', 'end']]
+        days = timeseries_cache.get((start, end))
+        if days is None:
+            days = [{'date': s.date, 'counts': s.counts, 'annotations_per_user': s.annotations_per_user}
+                    for s in model.DailyStatistics.get_range(start, end)]
+            timeseries_cache.set((start, end), days)
+        return {'days': days}
+
+
 @api.route('/api/collections')
 class CollectionsResource(Resource):
     @api.marshal_with(model_collections)
     def get(self):
-        return {'collections': [coll.to_dict() for coll in model.Collection.nodes.all()]}
+        return {'collections': model.Collection.to_dicts(model.Collection.nodes.all())}
 
 
 @api.route('/api/collection/<string:uid>')
 class CollectionResource(Resource):
-    @api.marshal_with(api.models['Collection_ext'])
+    @fast_marshal_with(api, api.models['Collection_ext'])
     def get(self, uid):
-        coll = model.Collection.nodes.get_or_none(uid=uid)  # type: model.Collection
+        coll = model.Collection.get_cached(uid)  # type: model.Collection
         if coll is None:
             raise BadRequest("{} is not a collection".format(uid))
         return coll.to_dict(level=SerializationLevel.EXTENDED)
@@ -148,7 +208,7 @@ class CollectionResource(Resource):
 class GroupResrouce(Resource):
     @api.marshal_with(api.models['Group_ext'])
     def get(self, uid):
-        group = model.Group.nodes.get_or_none(uid=uid)  # type: model.Group
+        group = model.Group.get_cached(uid)  # type: model.Group
         if group is None:
             raise BadRequest("{} is not a group".format(uid))
         return group.to_dict(level=SerializationLevel.EXTENDED)
@@ -161,7 +221,7 @@ class GroupResrouce(Resource):
     @api.expect(parser)
     @auth.login_required
     def put(self, uid):
-        current_user = model.User.nodes.get(uid=g.user_uid)
+        current_user = model.User.get_cached(g.user_uid)
         group = model.Group.nodes.get_or_none(uid=uid)  # type: model.Group
         if group.owner.get() != current_user:
             raise BadRequest('Unauthorized')
@@ -176,7 +236,7 @@ class GroupResrouce(Resource):
 
     @auth.login_required
     def delete(self, uid):
-        current_user = model.User.nodes.get(uid=g.user_uid)
+        current_user = model.User.get_cached(g.user_uid)
         group = model.Group.nodes.get_or_none(uid=uid)  # type: model.Group
         if group.owner.get() != current_user:
             raise BadRequest('Unauthorized')
@@ -191,7 +251,7 @@ class AddImagesGroupResrouce(Resource):
     @api.expect(parser)
     @auth.login_required
     def post(self, uid):
-        current_user = model.User.nodes.get(uid=g.user_uid)
+        current_user = model.User.get_cached(g.user_uid)
         group = model.Group.nodes.get_or_none(uid=uid)  # type: model.Group
         if group.owner.get() != current_user:
             raise BadRequest('Unauthorized')
@@ -215,7 +275,7 @@ class CreateGroupResource(Resource):
     @api.expect(parser)
     @auth.login_required
     def post(self):
-        current_user = model.User.nodes.get(uid=g.user_uid)
+        current_user = model.User.get_cached(g.user_uid)
         args = self.parser.parse_args()
         try:
             images = [model.Image.nodes.get(uid=uid) for uid in args['image_uids']]
@@ -227,9 +287,9 @@ class CreateGroupResource(Resource):
 
 @api.route('/api/element/<string:uid>')
 class ElementResource(Resource):
-    @api.marshal_with(api.models['CHO_ext'])
+    @fast_marshal_with(api, api.models['CHO_ext'])
     def get(self, uid):
-        cho = model.CHO.nodes.get_or_none(uid=uid)  # type: model.CHO
+        cho = model.CHO.get_cached(uid)  # type: model.CHO
         if cho is None:
             raise BadRequest("{} is not an element".format(uid))
         return cho.to_dict(level=SerializationLevel.EXTENDED)
@@ -241,28 +301,40 @@ class LinkResource(Resource):
     parser.add_argument('nb_elements', type=int, default=1)
 
     @api.expect(parser)
-    @api.marshal_with(api.models['CHO_ext'])
+    @fast_marshal_with(api, api.models['CHO_ext'])
     def get(self):
         args = self.parser.parse_args()
         chos = model.CHO.get_random(limit=args['nb_elements'])
-        return [cho.to_dict(level=SerializationLevel.DEFAULT) for cho in chos]
+        return model.CHO.to_dicts(chos, level=SerializationLevel.DEFAULT)
 
 
 @api.route('/api/image/<string:uid>')
 class ImageResource(Resource):
-    @api.marshal_with(api.models['Image_ext'])
+    parser = api.parser()
+    parser.add_argument('link_types', type=str, action='split',
+                        help='Comma-separated types of the links to return, all of them if not given')
+    parser.add_argument('links_offset', type=int, default=0)
+    parser.add_argument('links_limit', type=int, help='Maximum number of links to return, all of them if not given')
+
+    @api.expect(parser)
+    @fast_marshal_with(api, api.models['Image_ext'])
     def get(self, uid):
-        img = model.Image.nodes.get_or_none(uid=uid)  # type: model.Image
+        args = self.parser.parse_args()
+        link_types = args['link_types']
+        if link_types is not None and not set(link_types).issubset(model.VisualLink.Type.ALL_TYPES):
+            raise BadRequest("Link types should be in {}".format(model.VisualLink.Type.ALL_TYPES))
+        img = model.Image.get_cached(uid)  # type: model.Image
         if img is None:
             raise BadRequest("{} is not an image".format(uid))
-        return img.to_dict(level=SerializationLevel.EXTENDED)
+        return model.Image.to_dicts([img], level=SerializationLevel.EXTENDED, link_types=link_types,
+                                    links_offset=max(args['links_offset'], 0), links_limit=args['links_limit'])[0]
 
 
 @api.route('/api/link/<string:uid>')
 class LinkResource(Resource):
-    @api.marshal_with(api.models['VisualLink_ext'])
+    @fast_marshal_with(api, api.models['VisualLink_ext'])
     def get(self, uid):
-        link = model.VisualLink.nodes.get_or_none(uid=uid)  # type: model.VisualLink
+        link = model.VisualLink.get_cached(uid)  # type: model.VisualLink
         if link is None:
             raise BadRequest("{} is not a link".format(uid))
         return link.to_dict(level=SerializationLevel.EXTENDED)
@@ -297,12 +369,12 @@ class LinkResource(Resource):
         user_uid = g.user_uid
         img1_uid, img2_uid, type = args['img1_uid'], args['img2_uid'], args['type']
 
-        user = model.User.nodes.get_or_none(uid=user_uid)
+        user = model.User.get_cached(user_uid)
         if not user:
             raise BadRequest('User does not exist')
 
-        img1 = model.Image.nodes.get_or_none(uid=img1_uid)
-        img2 = model.Image.nodes.get_or_none(uid=img2_uid)
+        img1 = model.Image.get_cached(img1_uid)
+        img2 = model.Image.get_cached(img2_uid)
 
         if args['personal']:
             link = model.PersonalLink.create_link(img1, img2, user)
@@ -333,28 +405,132 @@ class LinkResource(Resource):
         user_uid = g.user_uid
         img1_uid, img2_uid = args['img1_uid'], args['img2_uid']
 
-        user = model.User.nodes.get_or_none(uid=user_uid)
+        user = model.User.get_cached(user_uid)
         if not user:
             raise BadRequest('User does not exist')
 
         # Create the proposal first
-        img1 = model.Image.nodes.get_or_none(uid=img1_uid)
-        img2 = model.Image.nodes.get_or_none(uid=img2_uid)
+        img1 = model.Image.get_cached(img1_uid)
+        img2 = model.Image.get_cached(img2_uid)
         link = model.VisualLink.create_proposal(img1, img2, user, exist_ok=True)
         return {"uid": link.uid}
 
 
+model_bulk_result = api.model('BulkResult', {'uid': fields.String,
+                                              'status': fields.String(required=True,
+                                                                      enum=['created', 'annotated', 'exists', 'error']),
+                                              'error': fields.String})
+model_bulk_results = api.model('BulkResults', {'results': fields.List(fields.Nested(model_bulk_result))})
+
+
+def _bulk_records(records) -> List[dict]:
+    if not all(isinstance(r, dict) for r in records):
+        raise BadRequest('Records should be objects')
+    return records
+
+
+@api.route('/api/link/create_bulk')
+class LinkResource(Resource):
+    parser = api.parser()
+    parser.add_argument('links', type=list, required=True, location='json',
+                        help='List of {img1_uid, img2_uid, type, img1_box, img2_box}, boxes being optional')
+
+    @api.expect(parser)
+    @api.marshal_with(model_bulk_results)
+    @auth.login_required
+    def post(self):
+        """
+        Bulk version of /api/link/create (non-personal links only), with one result per record in the same order
+        """
+        args = self.parser.parse_args()
+        user = model.User.get_cached(g.user_uid)
+        if not user:
+            raise BadRequest('User does not exist')
+        if not user.can_annotate_links():
+            raise BadRequest("Forbidden action, user account does not have the right privileges.")
+        return {'results': model.VisualLink.create_bulk(_bulk_records(args['links']), user, annotate=True)}
+
+
+@api.route('/api/proposal/create_bulk')
+class LinkResource(Resource):
+    parser = api.parser()
+    parser.add_argument('proposals', type=list, required=True, location='json',
+                        help='List of {img1_uid, img2_uid, prediction_score, spatial_spread, img1_box, img2_box}, '
+                             'all but the image uids being optional')
+
+    @api.expect(parser)
+    @api.marshal_with(model_bulk_results)
+    @auth.login_required
+    def post(self):
+        """
+        Bulk version of /api/proposal/create, with one result per record in the same order
+        """
+        args = self.parser.parse_args()
+        user = model.User.get_cached(g.user_uid)
+        if not user:
+            raise BadRequest('User does not exist')
+        return {'results': model.VisualLink.create_bulk(_bulk_records(args['proposals']), user, annotate=False)}
+
+
 @api.route('/api/link/proposal/random')
 class LinkResource(Resource):
     parser = api.parser()
     parser.add_argument('nb_proposals', type=int, default=10)
 
     @api.expect(parser)
-    @api.marshal_with(api.models['VisualLink_ext'])
+    @fast_marshal_with(api, api.models['VisualLink_ext'])
     def get(self):
         args = self.parser.parse_args()
         links = model.VisualLink.get_random_proposals(limit=args['nb_proposals'])
-        return [link.to_dict(level=SerializationLevel.EXTENDED) for link in links]
+        return model.VisualLink.to_dicts(links, level=SerializationLevel.EXTENDED)
+
+
+@api.route('/api/link/proposal/checkout')
+class LinkResource(Resource):
+    parser = api.parser()
+    parser.add_argument('nb_proposals', type=int, default=10, location='json')
+    parser.add_argument('lease_duration', type=int, location='json',
+                        help='Seconds the proposals are reserved for the user, server default if not given, '
+                             'capped by the server maximum')
+
+    @api.expect(parser)
+    @fast_marshal_with(api, api.models['VisualLink_ext'])
+    @auth.login_required
+    def post(self):
+        """
+        Checks out the next proposals of the annotation queue (highest prediction scores first)
+        They are not given to other users until annotated, released or until the lease expires.
+        """
+        args = self.parser.parse_args()
+        if args['lease_duration'] is not None and args['lease_duration'] <= 0:
+            raise BadRequest('lease_duration should be positive')
+        user = model.User.get_cached(g.user_uid)
+        if not user:
+            raise BadRequest('User does not exist')
+        if not user.can_annotate_links():
+            raise BadRequest("Forbidden action, user account does not have the right privileges.")
+        links = model.VisualLink.checkout_proposals(user, limit=args['nb_proposals'],
+                                                    lease_duration=args['lease_duration'])
+        return model.VisualLink.to_dicts(links, level=SerializationLevel.EXTENDED)
+
+
+@api.route('/api/link/proposal/release')
+class LinkResource(Resource):
+    parser = api.parser()
+    parser.add_argument('uids', type=list, required=True, location='json')
+
+    @api.expect(parser)
+    @auth.login_required
+    def post(self):
+        """Puts proposals checked out by the user back into the annotation queue"""
+        args = self.parser.parse_args()
+        try:
+            links = model.VisualLink.get_by_uids(args['uids'])
+        except KeyError as e:
+            raise BadRequest('{} is not a link'.format(e))
+        for link in links:
+            model.proposal_queue.release(link.id, g.user_uid)
+        return {}
 
 
 @api.route('/api/link/related')
@@ -369,22 +545,24 @@ class LinkResource(Resource):
     related_data = api.model('RelatedData',
                              {'links': fields.List(fields.Nested(graph_link_model))})
 
-    @api.marshal_with(related_data)
+    @fast_marshal_with(api, related_data)
     @api.expect(parser)
     @auth.login_required
     def post(self):
         args = self.parser.parse_args()
         user_uid = g.user_uid
-        user = model.User.nodes.get_or_none(uid=user_uid)
+        user = model.User.get_cached(user_uid)
         if not user:
             raise BadRequest('User does not exist')
         if not args['personal']:
             _, links = model.get_subgraph(args['image_uids'], graph_depth=0)
         else:
             _, links = model.get_subgraph_personal(args['image_uids'], user, graph_depth=0)
+        links_data = model.PersonalLink.to_dicts([l for _, _, l in links]) if args['personal'] \
+            else model.VisualLink.to_dicts([l for _, _, l in links])
         return {'links': [{'source': uid1,
                            'target': uid2,
-                           'data': l.to_dict()} for uid1, uid2, l in links]}
+                           'data': d} for (uid1, uid2, _), d in zip(links, links_data)]}
 
 
 @api.route('/api/triplet/proposal/random')
@@ -397,14 +575,14 @@ class LinkResource(Resource):
     def get(self):
         args = self.parser.parse_args()
         links = model.TripletComparison.get_random_proposals(limit=args['nb_proposals'])
-        return [link.to_dict(level=SerializationLevel.EXTENDED) for link in links]
+        return model.TripletComparison.to_dicts(links, level=SerializationLevel.EXTENDED)
 
 
 @api.route('/api/triplet/<string:uid>')
 class LinkResource(Resource):
     @api.marshal_with(api.models['TripletComparison_ext'])
     def get(self, uid):
-        link = model.TripletComparison.nodes.get_or_none(uid=uid)  # type: model.TripletComparison
+        link = model.TripletComparison.get_cached(uid)  # type: model.TripletComparison
         if link is None:
             raise BadRequest("{} is not a triplet".format(uid))
         return link.to_dict(level=SerializationLevel.EXTENDED)
@@ -435,15 +613,15 @@ class LinkResource(Resource):
         if user_uid is None:
             user = model.User.nodes.get(username='Anonymous')
         else:
-            user = model.User.nodes.get_or_none(uid=user_uid)
+            user = model.User.get_cached(user_uid)
 
         if not user:
             raise BadRequest('User does not exist')
         link = model.TripletComparison.nodes.get_or_none(uid=uid)  # type: model.TripletComparison
         if link is None:
             raise BadRequest("{} is not a triplet".format(uid))
-        positive_img = model.Image.nodes.get_or_none(uid=args['positive_uid'])
-        negative_img = model.Image.nodes.get_or_none(uid=args['negative_uid'])
+        positive_img = model.Image.get_cached(args['positive_uid'])
+        negative_img = model.Image.get_cached(args['negative_uid'])
         if not positive_img or not negative_img:
             raise BadRequest('One of the image does not exist')
         link.annotate(user, positive_img, negative_img)
@@ -456,7 +634,14 @@ class LinkResource(Resource):
 #        return {'links': [l.to_dict(extended=True) for l in model.VisualLink.nodes.all()]}
 
 
-def elastic_search_ids(query=None, all_terms=False, min_date=None, max_date=None, nb_results=200):
+def _elastic_request(route, method='GET', **kwargs):
+    try:
+        return elastic_client.request(method, route, **kwargs)
+    except BackendError as e:
+        raise BadRequest('Could not connect to ElasticSearch')
+
+
+def elastic_search_base_query(query=None, all_terms=False, min_date=None, max_date=None):
     base_query = {
         "bool": {
              "must": [
@@ -483,32 +668,63 @@ def elastic_search_ids(query=None, all_terms=False, min_date=None, max_date=None
         base_query['bool']['must'].append({"range": {"date_begin": {"lte": max_date}}})
     if min_date is not None:
         base_query['bool']['must'].append({"range": {"date_end": {"gte": min_date}}})
-    elastic_search_query = {
+    return base_query
+
+
+def elastic_search_ids_query(query=None, all_terms=False, min_date=None, max_date=None, size=200) -> dict:
+    return {
+        "_source": False,
         "stored_fields": [],  # Do not return the fields, _id is enough
-        "query": base_query,
-        "size": nb_results
+        "query": elastic_search_base_query(query, all_terms, min_date, max_date),
+        "size": size
     }
-    # If all of them needs to be returned, use scrolling
-    if nb_results > 10000:
-        elastic_search_query['size'] = 10000  # Pages of 10000 elements
-        es_results = requests.get('{}/_search?scroll=1m'.format(app.config['ELASTICSEARCH_URL']),
-                                  json=elastic_search_query)
-        all_ids = []
-        # Take pages until done
+
+
+def elastic_scroll_page(es_results, scroll_id=None) -> Tuple[List[int], int, str]:
+    """`(ids, total_results, scroll_id)` of an answer of the scroll API"""
+    if es_results.status_code != 200:
+        raise BadRequest('ElasticSearch query failed')
+    json_result = es_results.json()
+    return ([int(s['_id']) for s in json_result['hits']['hits']], json_result['hits']['total'],
+            json_result.get('_scroll_id', scroll_id))
+
+
+def elastic_search_id_pages(query=None, all_terms=False, min_date=None, max_date=None,
+                            page_size=10000) -> Iterator[Tuple[List[int], int]]:
+    """
+    Generator of the pages `(ids, total_results)` of all the matching elements using the scroll API.
+    The scroll context is cleared when the generator is exhausted or closed.
+    """
+    es_results = _elastic_request('/_search', params={'scroll': '1m'},
+                                  json=elastic_search_ids_query(query, all_terms, min_date, max_date, page_size))
+    scroll_id = None
+    try:
         while True:
-            json_result = es_results.json()
-            total_results = json_result['hits']['total']
-            new_ids = [int(s['_id']) for s in json_result['hits']['hits']]
+            new_ids, total_results, scroll_id = elastic_scroll_page(es_results, scroll_id)
             if len(new_ids) == 0:
-                return all_ids, total_results
+                return
+            yield new_ids, total_results
+            es_results = _elastic_request('/_search/scroll', json={'scroll': '1m', 'scroll_id': scroll_id})
+    finally:
+        if scroll_id is not None:
+            try:
+                elastic_client.delete('/_search/scroll', json={'scroll_id': [scroll_id]}, retries=0)
+            except BackendError:
+                pass  # Expires by itself anyway
+
+
+def elastic_search_ids(query=None, all_terms=False, min_date=None, max_date=None, nb_results=200):
+    # If all of them needs to be returned, use scrolling
+    if nb_results > 10000:
+        all_ids, total_results = [], 0
+        for new_ids, total_results in elastic_search_id_pages(query, all_terms, min_date, max_date):
             all_ids.extend(new_ids)
-            if len(all_ids) > nb_results:
-                return all_ids[:nb_results], total_results
-            es_results = requests.get('{}/_search/scroll'.format(app.config['ELASTICSEARCH_URL']),
-                                      json={'scroll': '1m', 'scroll_id': json_result['_scroll_id']})
+            if len(all_ids) >= nb_results:
+                break
+        return all_ids[:nb_results], total_results
     else:
-        es_results = requests.get('{}/_search'.format(app.config['ELASTICSEARCH_URL']),
-                                  json=elastic_search_query)
+        es_results = _elastic_request('/_search',
+                                      json=elastic_search_ids_query(query, all_terms, min_date, max_date, nb_results))
         if es_results.status_code != 200:
             raise BadRequest('ElasticSearch query failed')
         search_data = es_results.json()
@@ -516,6 +732,162 @@ def elastic_search_ids(query=None, all_terms=False, min_date=None, max_date=None
         return [int(r['_id']) for r in search_data['hits']['hits']], total_results
 
 
+metadata_filter_cache = LRUCache('metadata_filters', max_size=app.config.get('METADATA_FILTER_CACHE_SIZE', 64),
+                                 ttl=app.config.get('METADATA_FILTER_CACHE_TTL', 3600))
+
+
+last_import = PeriodicValue('last_import', model.Collection.get_last_import,
+                            interval=app.config.get('LAST_IMPORT_CHECK_INTERVAL', 60))
+
+
+@last_import.on_refresh
+def _invalidate_metadata_filters(old_time, new_time):
+    # Elements were imported (or deleted) in the meantime
+    if old_time != new_time:
+        metadata_filter_cache.clear()
+
+
+def _parse_year(value):
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        raise BadRequest('Invalid date : {}'.format(value))
+
+
+def metadata_filter_key(metadata: dict, max_elements: int) -> tuple:
+    """Normalized `(query, all_terms, min_date, max_date, max_elements)` of a metadata filter"""
+    query = ' '.join((metadata.get('query') or '').lower().split())
+    return (query, bool(metadata.get('all_terms', True)),
+            _parse_year(metadata.get('min_date')), _parse_year(metadata.get('max_date')),
+            max_elements)
+
+
+def metadata_filter_lookup(metadata: dict, max_elements: int) -> Tuple[tuple, Optional[bytes]]:
+    """Key of the metadata filter and its cached uids, None if not cached"""
+    last_import.get()  # Starts the periodic check invalidating the cache
+    key = metadata_filter_key(metadata, max_elements)
+    return key, metadata_filter_cache.get(key)
+
+
+def metadata_filter_store(key: tuple, uids: List[str]) -> bytes:
+    """Caches the uids of a metadata filter encoded, to be spliced as is in the search server requests by
+    `search_request_body`"""
+    image_uids = dumps(uids).encode('utf-8')
+    metadata_filter_cache.set(key, image_uids)
+    return image_uids
+
+
+def metadata_filtered_image_uids(metadata: dict, max_elements: int) -> bytes:
+    """
+    JSON array of the uids of the images of (at most `max_elements`) elements matching the metadata query, mapped
+    to image uids one page of elasticsearch results at a time
+    """
+    key, image_uids = metadata_filter_lookup(metadata, max_elements)
+    if image_uids is None:
+        query, all_terms, min_date, max_date = key[:4]
+        uids = []
+        nb_elements = 0
+        for ids, _ in elastic_search_id_pages(query, all_terms, min_date, max_date):
+            ids = ids[:max_elements - nb_elements]
+            nb_elements += len(ids)
+            uids.extend(model.CHO.get_image_uids_from_ids(ids))
+            if nb_elements >= max_elements:
+                break
+        image_uids = metadata_filter_store(key, uids)
+    return image_uids
+
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+
+def search_request_body(args: dict, filtered_uids: bytes=None) -> bytes:
+    """JSON body of a search server request, with the encoded `filtered_uids` given by
+    `metadata_filtered_image_uids`"""
+    body = dumps(args).encode('utf-8')
+    if filtered_uids is None:
+        return body
+    return body[:-1] + (b',' if len(args) > 0 else b'') + b'"filtered_uids":' + filtered_uids + b'}'
+
+
+def search_server_post(route: str, args: dict, timeout: int, filtered_uids: bytes=None) -> dict:
+    try:
+        r = search_client.post(route, data=search_request_body(args, filtered_uids), headers=JSON_HEADERS,
+                               timeout=timeout)
+    except BackendError as e:
+        raise BadRequest('Could not connect to search server')
+    if r.status_code != 200:
+        raise BadRequest('Bad answer from the search server : {}'.format(r.json().get('message')))
+    return r.json()
+
+
+def image_search_request(args: dict, filter_empty_metadata=True) -> Tuple[int, Optional[dict]]:
+    """
+    Turns the parsed arguments of an image search into the search server request (more results are asked when
+    duplicates are filtered, the metadata filter is removed)
+    :param filter_empty_metadata: whether a metadata filter without query nor dates restricts the results
+    :return: number of results to answer, metadata filter to apply if any
+    """
+    nb_results = args['nb_results']
+    if args['filter_duplicates']:
+        args['nb_results'] = int(2.5*args['nb_results'])
+    metadata = None
+    if args.get('metadata'):
+        metadata = args.pop('metadata')
+        if not filter_empty_metadata and metadata.get('query', '') == '' and metadata.get('min_date') is None \
+                and metadata.get('max_date') is None:
+            metadata = None
+    return nb_results, metadata
+
+
+def image_search_results(request_output: dict, filter_duplicates: bool, nb_results: int) -> dict:
+    """Answer of an image search from the answer of the search server"""
+    result_output_raw = request_output['results']
+    if filter_duplicates:
+        image_uids = set(model.utils.filter_duplicates_image_uids([r['uid'] for r in result_output_raw]))
+        result_output_raw = [r for r in result_output_raw if r['uid'] in image_uids]
+    chos = model.CHO.get_from_image_uids([r['uid'] for r in result_output_raw])
+    assert len(result_output_raw) == len(chos)
+    result_output = []
+    for result, r in zip(result_output_raw, model.CHO.to_dicts(chos)):
+        if 'box' in result.keys():
+            r['images'][0]['box'] = result['box']
+        result_output.append(r)
+    return {'results': result_output[:nb_results], 'total': request_output['total']}
+
+
+search_response_cache = LRUCache('search_responses', max_size=app.config.get('SEARCH_RESPONSE_CACHE_SIZE', 256),
+                                 ttl=app.config.get('SEARCH_RESPONSE_CACHE_TTL', 10))
+search_flights = SingleFlight()
+
+
+def search_request_key(path: str, args: dict) -> tuple:
+    """Route and hash of the parsed arguments (defaults included, so that omitting one does not matter)"""
+    return path, hashlib.sha256(json.dumps(args, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def coalesce_anonymous(f):
+    """
+    Identical concurrent anonymous requests of the decorated resource method share a single computation, whose
+    result is also kept `SEARCH_RESPONSE_CACHE_TTL` seconds. To be put under `(fast_)marshal_with`.
+    """
+    @wraps(f)
+    def decorated_function(self, *args, **kwargs):
+        if request.headers.get('Authorization'):
+            return f(self, *args, **kwargs)
+        key = search_request_key(request.path, self.parser.parse_args())
+
+        def compute():
+            result = search_response_cache.get(key)
+            if result is None:
+                result = f(self, *args, **kwargs)
+                search_response_cache.set(key, result)
+            return result
+
+        result = search_response_cache.get(key)
+        return result if result is not None else search_flights.do(key, compute)
+    return decorated_function
+
+
 @api.route('/api/search/text')
 class SearchTextResource(Resource):
     parser = api.parser()
@@ -526,8 +898,9 @@ class SearchTextResource(Resource):
     parser.add_argument('max_date', type=int)
     parser.add_argument('filter_duplicates', type=int, default=1)
 
-    @api.marshal_with(model_text_search)
+    @fast_marshal_with(api, model_text_search)
     @api.expect(parser)
+    @coalesce_anonymous
     def get(self):
         args = self.parser.parse_args()
         nb_results = args['nb_results']
@@ -544,7 +917,7 @@ class SearchTextResource(Resource):
         if args['filter_duplicates']:
             results = model.utils.filter_duplicates_cho(results)
         results = results[:nb_results]
-        return {'query': q, 'results': [r.to_dict() for r in results], 'total': total_results}
+        return {'query': q, 'results': model.CHO.to_dicts(results), 'total': total_results}
 
 
 @api.route('/api/image/search')
@@ -560,48 +933,15 @@ class SearchImageResource(Resource):
     parser.add_argument('rerank', type=bool, default=False, location='json')
     parser.add_argument('filter_duplicates', type=bool, default=True, location='json')
 
-    @api.marshal_with(model_image_search_region)
+    @fast_marshal_with(api, model_image_search_region)
     @api.expect(parser)
+    @coalesce_anonymous
     def post(self):
         args = self.parser.parse_args()
-        nb_results = args['nb_results']
-        if args['filter_duplicates']:
-            args['nb_results'] = int(2.5*args['nb_results'])
-        if args.get('metadata'):
-            metadata = args['metadata']
-            if metadata.get('query', '') != '' or metadata.get('min_date') is not None or metadata.get('max_date') is not None:
-                ids, _ = elastic_search_ids(metadata.get('query', ''),
-                                         metadata.get('all_terms', True),
-                                         metadata.get('min_date'),
-                                         metadata.get('max_date'),
-                                         100000)
-                filtered_uids = model.CHO.get_image_uids_from_ids(ids)
-                args['filtered_uids'] = filtered_uids
-            del args['metadata']
-        try:
-            r = requests.post(app.config['REPLICA_SEARCH_URL'] + '/api/search', json=args)
-        except Exception as e:
-            raise BadRequest('Could not connect to search server')
-        if r.status_code != 200:
-            raise BadRequest('Bad answer from the search server : {}'.format(r.json().get('message')))
-        result_output = []
-        request_output = r.json()
-        result_output_raw = request_output['results']
-        # Filter duplicates
-        if args['filter_duplicates']:
-            image_uids = [r['uid'] for r in result_output_raw]
-            image_uids = set(model.utils.filter_duplicates_image_uids(image_uids))
-            result_output_raw = [r for r in result_output_raw if r['uid'] in image_uids]
-
-        chos = model.CHO.get_from_image_uids([r['uid'] for r in result_output_raw])
-        assert len(result_output_raw) == len(chos)
-        for result, cho in zip(result_output_raw, chos):
-            r = cho.to_dict()
-            if 'box' in result.keys():
-                r['images'][0]['box'] = result['box']
-            result_output.append(r)
-        result_output = result_output[:nb_results]
-        return {'results': result_output, 'total': request_output['total']}
+        nb_results, metadata = image_search_request(args, filter_empty_metadata=False)
+        filtered_uids = metadata_filtered_image_uids(metadata, 100000) if metadata is not None else None
+        request_output = search_server_post('/api/search', args, 30, filtered_uids)
+        return image_search_results(request_output, args['filter_duplicates'], nb_results)
 
 
 @api.route('/api/image/search_external')
@@ -613,65 +953,71 @@ class SearchImageExternalResource(Resource):
     parser.add_argument('rerank', type=bool, default=False, location='json')
     parser.add_argument('filter_duplicates', type=bool, default=True, location='json')
 
-    @api.marshal_with(model_image_search_region)
+    @fast_marshal_with(api, model_image_search_region)
     @api.expect(parser)
     def post(self):
         args = self.parser.parse_args()
-        nb_results = args['nb_results']
-        if args['filter_duplicates']:
-            args['nb_results'] = int(2.5*args['nb_results'])
-        if args.get('metadata'):
-            metadata = args['metadata']
-            ids, _ = elastic_search_ids(metadata.get('query', ''),
-                                     metadata.get('all_terms', True),
-                                     metadata.get('min_date'),
-                                     metadata.get('max_date'),
-                                     100000)
-            filtered_uids = model.CHO.get_image_uids_from_ids(ids)
-            del args['metadata']
-            args['filtered_uids'] = filtered_uids
+        nb_results, metadata = image_search_request(args)
+        filtered_uids = metadata_filtered_image_uids(metadata, 100000) if metadata is not None else None
+        request_output = search_server_post('/api/search_external', args, 60, filtered_uids)
+        return image_search_results(request_output, args['filter_duplicates'], nb_results)
+
+
+transition_gif_cache = FileCache('transition_gifs', app.config.get('TRANSITION_GIF_CACHE_DIR'),
+                                 max_size=app.config.get('TRANSITION_GIF_CACHE_SIZE', 1 << 30))
+TRANSITION_GIF_MAX_AGE = app.config.get('TRANSITION_GIF_MAX_AGE', 86400)
+
+
+def fetch_transition_gif(route: str, uid1: str, uid2: str) -> Tuple[bytes, str]:
+    try:
+        r = search_client.get('{}/{}/{}'.format(route, uid1, uid2), timeout=60, metric_route=route)
+    except BackendError as e:
+        raise BadRequest('Could not connect to search server')
+    if r.status_code != 200:
+        raise BadRequest('Bad answer from the search server')
+    return r.content, r.headers['content-type']
+
+
+def transition_gif_response(route: str, uid1: str, uid2: str) -> Response:
+    """
+    Answer of the search server, served from the on-disk cache if enabled (the gifs and validity results are
+    deterministic), otherwise streamed
+    """
+    if not transition_gif_cache.enabled:
         try:
-            r = requests.post(app.config['REPLICA_SEARCH_URL'] + '/api/search_external', json=args)
-        except Exception as e:
+            req = search_client.get('{}/{}/{}'.format(route, uid1, uid2), stream=True, timeout=60,
+                                    metric_route=route)
+        except BackendError as e:
             raise BadRequest('Could not connect to search server')
-        if r.status_code != 200:
-            raise BadRequest('Bad answer from the search server : {}'.format(r.json().get('message')))
-        result_output = []
-        request_output = r.json()
-        result_output_raw = request_output['results']
-        # Filter duplicates
-        if args['filter_duplicates']:
-            image_uids = [r['uid'] for r in result_output_raw]
-            image_uids = set(model.utils.filter_duplicates_image_uids(image_uids))
-            result_output_raw = [r for r in result_output_raw if r['uid'] in image_uids]
-
-        chos = model.CHO.get_from_image_uids([r['uid'] for r in result_output_raw])
-        assert len(result_output_raw) == len(chos)
-        for result, cho in zip(result_output_raw, chos):
-            r = cho.to_dict()
-            if 'box' in result.keys():
-                r['images'][0]['box'] = result['box']
-            result_output.append(r)
-        result_output = result_output[:nb_results]
-        return {'results': result_output, 'total': request_output['total']}
+        return Response(stream_with_context(req.iter_content(chunk_size=10000)),
+                        content_type=req.headers['content-type'])
+    key = (route, uid1, uid2)
+    entry = transition_gif_cache.get_or_fetch(key, lambda: fetch_transition_gif(route, uid1, uid2))
+    try:
+        # Sent with the file wrapper of the WSGI server (sendfile) when available
+        rv = send_file(entry.path, mimetype=entry.content_type, add_etags=False,
+                       cache_timeout=TRANSITION_GIF_MAX_AGE)
+    except FileNotFoundError:
+        # Evicted in the meantime
+        content, content_type = fetch_transition_gif(route, uid1, uid2)
+        entry = transition_gif_cache.set(key, content, content_type)
+        rv = Response(content, content_type=content_type)
+        rv.cache_control.max_age = TRANSITION_GIF_MAX_AGE
+    rv.set_etag(entry.etag)
+    rv.cache_control.public = True
+    return rv.make_conditional(request)
 
 
 @api.route('/api/transition_gif/<string:uid1>/<string:uid2>')
 class TransitionGifResource(Resource):
     def get(self, uid1, uid2):
-        req = requests.get(app.config['REPLICA_SEARCH_URL'] + '/api/transition_gif/{}/{}'.format(uid1, uid2),
-                           stream=True)
-        return Response(stream_with_context(req.iter_content(chunk_size=10000)),
-                        content_type=req.headers['content-type'])
+        return transition_gif_response('/api/transition_gif', uid1, uid2)
 
 
 @api.route('/api/transition_gif_validity/<string:uid1>/<string:uid2>')
 class TransitionGifResource(Resource):
     def get(self, uid1, uid2):
-        req = requests.get(app.config['REPLICA_SEARCH_URL'] + '/api/transition_gif_validity/{}/{}'.format(uid1, uid2),
-                           stream=True)
-        return Response(stream_with_context(req.iter_content(chunk_size=10000)),
-                        content_type=req.headers['content-type'])
+        return transition_gif_response('/api/transition_gif_validity', uid1, uid2)
 
 
 @api.route('/api/image/distance_matrix')
@@ -682,13 +1028,13 @@ class DistanceMatrixResource(Resource):
 
     distance_matrix_model = api.model('DistanceMatrixModel', {'distances': fields.List(fields.List(fields.Float))})
 
-    @api.marshal_with(distance_matrix_model)
+    @fast_marshal_with(api, distance_matrix_model)
     @api.expect(parser)
     def post(self):
         args = self.parser.parse_args()
         try:
-            r = requests.post(app.config['REPLICA_SEARCH_URL'] + '/api/distance_matrix', json=args)
-        except Exception as e:
+            r = search_client.post('/api/distance_matrix', json=args, timeout=30)
+        except BackendError as e:
             raise BadRequest('Could not connect to search server')
         if r.status_code != 200:
             raise BadRequest('Bad answer from the search server : {}'.format(r.json().get('message')))
@@ -708,44 +1054,15 @@ class SearchImageRegionResource(Resource):
     parser.add_argument('metadata', type=dict)
     parser.add_argument('filter_duplicates', type=bool, default=True, location='json')
 
-    @api.marshal_with(model_image_search_region)
+    @fast_marshal_with(api, model_image_search_region)
     @api.expect(parser)
+    @coalesce_anonymous
     def post(self):
         args = self.parser.parse_args()
-        nb_results = args['nb_results']
-        if args['filter_duplicates']:
-            args['nb_results'] = int(2.5*args['nb_results'])
-        if args.get('metadata'):
-            metadata = args['metadata']
-            ids, _ = elastic_search_ids(metadata.get('query', ''),
-                                     metadata.get('all_terms', True),
-                                     metadata.get('min_date'),
-                                     metadata.get('max_date'),
-                                     50000)
-            filtered_uids = model.CHO.get_image_uids_from_ids(ids)
-            del args['metadata']
-            args['filtered_uids'] = filtered_uids
-        try:
-            r = requests.post(app.config['REPLICA_SEARCH_URL'] + '/api/search_region', json=args)
-        except Exception as e:
-            raise BadRequest('Could not connect to search server')
-        if r.status_code != 200:
-            raise BadRequest('Bad answer from the search server : {}'.format(r.json().get('message')))
-        result_output = []
-        request_output = r.json()
-        result_output_raw = request_output['results']
-        if args['filter_duplicates']:
-            image_uids = [r['uid'] for r in result_output_raw]
-            image_uids = set(model.utils.filter_duplicates_image_uids(image_uids))
-            result_output_raw = [r for r in result_output_raw if r['uid'] in image_uids]
-
-        chos = model.CHO.get_from_image_uids([r['uid'] for r in result_output_raw])
-        for result, cho in zip(result_output_raw, chos):
-            r = cho.to_dict()
-            r['images'][0]['box'] = result['box']
-            result_output.append(r)
-        result_output = result_output[:nb_results]
-        return {'results': result_output, 'total': request_output['total']}
+        nb_results, metadata = image_search_request(args)
+        filtered_uids = metadata_filtered_image_uids(metadata, 50000) if metadata is not None else None
+        request_output = search_server_post('/api/search_region', args, 30, filtered_uids)
+        return image_search_results(request_output, args['filter_duplicates'], nb_results)
 
 
 @api.route('/api/auth')
@@ -772,7 +1089,7 @@ class CurrentUserResource(Resource):
     @api.marshal_with(api.models['User'])
     @auth.login_required
     def get(self):
-        current_user = model.User.nodes.get(uid=g.user_uid)
+        current_user = model.User.get_cached(g.user_uid)
         return current_user.to_dict()
 
 
@@ -781,15 +1098,103 @@ class CurrentUserGroupsRessource(Resource):
     @api.marshal_with(api.models['Groups'])
     @auth.login_required
     def get(self):
-        current_user = model.User.nodes.get(uid=g.user_uid)
+        current_user = model.User.get_cached(g.user_uid)
+
+        return {'groups': model.Group.to_dicts(current_user.groups.all())}
+
+
+# (index, uid1, uid2) -> distance, uid1 < uid2, the default search index being None
+distance_cache = LRUCache('distances', max_size=app.config.get('DISTANCE_CACHE_SIZE', 200000))
+
+DISTANCES_FORMATS = ['list', 'base64', 'base64_upper']
+
+
+def encode_distances(matrix: np.ndarray, distances_format='list') -> dict:
+    """
+    `distances` as nested lists, or `distances_b64` as base64 of the little-endian float32 matrix (row-major),
+    or of its upper triangle without the diagonal for `base64_upper`
+    """
+    if distances_format == 'list':
+        return {'distances': matrix.tolist()}
+    if distances_format == 'base64_upper':
+        matrix = matrix[np.triu_indices(len(matrix), 1)]
+    return {'distances_b64': base64.b64encode(matrix.astype('<f4').tobytes()).decode('ascii')}
+
+
+def _distance_key(uid1: str, uid2: str, index: str=None) -> tuple:
+    return (index, uid1, uid2) if uid1 < uid2 else (index, uid2, uid1)
+
+
+def cached_distance_matrix(image_uids: List[str]) -> Optional[np.ndarray]:
+    """Distance matrix of the images if all their pairs are cached, that is for graphs computed before or parts
+    of them"""
+    matrix = np.zeros((len(image_uids), len(image_uids)), dtype=np.float32)
+    for i, uid1 in enumerate(image_uids):
+        for j in range(i + 1, len(image_uids)):
+            distance = distance_cache.get(_distance_key(uid1, image_uids[j]))
+            if distance is None:
+                return None
+            matrix[i, j] = matrix[j, i] = distance
+    return matrix
+
+
+def store_graph_distances(image_uids: List[str], request_output: dict) -> np.ndarray:
+    """Caches the distance matrix of the images answered by the search server"""
+    distances = request_output['distances']
+    for i, uid1 in enumerate(image_uids):
+        for j in range(i + 1, len(image_uids)):
+            distance_cache.set(_distance_key(uid1, image_uids[j]), distances[i][j])
+    return np.array(distances, dtype=np.float32)
+
+
+def graph_distance_matrix(image_uids: List[str]) -> np.ndarray:
+    """
+    Distance matrix of the images, the search server only answering full square matrices it is fetched again
+    as soon as a pair is missing from the cache
+    """
+    matrix = cached_distance_matrix(image_uids)
+    if matrix is None:
+        request_output = search_server_post('/api/distance_matrix', {'image_uids': image_uids}, 30)
+        matrix = store_graph_distances(image_uids, request_output)
+    return matrix
+
+
+def graph_neighborhood(args: dict) -> Tuple[List[str], List[Tuple[str, str, int]]]:
+    """Image uids and link rows of the graph asked by the parsed arguments of `GraphResource`"""
+    return model.link_graph.neighborhood(args['image_uids'], max(args['graph_depth'], 0), args['max_nodes_per_hop'],
+                                         args['link_types'])
+
+
+def graph_result(image_uids: List[str], link_rows: List[Tuple[str, str, int]]) -> dict:
+    """Database stage of the graph, images deleted since the link graph was loaded are left out"""
+    nodes, links = model.utils.resolve_subgraph(model.VisualLink, image_uids, link_rows)
+    return {
+        'nodes': model.Image.to_dicts(nodes),
+        'links': [{'source': uid1,
+                   'target': uid2,
+                   'data': d} for (uid1, uid2, _), d in zip(links,
+                                                            model.VisualLink.to_dicts([l for _, _, l in links]))]
+    }
 
-        return {'groups': [group.to_dict() for group in current_user.groups]}
+
+def add_graph_distances(result: dict, matrix: np.ndarray, distances_format: str) -> dict:
+    """Adds the distance matrix of the nodes of the graph, in the order of `result['nodes']`"""
+    result.update(encode_distances(matrix, distances_format))
+    return result
 
 
 @api.route('/api/graph')
 class GraphResource(Resource):
     parser = api.parser()
     parser.add_argument('image_uids', type=list, required=True, location='json')
+    parser.add_argument('graph_depth', type=int, default=3, location='json')
+    parser.add_argument('max_nodes_per_hop', type=int, location='json',
+                        help='Maximum number of images added at each hop, no limit if not given')
+    parser.add_argument('link_types', type=list, location='json',
+                        help='Types of the links followed, all of them if not given')
+    parser.add_argument('distances_format', type=str, default='list', choices=DISTANCES_FORMATS, location='json',
+                        help='`list` for nested lists in `distances`, `base64` for the float32 matrix in '
+                             '`distances_b64`, `base64_upper` for its upper triangle (without the diagonal)')
 
     graph_link_model = api.model('GraphLinkData', {'source': fields.String,
                                                    'target': fields.String,
@@ -797,39 +1202,35 @@ class GraphResource(Resource):
     graph_model = api.model('GraphData',
                             {'nodes': fields.List(fields.Nested(api.models['Image'])),
                              'links': fields.List(fields.Nested(graph_link_model)),
-                             'distances': fields.List(fields.List(fields.Float))})
+                             'distances': fields.List(fields.List(fields.Float)),
+                             'distances_b64': fields.String})
 
-    @api.marshal_with(graph_model)
+    @fast_marshal_with(api, graph_model)
+    @api.expect(parser)
     def post(self):
         args = self.parser.parse_args()
         print(args['image_uids'])
-        nodes, links = model.get_subgraph(args['image_uids'])
-        try:
-            r = requests.post(app.config['REPLICA_SEARCH_URL'] + '/api/distance_matrix',
-                              json={'image_uids': [img.uid for img in nodes]})
-        except Exception as e:
-            raise BadRequest('Could not connect to search server')
-        if r.status_code != 200:
-            raise BadRequest('Bad answer from the search server : {}'.format(r.json().get('message')))
-        return {
-            'nodes': [img.to_dict() for img in nodes],
-            'links': [{'source': uid1,
-                       'target': uid2,
-                       'data': l.to_dict()} for uid1, uid2, l in links],
-            'distances': r.json()['distances']
-        }
+        image_uids, link_rows = graph_neighborhood(args)
+        result = graph_result(image_uids, link_rows)
+        node_uids = [n['uid'] for n in result['nodes']]
+        return add_graph_distances(result, graph_distance_matrix(node_uids), args['distances_format'])
+
+
+def preload_indexes():
+    """Loads the in-memory indexes in the background so that the first requests do not wait for them"""
+    Thread(target=model.link_graph.load, name='load-link-graph', daemon=True).start()
 
 
 _log_lock = Lock()
 @api.route('/api/log')
-class GraphResource(Resource):
+class LogResource(Resource):
     parser = api.parser()
     parser.add_argument('data', type=dict, required=True, location='json')
 
     @api.expect(parser)
     @auth.login_required
     def post(self):
-        current_user = model.User.nodes.get(uid=g.user_uid)
+        current_user = model.User.get_cached(g.user_uid)
         data = self.parser.parse_args()['data']
         data['user_uid'] = current_user.username
         with _log_lock:
@@ -841,4 +1242,5 @@ class GraphResource(Resource):
 
 if __name__ == '__main__':
     monitor(app, port=5010)
+    preload_indexes()
     app.run(host='0.0.0.0', debug=True, port=5000, threaded=True)
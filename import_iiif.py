@@ -1,16 +1,25 @@
-import requests
 import tqdm
+import time
+from functools import partial
 from replica_core.model import CHO, Image, Collection
+from replica_core.iiif_fetch import ManifestFetcher, ManifestCache, ImportCheckpoint
+from replica_core.model.bulk import IIIFBatchWriter
 import argparse
 
 import core_server
 
-pbar = tqdm.tqdm(desc='#Images added')
+pbar_manifests = tqdm.tqdm(desc='#Manifests added', unit='manifests')
+pbar = tqdm.tqdm(desc='#Images added', unit='images')
 pbar_failed = tqdm.tqdm(desc='#Resource failed')
 
 METADATA_AUTHOR_FIELD = None
 METADATA_TITLE_FIELD = None
 
+fetcher = ManifestFetcher()
+writer = IIIFBatchWriter()
+# Collections touched by the import, their elements' hierarchy paths are rebuilt at the end
+imported_collection_uris = set()
+
 
 def get_id(data, required=False):
     if isinstance(data, dict):
@@ -40,11 +49,19 @@ def get_one(data):
 def download_json(uri, verbose=False):
     if verbose:
         print('Downloading : {}'.format(uri))
-    r = requests.get(uri)
-    return r.json()
+    return fetcher.download_json(uri)
+
+
+def is_full_manifest(data):
+    return isinstance(data, dict) and 'sequences' in data.keys()
 
 
-def create_coll(data, overwrite_ok=True):
+def create_coll(data, pending_manifests=None):
+    """
+    Creates the collection and its sub-collections. If `pending_manifests` is given, the manifests are not imported
+    but appended to it as `(collection, manifest_data)` to be imported by `import_manifests`.
+    Nodes are only written by `writer` and existing ones (same uri) are overwritten.
+    """
     uri = get_id(data, required=True)
     if isinstance(data, str) or ('collections' not in data.keys() and 'manifests' not in data.keys()):
         data = download_json(uri, verbose=True)
@@ -52,43 +69,75 @@ def create_coll(data, overwrite_ok=True):
     assert 'collections' in data.keys() or 'manifests' in data.keys()
     # assert not ('collections' in data.keys() and 'manifests' in data.keys())
 
-    coll = Collection.nodes.get_or_none(uri=uri)
-    if coll is not None and not overwrite_ok:
-        raise Exception()
-    if coll is None:
-        coll = Collection()
+    coll = Collection()
     coll.uri = get_id(data, required=True)
     coll.label = data.get('label', '')
     coll.raw_metadata = data.get('metadata', {})
     coll.description = data.get('description', '')
     coll.thumbnail = get_id(data.get('thumbnail'))
-    coll.save()
+    writer.add_node(coll)
+    imported_collection_uris.add(coll.uri)
 
     for new_coll_data in data.get('collections', []):
-        new_coll = create_coll(new_coll_data, overwrite_ok)
-        coll.children_collections.connect(new_coll)
+        new_coll = create_coll(new_coll_data, pending_manifests)
+        writer.add_relationship(coll, 'COLL_CONTAINS', new_coll)
 
     for new_manifest_data in data.get('manifests', []):
-        cho = create_cho(new_manifest_data, overwrite_ok)
-        coll.elements.connect(cho)
+        if pending_manifests is not None:
+            pending_manifests.append((coll, new_manifest_data))
+        else:
+            cho = create_cho(new_manifest_data)
+            writer.add_relationship(coll, 'COLL_CONTAINS', cho)
 
     return coll
 
 
-def create_cho(data, overwrite_ok=True):
+def import_manifests(pending_manifests, checkpoint: ImportCheckpoint=None):
+    """
+    Manifests are downloaded in parallel by the fetcher threads while the main thread parses the already
+    downloaded ones and buffers them in `writer`. A manifest is checkpointed once its batch is committed.
+    """
+    def _download(task):
+        coll, data = task
+        return data if is_full_manifest(data) else download_json(get_id(data, required=True))
+
+    if checkpoint is not None:
+        pending_manifests = [(coll, data) for coll, data in pending_manifests
+                             if get_id(data, required=True) not in checkpoint]
+    start_time, start_nb_images = time.time(), pbar.n
+    nb_manifests = 0
+    for (coll, data), manifest_data, exception in fetcher.map_unordered(_download, pending_manifests):
+        uri = get_id(data, required=True)
+        try:
+            if exception is not None:
+                raise exception
+            cho = create_cho(manifest_data)
+        except Exception as e:
+            print('Failed manifest {} : {}'.format(uri, e))
+            pbar_failed.update(1)
+            continue
+        writer.add_relationship(coll, 'COLL_CONTAINS', cho)
+        if checkpoint is not None:
+            writer.call_after_flush(partial(checkpoint.mark_done, uri))
+        nb_manifests += 1
+        pbar_manifests.update(1)
+    writer.flush()
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    print('Imported {} manifests ({:.2f} manifests/sec) and {} images ({:.2f} images/sec)'.format(
+        nb_manifests, nb_manifests / elapsed, pbar.n - start_nb_images, (pbar.n - start_nb_images) / elapsed))
+
+
+def create_cho(data):
     uri = get_id(data, required=True)
-    if isinstance(data, str) or 'sequences' not in data.keys():
+    if not is_full_manifest(data):
         data = download_json(uri, verbose=False)
     assert data['@type'] == 'sc:Manifest'
     assert 'sequences' in data.keys()
 
     # Parse Manifest base
     assert uri.startswith('https://'), "IIIF Manifests MUST BE HTTPS"
-    cho = CHO.nodes.get_or_none(uri=uri)
-    if cho is not None and not overwrite_ok:
-        raise Exception()
-    if cho is None:
-        cho = CHO()
+    cho = CHO()
     cho.uri = uri
     cho.label = data.get('label', '')
     cho.description = data.get('description', '')
@@ -117,24 +166,26 @@ def create_cho(data, overwrite_ok=True):
     begin_range_date, end_range_date = cho.get_date_range_from_fields(['date', 'daterange', 'timeline', 'timeframe'])
     cho.date_begin = begin_range_date
     cho.date_end = end_range_date
-    cho.save()
 
     # Gather all the image ressources
     painting_annotations = [img for seq in data['sequences'] for can in seq['canvases'] for img in can['images']
                             if img['@type'] == 'oa:Annotation' and img['motivation'] == 'sc:painting']
     resources = [anno['resource'] for anno in painting_annotations if 'resource' in anno.keys()]
 
+    writer.add_node(cho)
     for res in resources:
         try:
             img = create_image(res)
-            cho.images.connect(img)
+            writer.add_node(img)
+            writer.add_relationship(cho, 'IS_SHOWN_BY', img)
+            pbar.update(1)
         except Exception as e:
             pbar_failed.update(1)
 
     return cho
 
 
-def create_image(resource, overwrite_ok=True):
+def create_image(resource):
     _standard_str = 'http://iiif.io/api/image/2/'
     _standard_str_old = 'http://library.stanford.edu/iiif/image-api/'
 
@@ -146,16 +197,10 @@ def create_image(resource, overwrite_ok=True):
            resource['service'].get('profile', '').startswith(_standard_str)
     iiif_url = resource['service']['@id']  # type: str
     assert iiif_url.startswith('https://'), "IIIF Manifests MUST BE HTTPS"
-    img = Image.nodes.get_or_none(iiif_url=iiif_url)
-    if img is not None and not overwrite_ok:
-        raise Exception()
-    if img is None:
-        img = Image()
+    img = Image()
     img.iiif_url = iiif_url
     img.height = resource.get('height')
     img.width = resource.get('width')
-    img.save()
-    pbar.update(1)
     return img
 
 
@@ -164,10 +209,25 @@ if __name__ == '__main__':
     ap.add_argument("-m", "--top-manifest", required=True, help="Top collection manifest to be imported")
     ap.add_argument("-a", "--author-field", required=True, help="Author field in the metadata")
     ap.add_argument("-t", "--title-field", required=True, help="Title field in the metadata")
+    ap.add_argument("-w", "--nb-workers", type=int, default=8, help="Number of parallel manifest downloads")
+    ap.add_argument("-c", "--checkpoint", help="File of the imported manifests, used to resume an interrupted import")
+    ap.add_argument("-b", "--batch-size", type=int, default=1000, help="Number of nodes and relationships per write")
+    ap.add_argument("--cache-dir", help="Directory where the downloaded IIIF documents are cached")
+    ap.add_argument("--offline", action='store_true', help="Replay the import from the cache without network access")
     args = vars(ap.parse_args())
 
     METADATA_AUTHOR_FIELD = args['author_field']
     METADATA_TITLE_FIELD = args['title_field']
-
-    create_coll(args['top_manifest'])
+    fetcher = ManifestFetcher(nb_workers=args['nb_workers'],
+                              cache=ManifestCache(args['cache_dir']) if args['cache_dir'] else None,
+                              offline=args['offline'])
+    writer = IIIFBatchWriter(batch_size=args['batch_size'])
+    checkpoint = ImportCheckpoint(args['checkpoint']) if args['checkpoint'] else None
+
+    pending_manifests = []
+    create_coll(args['top_manifest'], pending_manifests=pending_manifests)
+    import_manifests(pending_manifests, checkpoint=checkpoint)
+    Collection.rebuild_hierarchy_cache(element_collection_uris=imported_collection_uris)
+    if checkpoint is not None:
+        checkpoint.close()
 
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import time
+import aiohttp
+from .http_client import BACKEND_LATENCY, BackendError, BackendUnavailable, CircuitBreaker, IDEMPOTENT_METHODS
+
+
+class AsyncBackendResponse:
+    """Fully read answer of a backend"""
+    def __init__(self, status_code: int, headers, content: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+
+class AsyncBackendClient:
+    """
+    asyncio counterpart of `BackendClient` : one aiohttp session per backend with a bounded connection pool,
+    default timeout, bounded retries with exponential backoff (same policy) and a circuit breaker. `start` has to be called
+    from the event loop before the first request.
+    """
+    RETRY_STATUSES = [502, 503, 504]
+
+    def __init__(self, name: str, base_url: str, pool_size=100, timeout=10, retries=2, backoff=0.2,
+                 failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.session = None  # type: aiohttp.ClientSession
+
+    async def start(self):
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def request(self, method: str, route: str, timeout=None, retries=None, metric_route=None,
+                      **kwargs) -> AsyncBackendResponse:
+        """
+        :param route: appended to the base url of the backend
+        :param metric_route: route label of the latency histogram, defaults to `route`, should not contain ids
+        :param kwargs: passed to `aiohttp.ClientSession.request`
+        """
+        if not self.breaker.allow():
+            raise BackendUnavailable('{} is unavailable'.format(self.name))
+        timeout = aiohttp.ClientTimeout(total=timeout if timeout is not None else self.timeout)
+        retries = retries if retries is not None else self.retries
+        latency = BACKEND_LATENCY.labels(self.name, metric_route or route)
+        error = None
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            start = time.monotonic()
+            try:
+                async with self.session.request(method, self.base_url + route, timeout=timeout, **kwargs) as r:
+                    if r.status in self.RETRY_STATUSES:
+                        # Released unread by the context manager
+                        error = 'status {}'.format(r.status)
+                    else:
+                        response = AsyncBackendResponse(r.status, r.headers, await r.read())
+                        error = None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+                if isinstance(e, aiohttp.ClientConnectorError) or method in IDEMPOTENT_METHODS:
+                    continue
+                break
+            finally:
+                latency.observe(time.monotonic() - start)
+            if error is None:
+                self.breaker.record_success()
+                return response
+            if method not in IDEMPOTENT_METHODS:
+                break
+        self.breaker.record_failure()
+        raise BackendError('Request to {} failed : {}'.format(self.name, error)) \
+            from (error if isinstance(error, Exception) else None)
+
+    async def open(self, method: str, route: str, timeout=None, metric_route=None,
+                   **kwargs) -> aiohttp.ClientResponse:
+        """
+        Single attempt whose body is not read, for streaming it. The caller has to `release()` the response.
+        The latency histogram only measures the time to the headers.
+        """
+        if not self.breaker.allow():
+            raise BackendUnavailable('{} is unavailable'.format(self.name))
+        timeout = aiohttp.ClientTimeout(total=timeout if timeout is not None else self.timeout)
+        start = time.monotonic()
+        try:
+            response = await self.session.request(method, self.base_url + route, timeout=timeout, **kwargs)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.breaker.record_failure()
+            raise BackendError('Request to {} failed : {}'.format(self.name, e)) from e
+        finally:
+            BACKEND_LATENCY.labels(self.name, metric_route or route).observe(time.monotonic() - start)
+        if response.status in self.RETRY_STATUSES:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    async def get(self, route: str, **kwargs) -> AsyncBackendResponse:
+        return await self.request('GET', route, **kwargs)
+
+    async def post(self, route: str, **kwargs) -> AsyncBackendResponse:
+        return await self.request('POST', route, **kwargs)
+
+    async def delete(self, route: str, **kwargs) -> AsyncBackendResponse:
+        return await self.request('DELETE', route, **kwargs)
@@ -0,0 +1,368 @@
+import os
+import json
+import time
+import hashlib
+import mimetypes
+import traceback
+import numpy as np
+from collections import OrderedDict, namedtuple
+from threading import RLock, Lock, Thread, Event, get_ident
+from typing import List, Callable, Optional, Tuple, Hashable
+
+_registered_caches = []  # type: List['LRUCache']
+
+
+def registered_caches() -> List['LRUCache']:
+    return list(_registered_caches)
+
+
+class LRUCache:
+    """
+    Thread-safe process-local cache with a bounded size (LRU eviction) and an optional time-to-live
+    """
+    _missing = object()
+
+    def __init__(self, name: str, max_size=1000, ttl=None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expiry, value)
+        self._lock = RLock()
+        _registered_caches.append(self)
+
+    def configure(self, max_size=None, ttl=None):
+        with self._lock:
+            if max_size is not None:
+                self.max_size = max_size
+            if ttl is not None:
+                self.ttl = ttl
+            self._evict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, self._missing)
+            if entry is not self._missing and (entry[0] is None or entry[0] > time.monotonic()):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not self._missing:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            expiry = time.monotonic() + self.ttl if self.ttl is not None else None
+            self._data[key] = (expiry, value)
+            self._data.move_to_end(key)
+            self._evict()
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def _evict(self):
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'name': self.name,
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total > 0 else 0.
+            }
+
+
+class PeriodicValue:
+    """
+    Value computed by `fn` and kept up to date by a background daemon thread every `interval` seconds.
+    Only the very first `get` waits for the computation, the following ones return the last snapshot.
+    Each computation gets a `generation` number when it starts, a computation finishing after a more recent one
+    is not installed.
+    """
+    _missing = object()
+
+    def __init__(self, name: str, fn: Callable, interval=300, lock=None):
+        """
+        :param lock: RLock held during the first computation and while a new value is installed and the
+                     `on_install` callbacks run, so that its holders see the value and the state derived from it
+                     change together
+        """
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.last_refresh = None
+        self.generation = 0  # Number of computations started
+        self.value_generation = 0  # Generation of the current value
+        self._value = self._missing
+        self._callbacks = []
+        self._install_callbacks = []
+        self._lock = lock if lock is not None else RLock()
+        self._generation_lock = Lock()
+        self._thread = None
+
+    def on_refresh(self, callback: Callable):
+        """`callback(old_value, new_value)` is called after each refresh, can be used as a decorator"""
+        self._callbacks.append(callback)
+        return callback
+
+    def on_install(self, callback: Callable):
+        """`callback(value, generation)` is called under the lock whenever a value is installed, the first one
+        included"""
+        self._install_callbacks.append(callback)
+        return callback
+
+    def get(self):
+        if self._value is self._missing:
+            with self._lock:
+                if self._value is self._missing:
+                    self.refresh()
+                if self._thread is None:
+                    self._thread = Thread(target=self._run, name='refresh-{}'.format(self.name), daemon=True)
+                    self._thread.start()
+        return self._value
+
+    def peek(self):
+        """Current value without computing it, None if not computed yet"""
+        value = self._value
+        return value if value is not self._missing else None
+
+    def refresh(self):
+        with self._generation_lock:
+            self.generation += 1
+            generation = self.generation
+        new_value = self.fn()
+        with self._lock:
+            if generation < self.value_generation:
+                return
+            old_value, self._value = self._value, new_value
+            self.value_generation = generation
+            self.last_refresh = time.time()
+            for callback in self._install_callbacks:
+                callback(new_value, generation)
+        if old_value is not self._missing:
+            for callback in self._callbacks:
+                callback(old_value, new_value)
+
+    def refresh_async(self):
+        """Starts a refresh in a new daemon thread, the current value is served in the meantime"""
+        Thread(target=self._refresh, name='refresh-{}'.format(self.name), daemon=True).start()
+
+    def _refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            # Keep the previous snapshot
+            traceback.print_exc()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self._refresh()
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key : only the first one runs, the others wait for its result"""
+    class _Call:
+        def __init__(self):
+            self.done = Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = dict()
+        self._lock = Lock()
+
+    def do(self, key: Hashable, fn: Callable):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+FileCacheEntry = namedtuple('FileCacheEntry', ['path', 'content_type', 'etag', 'size'])
+
+
+class FileCache:
+    """
+    Content-addressed on-disk cache shared by the processes using the same `directory` : each body is stored once
+    in `blobs/`, named after its sha256 (also its ETag), and `keys/` maps the hash of each key to a body and its
+    content type. The least recently used bodies, and the keys mapped to them, are removed when the total size of
+    the directory exceeds `max_size` bytes. Disabled while `directory` is None.
+    """
+    # Fraction of `max_size` written by this process after which the size is measured again on disk, the other
+    # processes writing to the same directory
+    RESCAN_FRACTION = 0.1
+
+    def __init__(self, name: str, directory: str=None, max_size=1 << 30):
+        self.name = name
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._size = None  # Size of the directory at the last scan
+        self._written = 0  # Bytes written by this process since the last scan
+        self._lock = Lock()
+        self._flights = SingleFlight()
+        _registered_caches.append(self)
+
+    def configure(self, directory=None, max_size=None):
+        if directory is not None:
+            self.directory = directory
+            self._size, self._written = None, 0
+        if max_size is not None:
+            self.max_size = max_size
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def _path(self, kind: str, name: str) -> str:
+        return os.path.join(self.directory, kind, name[:2], name)
+
+    @staticmethod
+    def _write(path: str, content: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}-{}.tmp'.format(path, os.getpid(), get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        # Atomic so that a concurrent reader never sees a partial file
+        os.replace(tmp_path, path)
+
+    def _get(self, key: Hashable) -> Optional[FileCacheEntry]:
+        try:
+            with open(self._path('keys', self._key_hash(key)), 'rb') as f:
+                meta = json.loads(f.read().decode('utf-8'))
+            path = self._path('blobs', meta['blob'])
+            # Marks the body as recently used
+            os.utime(path)
+            return FileCacheEntry(path, meta['content_type'], meta['etag'], os.stat(path).st_size)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    @staticmethod
+    def _key_hash(key: Hashable) -> str:
+        return hashlib.sha256(repr(key).encode()).hexdigest()
+
+    def get(self, key: Hashable) -> Optional[FileCacheEntry]:
+        entry = self._get(key)
+        with self._lock:
+            if entry is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry
+
+    def set(self, key: Hashable, content: bytes, content_type: str) -> FileCacheEntry:
+        etag = hashlib.sha256(content).hexdigest()
+        # The extension lets file servers guess the content type
+        blob = etag + (mimetypes.guess_extension(content_type.split(';')[0].strip()) or '')
+        path = self._path('blobs', blob)
+        is_new = not os.path.exists(path)
+        if is_new:
+            self._write(path, content)
+        meta = json.dumps({'blob': blob, 'etag': etag, 'content_type': content_type}).encode('utf-8')
+        self._write(self._path('keys', self._key_hash(key)), meta)
+        self._added((len(content) if is_new else 0) + len(meta))
+        return FileCacheEntry(path, content_type, etag, len(content))
+
+    def get_or_fetch(self, key: Hashable, fetch: Callable[[], Tuple[bytes, str]]) -> FileCacheEntry:
+        """
+        Entry of the key, `fetch()` giving the `(content, content_type)` of a missing key.
+        Concurrent misses of the same key wait for a single `fetch`, whose errors are not cached.
+        """
+        entry = self.get(key)
+        if entry is None:
+            entry = self._flights.do(key, lambda: self._get(key) or self.set(key, *fetch()))
+        return entry
+
+    def _files(self, kind: str) -> List[Tuple[os.stat_result, str]]:
+        files = []
+        for root, _, names in os.walk(os.path.join(self.directory, kind)):
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    files.append((os.stat(path), path))
+                except OSError:
+                    pass  # Removed by another process
+        return files
+
+    @staticmethod
+    def _remove(path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False  # Removed by another process
+
+    def _added(self, size: int):
+        with self._lock:
+            self._written += size
+            if self._size is not None and self._size + self._written <= self.max_size \
+                    and self._written <= self.RESCAN_FRACTION * self.max_size:
+                return
+            blobs, keys = self._files('blobs'), self._files('keys')
+            self._size = sum(stat.st_size for stat, _ in blobs + keys)
+            self._written = 0
+            if self._size <= self.max_size:
+                return
+            # Down to 90% so that evictions do not happen at every write
+            for stat, path in sorted(blobs, key=lambda b: b[0].st_mtime):
+                if self._size <= 0.9 * self.max_size:
+                    break
+                if self._remove(path):
+                    self._size -= stat.st_size
+            # Keys of the removed bodies
+            for stat, path in keys:
+                try:
+                    with open(path, 'rb') as f:
+                        blob = json.loads(f.read().decode('utf-8'))['blob']
+                    dangling = not os.path.exists(self._path('blobs', blob))
+                except (OSError, ValueError, KeyError):
+                    dangling = True
+                if dangling and self._remove(path):
+                    self._size -= stat.st_size
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'name': self.name,
+                'size': self._size or 0,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total > 0 else 0.
+            }
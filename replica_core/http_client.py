@@ -0,0 +1,133 @@
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import NewConnectionError
+from threading import Lock
+from prometheus_client import Histogram
+
+BACKEND_LATENCY = Histogram('replica_backend_request_latency_seconds', 'Latency of the requests to the backends',
+                            ['backend', 'route'])
+
+
+class BackendError(Exception):
+    pass
+
+
+class BackendUnavailable(BackendError):
+    """Raised without sending anything when the circuit breaker of the backend is open"""
+    pass
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures, then lets a single trial request go through
+    every `reset_timeout` seconds until one succeeds
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.nb_failures = 0
+        self.opened_at = None
+        self._lock = Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Half-open, the next requests are refused until the trial one is done
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.nb_failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.nb_failures += 1
+            if self.nb_failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+# Methods which can be sent again when the outcome of an attempt is unknown
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+
+def _not_sent(error: requests.RequestException) -> bool:
+    """True if the connection could not be established, so the request never reached the backend"""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if len(error.args) > 0 else None
+    return isinstance(reason, NewConnectionError)
+
+
+class BackendClient:
+    """
+    HTTP client for one backend server (search server, elasticsearch...) with its own keep-alive connection pool,
+    default timeout, bounded retries with exponential backoff and a circuit breaker.
+    Failed connections are retried for every method, timeouts and gateway errors only for idempotent methods.
+    A request failing on its last attempt raises `BackendError`.
+    """
+    RETRY_STATUSES = [502, 503, 504]
+
+    def __init__(self, name: str, base_url: str, pool_size=20, timeout=10, retries=2, backoff=0.2,
+                 failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method: str, route: str, timeout=None, retries=None, metric_route=None,
+                **kwargs) -> requests.Response:
+        """
+        :param route: appended to the base url of the backend
+        :param metric_route: route label of the latency histogram, defaults to `route`, should not contain ids
+        :param kwargs: passed to `requests.Session.request`
+        """
+        if not self.breaker.allow():
+            raise BackendUnavailable('{} is unavailable'.format(self.name))
+        timeout = timeout if timeout is not None else self.timeout
+        retries = retries if retries is not None else self.retries
+        latency = BACKEND_LATENCY.labels(self.name, metric_route or route)
+        error = None
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, self.base_url + route, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+                if _not_sent(e) or method in IDEMPOTENT_METHODS:
+                    continue
+                break
+            finally:
+                latency.observe(time.monotonic() - start)
+            if response.status_code not in self.RETRY_STATUSES:
+                self.breaker.record_success()
+                return response
+            response.close()
+            error = 'status {}'.format(response.status_code)
+            if method not in IDEMPOTENT_METHODS:
+                break
+        self.breaker.record_failure()
+        raise BackendError('Request to {} failed : {}'.format(self.name, error)) \
+            from (error if isinstance(error, Exception) else None)
+
+    def get(self, route: str, **kwargs) -> requests.Response:
+        return self.request('GET', route, **kwargs)
+
+    def post(self, route: str, **kwargs) -> requests.Response:
+        return self.request('POST', route, **kwargs)
+
+    def delete(self, route: str, **kwargs) -> requests.Response:
+        return self.request('DELETE', route, **kwargs)
@@ -0,0 +1,132 @@
+import os
+import gzip
+import json
+import hashlib
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from threading import Lock, get_ident
+from typing import Callable, Iterable, Iterator, Tuple, Any, Optional
+
+
+class ManifestCache:
+    """
+    On-disk cache of IIIF documents, one gzipped json file per URI named after the hash of the URI. The validators
+    (ETag and Last-Modified) of the response are stored along the body.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _path(self, uri: str) -> str:
+        h = hashlib.sha256(uri.encode()).hexdigest()
+        return os.path.join(self.directory, h[:2], h + '.json.gz')
+
+    def get(self, uri: str) -> Optional[dict]:
+        """The cached entry `{'uri', 'etag', 'last_modified', 'body'}` or None"""
+        try:
+            with gzip.open(self._path(uri), 'rt', encoding='utf-8') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def put(self, uri: str, body: dict, etag: str=None, last_modified: str=None):
+        path = self._path(uri)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}-{}.tmp'.format(path, os.getpid(), get_ident())
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump({'uri': uri, 'etag': etag, 'last_modified': last_modified, 'body': body}, f)
+        # Atomic so that a concurrent or interrupted write never leaves a corrupted entry
+        os.replace(tmp_path, path)
+
+
+class ManifestFetcher:
+    """
+    Downloads IIIF documents through a keep-alive session with a connection pool sized for `nb_workers`
+    concurrent downloads.
+    With a `cache`, requests are conditional and the cached body is reused if the document did not change.
+    In `offline` mode, documents are only read from the cache.
+    """
+    def __init__(self, nb_workers=8, timeout=60, max_retries=3, cache: ManifestCache=None, offline=False):
+        if offline and cache is None:
+            raise ValueError('Offline mode requires a manifest cache')
+        self.nb_workers = nb_workers
+        self.timeout = timeout
+        self.cache = cache
+        self.offline = offline
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=nb_workers, pool_maxsize=nb_workers, max_retries=max_retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def download_json(self, uri: str) -> dict:
+        cached = self.cache.get(uri) if self.cache is not None else None
+        if self.offline:
+            if cached is None:
+                raise ValueError('{} is not in the manifest cache'.format(uri))
+            return cached['body']
+        headers = dict()
+        if cached is not None:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        r = self.session.get(uri, headers=headers, timeout=self.timeout)
+        if r.status_code == 304 and cached is not None:
+            return cached['body']
+        r.raise_for_status()
+        body = r.json()
+        if self.cache is not None:
+            self.cache.put(uri, body, r.headers.get('ETag'), r.headers.get('Last-Modified'))
+        return body
+
+    def map_unordered(self, fn: Callable, items: Iterable, max_pending=None) -> Iterator[Tuple[Any, Any, Exception]]:
+        """
+        Runs `fn(item)` in the thread pool and yields `(item, result, exception)` as they complete.
+        At most `max_pending` items are submitted at once so that `items` can be a long generator.
+        """
+        max_pending = max_pending or 4 * self.nb_workers
+        items = iter(items)
+        with ThreadPoolExecutor(self.nb_workers) as executor:
+            pending = dict()
+            while True:
+                for item in items:
+                    pending[executor.submit(fn, item)] = item
+                    if len(pending) >= max_pending:
+                        break
+                if len(pending) == 0:
+                    return
+                done, _ = wait(pending.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    exception = future.exception()
+                    yield item, (future.result() if exception is None else None), exception
+
+
+class ImportCheckpoint:
+    """
+    Append-only file of the manifest URIs already imported, so that an interrupted import can be resumed
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._done = set()
+        self._lock = Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                self._done = {l.strip() for l in f if l.strip() != ''}
+        self._file = open(path, 'a')
+
+    def __contains__(self, uri: str):
+        return uri in self._done
+
+    def __len__(self):
+        return len(self._done)
+
+    def mark_done(self, uri: str):
+        with self._lock:
+            if uri not in self._done:
+                self._done.add(uri)
+                self._file.write(uri + '\n')
+                self._file.flush()
+
+    def close(self):
+        self._file.close()
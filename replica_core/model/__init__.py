@@ -1,5 +1,9 @@
-from .base import BaseElement, SerializationLevel
+from .base import BaseElement, SerializationLevel, node_cache
 from .iiif import CHO, Collection, Image
 from .user import User, Group, GroupContains
 from .link import VisualLink, PersonalLink, TripletComparison
 from .utils import get_subgraph, get_subgraph_personal
+from .duplicates import duplicate_index
+from .proposal_queue import proposal_queue
+from .link_graph import link_graph, personal_link_graphs
+from .statistics import DailyStatistics, update_daily_statistics
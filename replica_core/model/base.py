@@ -5,6 +5,11 @@ from neomodel import StringProperty, DateTimeProperty, ArrayProperty, UniqueIdPr
 from flask_restplus import fields, Model
 from datetime import datetime, timedelta
 from collections import defaultdict
+from typing import List, Dict, Optional
+from ..cache import LRUCache
+
+# Raw database nodes indexed by (class name, uid)
+node_cache = LRUCache('nodes', max_size=10000, ttl=60)
 
 
 class _SerializationLevel:
@@ -89,21 +94,97 @@ class BaseElement:
         return raw_name.split('.')[-1] + level.get_suffix()
 
     def to_dict(self, level=SerializationLevel.DEFAULT):
-        result = {**self.__properties__}  # copy to avoid modifications
-        if level >= SerializationLevel.NORMAL:
-            for relationship_name, relationship in self.__all_relationships__:
-                if relationship_name in self.__do_not_marshall_relationships__:
-                    continue
-                if (level >= SerializationLevel.EXTENDED) or relationship_name in self.__non_extended_relationships__:
-                    elements = [n.to_dict(self.__relationship_serialization__.get(relationship_name, SerializationLevel.NORMAL))
-                                for n in getattr(self, relationship_name).order_by('added').all()]
-                    # print(elements)
+        return self.to_dicts([self], level)[0]
+
+    @classmethod
+    def to_dicts(cls, nodes: List['BaseElement'], level=SerializationLevel.DEFAULT) -> List[dict]:
+        """
+        Serializes a list of nodes of the same class, fetching each needed relationship for all
+        the nodes at once instead of once per node.
+        """
+        results = [{**n.__properties__} for n in nodes]  # copy to avoid modifications
+        if len(nodes) == 0 or level < SerializationLevel.NORMAL:
+            return results
+        for relationship_name, relationship in cls.__all_relationships__:
+            if relationship_name in cls.__do_not_marshall_relationships__:
+                continue
+            if (level >= SerializationLevel.EXTENDED) or relationship_name in cls.__non_extended_relationships__:
+                related_nodes, node_class = cls._get_related_nodes(nodes, relationship_name)
+                unique_related_nodes = list({n.id: n for l in related_nodes.values() for n in l}.values())
+                related_dicts = node_class.to_dicts(
+                    unique_related_nodes,
+                    cls.__relationship_serialization__.get(relationship_name, SerializationLevel.NORMAL))
+                related_dicts = {n.id: d for n, d in zip(unique_related_nodes, related_dicts)}
+                for n, result in zip(nodes, results):
+                    # shallow copies so that a node appearing twice does not share its nested dicts
+                    elements = [dict(related_dicts[e.id]) for e in related_nodes.get(n.id, [])]
                     if relationship.manager == neomodel.One or \
                                     relationship.manager == neomodel.ZeroOrOne:
                         elements = elements[0] if len(elements) > 0 else None
                     if elements is not None:
                         result[relationship_name] = elements
-        return result
+        return results
+
+    @classmethod
+    def _relationship_pattern(cls, nodes: List['BaseElement'], relationship_name: str) -> (str, type):
+        definition = getattr(nodes[0], relationship_name).definition
+        node_class = definition['node_class']
+        rel, target = '[:{}]'.format(definition['relation_type']), '(b:{})'.format(node_class.__label__)
+        if definition['direction'] == neomodel.OUTGOING:
+            pattern = '(a)-{}->{}'.format(rel, target)
+        elif definition['direction'] == neomodel.INCOMING:
+            pattern = '(a)<-{}-{}'.format(rel, target)
+        else:
+            pattern = '(a)-{}-{}'.format(rel, target)
+        return pattern, node_class
+
+    @classmethod
+    def _get_related_nodes(cls, nodes: List['BaseElement'], relationship_name: str) -> (Dict[int, list], type):
+        """Nodes of the relationship for all the given nodes in a single query, ordered by `added`"""
+        pattern, node_class = cls._relationship_pattern(nodes, relationship_name)
+        query = """MATCH (a) WHERE id(a) IN {ids}
+                   MATCH """ + pattern + """
+                   WITH a, b ORDER BY b.added
+                   RETURN id(a), COLLECT(b)"""
+        results, meta = db.cypher_query(query, {'ids': list({n.id for n in nodes})})
+        return {r[0]: [node_class.inflate(b) for b in r[1]] for r in results}, node_class
+
+    @classmethod
+    def _count_related_nodes(cls, nodes: List['BaseElement'], relationship_name: str) -> Dict[int, int]:
+        """Number of nodes in the relationship for all the given nodes in a single query"""
+        if len(nodes) == 0:
+            return dict()
+        pattern, node_class = cls._relationship_pattern(nodes, relationship_name)
+        query = """MATCH (a) WHERE id(a) IN {ids}
+                   OPTIONAL MATCH """ + pattern + """
+                   RETURN id(a), COUNT(b)"""
+        results, meta = db.cypher_query(query, {'ids': list({n.id for n in nodes})})
+        return {r[0]: r[1] for r in results}
+
+    @classmethod
+    def get_cached(cls, uid: str) -> Optional['BaseElement']:
+        """Same as `nodes.get_or_none(uid=uid)` but reads through the process-local node cache.
+        The cache holds the raw database nodes, every call returns a newly inflated instance."""
+        key = (cls.__name__, uid)
+        raw_node = node_cache.get(key)
+        if raw_node is None:
+            results, meta = db.cypher_query("MATCH (a:" + cls.__label__ + " {uid: {uid}}) RETURN a LIMIT 1",
+                                            {'uid': uid})
+            if len(results) == 0:
+                return None
+            raw_node = results[0][0]
+            node_cache.set(key, raw_node)
+        return cls.inflate(raw_node)
+
+    def invalidate_cache(self):
+        node_cache.invalidate((self.__class__.__name__, self.uid))
+
+    # neomodel hooks
+    def post_save(self):
+        self.invalidate_cache()
+
+    def post_delete(self):
+        self.invalidate_cache()
 
     @classmethod
     def get_by_id(cls, _id):
@@ -135,8 +216,19 @@ class BaseElement:
         return [unordered_results[_id] for _id in _ids]
 
     @classmethod
-    def get_elements_created_since(cls, time=datetime.today() - timedelta(1)):
-        # return cls.nodes.filter(added__gt=time.timestamp())
-        query = "MATCH (a) WHERE a.added>{timestamp} RETURN a ORDER BY a.added DESC"
-        results, meta = db.cypher_query(query, {'obj_type': cls.__name__, 'timestamp': time.timestamp()})
+    def get_elements_created_since(cls, time: datetime=None, limit: int=None, property_name='added',
+                                   after_id: int=None):
+        """
+        Elements of this class whose `property_name` timestamp is after `time` (a day ago by default), oldest first
+        then by node id, so that they can be paged by passing the timestamp and the id of the last element as `time`
+        and `after_id` (elements can share a timestamp)
+        """
+        if time is None:
+            time = datetime.today() - timedelta(1)
+        condition = "a." + property_name + ">{timestamp}"
+        if after_id is not None:
+            condition += " OR (a." + property_name + "={timestamp} AND id(a)>{after_id})"
+        query = "MATCH (a:" + cls.__label__ + ") WHERE " + condition + " " \
+                "RETURN a ORDER BY a." + property_name + ", id(a)" + (" LIMIT {limit}" if limit is not None else "")
+        results, meta = db.cypher_query(query, {'timestamp': time.timestamp(), 'after_id': after_id, 'limit': limit})
         return [cls.inflate(r[0]) for r in results]
\ No newline at end of file
@@ -0,0 +1,88 @@
+from neomodel import db
+from collections import OrderedDict
+from typing import Callable
+from .base import BaseElement, node_cache
+from .iiif import CHO, Collection, Image
+
+
+class IIIFBatchWriter:
+    """
+    Buffers parsed (unsaved) Collections, CHOs, Images and their relationships, and writes them with a few
+    `UNWIND ... MERGE` statements per batch. Nodes are matched on their unique `uri`/`iiif_url`, existing nodes
+    keep their `uid` and `added` values and the properties the importer does not set, the other ones are overwritten.
+    """
+    MERGE_KEYS = OrderedDict([(Collection, 'uri'), (CHO, 'uri'), (Image, 'iiif_url')])
+    # Properties only set on creation
+    CREATION_PROPERTIES = ['uid', 'added']
+    # Properties maintained by the server (hierarchy cache, statistics), never overwritten
+    DERIVED_PROPERTIES = ['ancestor_uids', 'nb_elements', 'nb_total_elements', 'first_connected']
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.nb_nodes_written = 0
+        self.nb_relationships_written = 0
+        self._nodes = OrderedDict((cls, []) for cls in self.MERGE_KEYS.keys())  # class -> [node row]
+        self._relationships = OrderedDict()  # (source class, type, target class) -> [(source key, target key)]
+        self._after_flush = []
+        self._nb_buffered = 0
+
+    def add_node(self, node: BaseElement):
+        # Deflating right away raises the validation errors to the caller rather than when flushing
+        properties = node.deflate(node.__properties__, node)
+        self._nodes[node.__class__].append({
+            'key': self._merge_value(node),
+            'properties': properties,
+            'update': {k: v for k, v in properties.items()
+                       if v is not None and k not in self.CREATION_PROPERTIES and k not in self.DERIVED_PROPERTIES}
+        })
+        self._buffered()
+
+    def add_relationship(self, source: BaseElement, relation_type: str, target: BaseElement):
+        key = (source.__class__, relation_type, target.__class__)
+        self._relationships.setdefault(key, []).append([self._merge_value(source), self._merge_value(target)])
+        self._buffered()
+
+    def call_after_flush(self, fn: Callable):
+        """`fn` is called once everything buffered so far has been committed"""
+        self._after_flush.append(fn)
+
+    def _merge_value(self, node: BaseElement):
+        return getattr(node, self.MERGE_KEYS[node.__class__])
+
+    def _buffered(self):
+        self._nb_buffered += 1
+        if self._nb_buffered >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        with db.transaction:
+            for cls, rows in self._nodes.items():
+                if len(rows) > 0:
+                    self._write_nodes(cls, rows)
+            for (source_cls, relation_type, target_cls), rows in self._relationships.items():
+                self._write_relationships(source_cls, relation_type, target_cls, rows)
+        for rows in self._nodes.values():
+            self.nb_nodes_written += len(rows)
+            del rows[:]
+        self.nb_relationships_written += sum(len(rows) for rows in self._relationships.values())
+        self._relationships.clear()
+        self._nb_buffered = 0
+        # Nodes were written without going through neomodel
+        node_cache.clear()
+        callbacks, self._after_flush = self._after_flush, []
+        for fn in callbacks:
+            fn()
+
+    def _write_nodes(self, cls, rows):
+        db.cypher_query("""UNWIND {rows} as row
+                           MERGE (n:""" + cls.__label__ + """ {""" + self.MERGE_KEYS[cls] + """: row.key})
+                           ON CREATE SET n = row.properties
+                           ON MATCH SET n += row.update""",
+                        dict(rows=rows))
+
+    def _write_relationships(self, source_cls, relation_type, target_cls, rows):
+        db.cypher_query("""UNWIND {rows} as row
+                           MATCH (a:""" + source_cls.__label__ + """ {""" + self.MERGE_KEYS[source_cls] + """: row[0]}),
+                                 (b:""" + target_cls.__label__ + """ {""" + self.MERGE_KEYS[target_cls] + """: row[1]})
+                           MERGE (a)-[:""" + relation_type + """]->(b)""",
+                        dict(rows=rows))
@@ -0,0 +1,109 @@
+from neomodel import db
+from threading import RLock
+from typing import List, Dict, Tuple, Hashable
+from ..cache import PeriodicValue
+
+
+def _find(parent: Dict, x: Hashable) -> Hashable:
+    # Path halving
+    while parent.get(x, x) != x:
+        parent[x] = parent.get(parent[x], parent[x])
+        x = parent[x]
+    return x
+
+
+def _union(parent: Dict, a: Hashable, b: Hashable):
+    root_a, root_b = _find(parent, a), _find(parent, b)
+    if root_a != root_b:
+        parent[root_b] = root_a
+        parent.setdefault(root_a, root_a)
+
+
+def _filter(parent: Dict, candidates: List) -> List:
+    seen_clusters = set()
+    result = []
+    for c in candidates:
+        cluster = _find(parent, c)
+        if cluster not in seen_clusters:
+            seen_clusters.add(cluster)
+            result.append(c)
+    return result
+
+
+class DuplicateIndex:
+    """
+    Connected components of the DUPLICATE links, kept in memory as union-find structures over the image uids and
+    over the CHO ids. It is built with a single scan of the duplicate links, updated when a link becomes a duplicate,
+    and rebuilt in the background when one stops being one (components can not be split) and periodically to catch
+    up with the writes of other processes. The links added while a scan runs are applied again to its result.
+    """
+    def __init__(self, refresh_interval=600):
+        self._lock = RLock()
+        self._parents = PeriodicValue('duplicate_index', self._scan, refresh_interval, lock=self._lock)
+        self._parents.on_install(self._on_install)
+        self._added = []  # type: List[Tuple[int, Tuple[str, str, int, int]]]  # (generation, pair)
+
+    def configure(self, refresh_interval=None):
+        if refresh_interval is not None:
+            self._parents.interval = refresh_interval
+
+    @staticmethod
+    def _get_duplicate_pairs(link_ids=None) -> List[Tuple[str, str, int, int]]:
+        results, _ = db.cypher_query("""
+                                        MATCH (c1:CHO)-[:IS_SHOWN_BY]->(n1:Image)<-[:LINKS]-(v:VisualLink)
+                                              -[:LINKS]->(n2:Image)<-[:IS_SHOWN_BY]-(c2:CHO)
+                                        WHERE v.type = 'DUPLICATE' and id(n1) < id(n2)
+                                        """ + ("and id(v) IN {link_ids}" if link_ids is not None else "") + """
+                                        RETURN n1.uid, n2.uid, id(c1), id(c2)
+                                        """,
+                                     dict(link_ids=link_ids))
+        return results
+
+    def _scan(self) -> Tuple[Dict[str, str], Dict[int, int]]:
+        image_parent, cho_parent = dict(), dict()
+        for uid1, uid2, cho_id1, cho_id2 in self._get_duplicate_pairs():
+            _union(image_parent, uid1, uid2)
+            _union(cho_parent, cho_id1, cho_id2)
+        return image_parent, cho_parent
+
+    def add_link(self, link_id: int):
+        """To be called after a link was committed as DUPLICATE"""
+        self.add_links([link_id])
+
+    @staticmethod
+    def _apply(parents: Tuple[Dict[str, str], Dict[int, int]], pairs: List[Tuple[str, str, int, int]]):
+        image_parent, cho_parent = parents
+        for uid1, uid2, cho_id1, cho_id2 in pairs:
+            _union(image_parent, uid1, uid2)
+            _union(cho_parent, cho_id1, cho_id2)
+
+    def _on_install(self, parents, generation: int):
+        # Pairs added before the scan started are in it, the other ones might not be
+        self._added = [(g, pair) for g, pair in self._added if g >= generation]
+        self._apply(parents, [pair for _, pair in self._added])
+
+    def add_links(self, link_ids: List[int]):
+        pairs = self._get_duplicate_pairs(link_ids)
+        with self._lock:
+            generation = self._parents.generation
+            self._added.extend((generation, pair) for pair in pairs)
+            parents = self._parents.peek()
+            if parents is not None:
+                self._apply(parents, pairs)
+
+    def remove_link(self, link_id: int):
+        """To be called after a DUPLICATE link was committed with another type"""
+        self._parents.refresh_async()
+
+    def filter_image_uids(self, image_uids: List[str]) -> List[str]:
+        """Keeps the first image of each duplicate cluster, order is preserved"""
+        with self._lock:
+            return _filter(self._parents.get()[0], image_uids)
+
+    def filter_cho_ids(self, cho_ids: List[int]) -> List[int]:
+        """Keeps the first CHO of each duplicate cluster, order is preserved"""
+        with self._lock:
+            return _filter(self._parents.get()[1], cho_ids)
+
+
+duplicate_index = DuplicateIndex()
@@ -2,17 +2,36 @@ import neomodel
 from neomodel import StructuredNode, StructuredRel, db
 from neomodel import StringProperty, DateTimeProperty, ArrayProperty, UniqueIdProperty, EmailProperty, \
     RelationshipFrom, RelationshipTo, Relationship, JSONProperty, IntegerProperty
-from typing import List, Union, Tuple, Optional
+from typing import List, Union, Tuple, Optional, Dict
 import re
 from flask_restplus import fields, Model
-from .base import BaseElement, SerializationLevel
+from .base import BaseElement, SerializationLevel, node_cache
+from .sampling import RandomSampler
 from .user import GroupContains
 
 
 class IsPartOfCollection:
     parent_collection = RelationshipFrom('Collection', 'COLL_CONTAINS', cardinality=neomodel.ZeroOrOne)
+    # Materialized path from the top collection, maintained by `Collection.rebuild_hierarchy_cache`
+    ancestor_uids = ArrayProperty(StringProperty(), help_text='Uids of the parent collections, top one first')
 
     def get_parent_collections_hierarchy(self) -> List['Collection']:
+        return self.get_parent_collections_hierarchies([self])[0]
+
+    @classmethod
+    def get_parent_collections_hierarchies(cls, nodes: List['IsPartOfCollection']) -> List[List['Collection']]:
+        """Parent collections of each node, fetched together from their materialized paths when available"""
+        all_ancestor_uids = {uid for n in nodes if n.ancestor_uids is not None for uid in n.ancestor_uids}
+        collections = dict()
+        if len(all_ancestor_uids) > 0:
+            results, _ = db.cypher_query("MATCH (c:Collection) WHERE c.uid IN {uids} RETURN c",
+                                         dict(uids=list(all_ancestor_uids)))
+            collections = {c.uid: c for c in (Collection.inflate(r[0]) for r in results)}
+        return [[collections[uid] for uid in n.ancestor_uids if uid in collections] if n.ancestor_uids is not None
+                else n._query_parent_collections_hierarchy()
+                for n in nodes]
+
+    def _query_parent_collections_hierarchy(self) -> List['Collection']:
         results, _ = self.cypher("""
         MATCH p=(c:Collection)-[:COLL_CONTAINS*]->(n1) WHERE id(n1)={self}
         WITH COLLECT(p) as paths, MAX(LENGTH(p)) as max_length
@@ -25,6 +44,13 @@ class IsPartOfCollection:
             colls = results[0].nodes[:-1]
         return [Collection.inflate(n) for n in colls]
 
+    @staticmethod
+    def _parent_collections_hierarchies_dicts(nodes: List['IsPartOfCollection']) -> List[List[dict]]:
+        hierarchies = IsPartOfCollection.get_parent_collections_hierarchies(nodes)
+        unique_collections = list({c.id: c for h in hierarchies for c in h}.values())
+        collection_dicts = {c.id: d for c, d in zip(unique_collections, Collection.to_dicts(unique_collections))}
+        return [[dict(collection_dicts[c.id]) for c in h] for h in hierarchies]
+
 
 class IIIFMetadata:
     # IIIF data
@@ -100,12 +126,17 @@ class IIIFMetadata:
 
 
 class Collection(StructuredNode, IsPartOfCollection, BaseElement, IIIFMetadata):
+    __do_not_marshall_properties__ = ['ancestor_uids']
     __do_not_marshall_relationships__ = ['elements']
 
     children_collections = RelationshipTo('Collection', 'COLL_CONTAINS')
 
     elements = RelationshipTo('CHO', 'COLL_CONTAINS')
 
+    # Denormalized counts, maintained by `rebuild_hierarchy_cache`
+    nb_elements = IntegerProperty(help_text='Number of elements in the collection')
+    nb_total_elements = IntegerProperty(help_text='Number of elements in the collection and its sub-collections')
+
     @classmethod
     def _get_schema(cls, api, level=SerializationLevel.DEFAULT):
         schema = super()._get_schema(api, level)
@@ -115,18 +146,24 @@ class Collection(StructuredNode, IsPartOfCollection, BaseElement, IIIFMetadata):
         return schema
 
     def get_total_number_of_elements(self):
+        if self.nb_total_elements is not None:
+            return self.nb_total_elements
         # Might be a bit slow... :(
         results, _ = self.cypher("""
         MATCH (c:Collection)-[:COLL_CONTAINS*]->(n1:CHO) WHERE id(c)={self}
         RETURN COUNT(n1)""")
         return results[0][0]
 
-    def to_dict(self, level=SerializationLevel.DEFAULT):
-        result = super().to_dict(level)
-        result['nb_elements'] = len(self.elements)
+    @classmethod
+    def to_dicts(cls, nodes: List['Collection'], level=SerializationLevel.DEFAULT) -> List[dict]:
+        results = super().to_dicts(nodes, level)
+        nb_elements = cls._count_related_nodes([n for n in nodes if n.nb_elements is None], 'elements')
+        for n, result in zip(nodes, results):
+            result['nb_elements'] = n.nb_elements if n.nb_elements is not None else nb_elements.get(n.id, 0)
         if level >= SerializationLevel.EXTENDED:
-            result['parent_collection_hierarchy'] = [d.to_dict() for d in self.get_parent_collections_hierarchy()]
-        return result
+            for result, hierarchy in zip(results, cls._parent_collections_hierarchies_dicts(nodes)):
+                result['parent_collection_hierarchy'] = hierarchy
+        return results
 
     @classmethod
     def get_top_collections(cls) -> List['Collection']:
@@ -140,10 +177,71 @@ class Collection(StructuredNode, IsPartOfCollection, BaseElement, IIIFMetadata):
         self.cypher("""
         match (c:Collection)-[:COLL_CONTAINS|IS_SHOWN_BY*..3]->(n) where id(c)={self} optional match (n)-[r]-()
         delete c, r, n""")
+        # Paths of the remaining elements did not change, only the counts of the parents need an update
+        Collection.rebuild_hierarchy_cache(element_collection_uris=[])
+        # Children are deleted without going through neomodel
+        node_cache.clear()
+
+    @classmethod
+    def rebuild_hierarchy_cache(cls, element_collection_uris: List[str]=None):
+        """
+        Recomputes the denormalized `nb_elements`, `nb_total_elements` and `ancestor_uids` of all the collections,
+        and the `ancestor_uids` of the elements of the collections in `element_collection_uris` (all if None).
+        """
+        results, _ = db.cypher_query("""
+        MATCH (c:Collection)
+        OPTIONAL MATCH (p:Collection)-[:COLL_CONTAINS]->(c)
+        OPTIONAL MATCH (c)-[:COLL_CONTAINS]->(e:CHO)
+        RETURN c.uid, c.uri, p.uid, COUNT(e)""")
+        parents = {uid: parent_uid for uid, _, parent_uid, _ in results}
+        nb_elements = {uid: nb for uid, _, _, nb in results}
+
+        ancestors = dict()
+
+        def _get_ancestors(uid):
+            if uid not in ancestors:
+                parent_uid = parents.get(uid)
+                ancestors[uid] = [] if parent_uid is None else _get_ancestors(parent_uid) + [parent_uid]
+            return ancestors[uid]
+
+        nb_total_elements = dict(nb_elements)
+        for uid in parents.keys():
+            for ancestor_uid in _get_ancestors(uid):
+                nb_total_elements[ancestor_uid] += nb_elements[uid]
+
+        db.cypher_query("""
+        UNWIND {rows} as row
+        MATCH (c:Collection {uid: row.uid})
+        SET c.ancestor_uids = row.ancestor_uids, c.nb_elements = row.nb_elements,
+            c.nb_total_elements = row.nb_total_elements""",
+                        dict(rows=[{'uid': uid,
+                                    'ancestor_uids': _get_ancestors(uid),
+                                    'nb_elements': nb_elements[uid],
+                                    'nb_total_elements': nb_total_elements[uid]} for uid in parents.keys()]))
+
+        if element_collection_uris is not None:
+            element_collection_uris = set(element_collection_uris)
+        # One statement per collection to keep the transactions bounded
+        for uid, uri, _, nb in results:
+            if nb > 0 and (element_collection_uris is None or uri in element_collection_uris):
+                db.cypher_query("""
+                MATCH (c:Collection {uid: {uid}})-[:COLL_CONTAINS]->(e:CHO)
+                SET e.ancestor_uids = {ancestor_uids}""",
+                                dict(uid=uid, ancestor_uids=_get_ancestors(uid) + [uid]))
+        # Ends every import and deletion, read by the servers to invalidate what depends on the elements
+        db.cypher_query("MERGE (w:ImportWatermark) SET w.time = timestamp()")
+        node_cache.clear()
+
+    @staticmethod
+    def get_last_import() -> Optional[int]:
+        """Time (ms) of the last `rebuild_hierarchy_cache`, None if it never ran"""
+        results, _ = db.cypher_query("MATCH (w:ImportWatermark) RETURN max(w.time)")
+        return results[0][0]
 
 
 class CHO(StructuredNode, IsPartOfCollection, BaseElement, IIIFMetadata):
     """Rough Equivalent of the Manifest element in IIIF Presentation API"""
+    __do_not_marshall_properties__ = ['ancestor_uids']
     # __do_not_marshall_relationships__ = ['images']
     __non_extended_relationships__ = ['images']
     __relationship_serialization__ = {'images': SerializationLevel.BASE}
@@ -213,22 +311,24 @@ class CHO(StructuredNode, IsPartOfCollection, BaseElement, IIIFMetadata):
                                                                 required=True)
         return schema
 
-    def to_dict(self, level=SerializationLevel.DEFAULT):
-        result = super().to_dict(level)
+    @classmethod
+    def to_dicts(cls, nodes: List['CHO'], level=SerializationLevel.DEFAULT) -> List[dict]:
+        results = super().to_dicts(nodes, level)
         if level >= SerializationLevel.EXTENDED:
-            result['parent_collection_hierarchy'] = [d.to_dict() for d in self.get_parent_collections_hierarchy()]
-        return result
+            for result, hierarchy in zip(results, cls._parent_collections_hierarchies_dicts(nodes)):
+                result['parent_collection_hierarchy'] = hierarchy
+        return results
 
     @classmethod
     def get_random(cls, limit=10) -> List['CHO']:
-        results, _ = db.cypher_query('''MATCH (a:CHO)
-                                        RETURN a, rand() as r
-                                        ORDER BY r LIMIT {limit}''',
-                                     dict(limit=limit))
-        return [CHO.inflate(r[0]) for r in results]
+        return _random_chos.sample(CHO, limit)
+
+
+_random_chos = RandomSampler('CHO')
 
 
 class Image(StructuredNode, BaseElement):
+    __do_not_marshall_properties__ = ['first_connected']
     __do_not_marshall_relationships__ = ['links', 'groups']
     __non_extended_relationships__ = ['cho']
     __relationship_serialization__ = {'cho': SerializationLevel.BASE}
@@ -237,6 +337,8 @@ class Image(StructuredNode, BaseElement):
     iiif_url = StringProperty(required=True, unique_index=True, help_text='IIIF Url of the Resource')
     width = IntegerProperty(required=True)
     height = IntegerProperty(required=True)
+    # Annotation time of its first POSITIVE link, set once by `update_daily_statistics`
+    first_connected = DateTimeProperty()
 
     # Additional info
     # provider = StringProperty()
@@ -254,10 +356,56 @@ class Image(StructuredNode, BaseElement):
         schema = super()._get_schema(api, level)
         if level >= SerializationLevel.EXTENDED:
             schema['links'] = fields.List(fields.Nested(api.models['Link_from_source']), required=True)
+            schema['nb_links'] = fields.Integer(description='Number of links matching the link filters', required=True)
         return schema
 
-    def to_dict(self, level=SerializationLevel.DEFAULT):
-        result = super().to_dict(level)
+    @classmethod
+    def to_dicts(cls, nodes: List['Image'], level=SerializationLevel.DEFAULT,
+                 link_types: List[str]=None, links_offset=0, links_limit: int=None) -> List[dict]:
+        """
+        :param link_types: at the EXTENDED level, only the links of these types are serialized
+        :param links_offset: at the EXTENDED level, number of links skipped (links are sorted by creation date)
+        :param links_limit: at the EXTENDED level, maximum number of links serialized per image
+        """
+        results = super().to_dicts(nodes, level)
         if level >= SerializationLevel.EXTENDED:
-            result['links'] = [l.dict_from_source(self) for l in self.links]
-        return result
+            links = cls._get_links_dicts(nodes, link_types, links_offset, links_limit)
+            for n, result in zip(nodes, results):
+                result['nb_links'], result['links'] = links.get(n.id, (0, []))
+        return results
+
+    @classmethod
+    def _get_links_dicts(cls, nodes: List['Image'], link_types: List[str]=None, offset=0,
+                         limit: int=None) -> Dict[int, Tuple[int, List[dict]]]:
+        """
+        Number of links and serialized links (with the opposite image and its CHO under `image`) of each image,
+        in a single query
+        """
+        from .link import VisualLink
+        if len(nodes) == 0:
+            return dict()
+        results, _ = db.cypher_query('''MATCH (i:Image) WHERE id(i) IN {ids}
+                                        MATCH (i)<-[:LINKS]-(l:VisualLink)-[:LINKS]->(t:Image)
+                                        WHERE {link_types} IS NULL OR l.type IN {link_types}
+                                        WITH i, l, t ORDER BY l.added
+                                        WITH i, collect([l, t]) as links
+                                        WITH i, size(links) as nb_links, links[{start}..{end}] as links
+                                        UNWIND (CASE WHEN size(links) = 0 THEN [null] ELSE links END) as link
+                                        WITH i, nb_links, link[0] as l, link[1] as t
+                                        OPTIONAL MATCH (c:CHO)-[:IS_SHOWN_BY]->(t)
+                                        RETURN id(i), nb_links, l, t, c''',
+                                     dict(ids=[n.id for n in nodes], link_types=link_types, start=offset,
+                                          end=offset + limit if limit is not None else 2 ** 62))
+        links = {r[0]: (r[1], []) for r in results}
+        # Images with no link in the requested page have a single row without link
+        rows = [r for r in results if r[2] is not None]
+        link_dicts = VisualLink.to_dicts([VisualLink.inflate(r[2]) for r in rows], SerializationLevel.NORMAL)
+        image_dicts = Image.to_dicts([Image.inflate(r[3]) for r in rows], SerializationLevel.BASE)
+        chos = {r[4].id: CHO.inflate(r[4]) for r in rows if r[4] is not None}
+        cho_dicts = dict(zip(chos.keys(), CHO.to_dicts(list(chos.values()), SerializationLevel.BASE)))
+        for r, link_dict, image_dict in zip(rows, link_dicts, image_dicts):
+            if r[4] is not None:
+                image_dict['cho'] = dict(cho_dicts[r[4].id])
+            link_dict['image'] = image_dict
+            links[r[0]][1].append(link_dict)
+        return links
@@ -5,9 +5,13 @@ from neomodel import StringProperty, DateTimeProperty, ArrayProperty, UniqueIdPr
 from typing import List, Union, Tuple, Optional
 import pytz
 from datetime import datetime, timedelta
-from .base import BaseElement
+from .base import BaseElement, node_cache
 from .iiif import CHO, Collection, Image
 from .user import User, Group, GroupContains
+from .duplicates import duplicate_index
+from .sampling import RandomSampler
+from .proposal_queue import proposal_queue
+from .link_graph import link_graph, personal_link_graphs
 
 
 class LinkImageRel(StructuredRel):
@@ -23,7 +27,13 @@ class LinkImageRel(StructuredRel):
         self.box_w = kwargs['box_w']
 
 
+def _pair_key(img1_uid: str, img2_uid: str, *extra: str) -> str:
+    return '|'.join(sorted([img1_uid, img2_uid]) + list(extra))
+
+
 class VisualLink(StructuredNode, BaseElement):
+    __do_not_marshall_properties__ = ['pair_key']
+
     class Type:
         PROPOSAL = 'PROPOSAL'
         DUPLICATE = 'DUPLICATE'
@@ -51,10 +61,13 @@ class VisualLink(StructuredNode, BaseElement):
     spatial_spread = FloatProperty()
 
     images = RelationshipTo('.iiif.Image', 'LINKS', model=LinkImageRel)
+    # Sorted uids of the two images, enforces a single link per pair
+    pair_key = StringProperty(unique_index=True)
 
     def annotate(self, user: 'User', link_type: 'Type'):
         if link_type not in VisualLink.Type.VALID_TYPES:
             raise ValueError('Type is invalid : {}'.format(link_type))
+        previous_type = self.type
         with db.transaction:
             self.annotated = datetime.utcnow().replace(tzinfo=pytz.utc)
             self.type = link_type
@@ -63,8 +76,16 @@ class VisualLink(StructuredNode, BaseElement):
             if old_annotator:
                 self.annotator.disconnect(old_annotator)
             self.annotator.connect(user)
+        if previous_type == VisualLink.Type.PROPOSAL:
+            _random_proposals.discard(self.id)
+            proposal_queue.complete(self.id)
+        link_graph.set_type(self.id, self.type)
+        # Again after the commit, another request might have cached the old version in between
+        self.invalidate_cache()
+        self._update_duplicate_index(previous_type)
 
     def remove_annotation(self, user=None):
+        previous_type = self.type
         with db.transaction:
             old_annotator = self.annotator.single()
             if old_annotator and ((user is not None) or user == old_annotator):
@@ -72,6 +93,18 @@ class VisualLink(StructuredNode, BaseElement):
                 self.type = VisualLink.Type.PROPOSAL
                 self.save()
                 self.annotator.disconnect(old_annotator)
+        if self.type == VisualLink.Type.PROPOSAL and previous_type != VisualLink.Type.PROPOSAL:
+            _random_proposals.add(self.id)
+            proposal_queue.push(self.id, self.prediction_score, self.spatial_spread)
+        link_graph.set_type(self.id, self.type)
+        self.invalidate_cache()
+        self._update_duplicate_index(previous_type)
+
+    def _update_duplicate_index(self, previous_type: str):
+        if self.type == VisualLink.Type.DUPLICATE and previous_type != VisualLink.Type.DUPLICATE:
+            duplicate_index.add_link(self.id)
+        elif self.type != VisualLink.Type.DUPLICATE and previous_type == VisualLink.Type.DUPLICATE:
+            duplicate_index.remove_link(self.id)
 
     def plot(self):
         from IPython.core.display import display, HTML
@@ -89,16 +122,13 @@ class VisualLink(StructuredNode, BaseElement):
         """.format(self.uid, self.type, self.creator.get().username, self.annotator.get_or_none(), *(img.iiif_url for img in self.images))
         display(HTML(html_code))
 
+    @staticmethod
+    def pair_key_of(img1_uid: str, img2_uid: str) -> str:
+        return _pair_key(img1_uid, img2_uid)
+
     @classmethod
     def get_from_images(cls, img1_uid: str, img2_uid: str, user=None) -> Union[None, 'VisualLink']:
-        results, _ = db.cypher_query('''MATCH (i2:Image)<-[:LINKS]-(l:'''+str(cls.__name__)+''')-[:LINKS]->(i1:Image)
-                                        WHERE i1.uid={img1} and i2.uid={img2}
-                                        RETURN l''',
-                                     dict(img1=img1_uid, img2=img2_uid))
-        if len(results) > 0:
-            return cls.inflate(results[0][0])
-        else:
-            return None
+        return cls.nodes.get_or_none(pair_key=cls.pair_key_of(img1_uid, img2_uid))
 
     @classmethod
     def create_proposal(cls, img1: Image, img2: Image, user: 'User', exist_ok=True):
@@ -110,56 +140,221 @@ class VisualLink(StructuredNode, BaseElement):
             raise ValueError('Can not connect two images of the same element')
 
         link = cls.get_from_images(img1.uid, img2.uid, user)
-        if link is not None:
-            if exist_ok:
-                return link
+        if link is None:
+            try:
+                with db.transaction:
+                    link = cls(pair_key=cls.pair_key_of(img1.uid, img2.uid))
+                    link.save()
+                    link.images.connect(img1)
+                    link.images.connect(img2)
+                    link.creator.connect(user)
+            except neomodel.UniqueProperty:
+                # Created concurrently
+                link = cls.get_from_images(img1.uid, img2.uid, user)
             else:
-                raise ValueError('Images are already linked')
-        with db.transaction:
-            link = cls()
-            link.save()
-            link.images.connect(img1)
-            link.images.connect(img2)
-            link.creator.connect(user)
-        return link
+                _random_proposals.add(link.id)
+                proposal_queue.push(link.id)
+                link_graph.add_link(img1.uid, img2.uid, link.id, link.type)
+                img1.invalidate_cache()
+                img2.invalidate_cache()
+                return link
+        if exist_ok:
+            return link
+        else:
+            raise ValueError('Images are already linked')
 
     @classmethod
     def get_random_proposals(cls, limit=10) -> List['VisualLink']:
-        results, _ = db.cypher_query('''MATCH (a:VisualLink) where a.type={link_type}
-                                        RETURN a, rand() as r
-                                        ORDER BY r LIMIT {limit}''',
-                                     dict(link_type=VisualLink.Type.PROPOSAL, limit=limit))
-        return [VisualLink.inflate(r[0]) for r in results]
-
-    def dict_from_source(self, image_source: Image):
-        d = self.to_dict()
-        images = self.images.all()
-        if images[0] == image_source:
-            target_image = images[1]
-        else:
-            target_image = images[0]
-        d['image'] = target_image.to_dict()
-        return d
+        return _random_proposals.sample(VisualLink, limit)
+
+    @classmethod
+    def checkout_proposals(cls, user: 'User', limit=10, lease_duration=None) -> List['VisualLink']:
+        """Leases the first proposals of the annotation queue to the user"""
+        links = []
+        while len(links) < limit:
+            ids = proposal_queue.checkout(user.uid, limit - len(links), lease_duration)
+            if len(ids) == 0:
+                break
+            results, _ = db.cypher_query('''MATCH (a:VisualLink) WHERE id(a) IN {ids} and a.type={link_type}
+                                            RETURN a''',
+                                         dict(ids=ids, link_type=VisualLink.Type.PROPOSAL))
+            found = {n.id: n for n in (VisualLink.inflate(r[0]) for r in results)}
+            for link_id in ids:
+                if link_id in found:
+                    links.append(found[link_id])
+                else:
+                    # Annotated by another process since the last scan
+                    proposal_queue.discard(link_id)
+        return links
+
+    BULK_CHUNK_SIZE = 1000
+
+    @classmethod
+    def create_bulk(cls, records: List[dict], user: 'User', annotate=False) -> List[dict]:
+        """
+        Bulk version of `create_proposal` (followed by `annotate` if `annotate`). Records have `img1_uid`, `img2_uid`,
+        optional `img1_box`/`img2_box` ({x, y, w, h}), and `type` if `annotate` else optional
+        `prediction_score`/`spatial_spread`. Each chunk is validated with two queries and written in one transaction,
+        which is validated and written again record by record if another request linked one of the pairs in between.
+        :return: one `{'uid', 'status', 'error'}` per record, status being 'created', 'annotated', 'exists' or 'error'
+        """
+        results = []
+        for i in range(0, len(records), cls.BULK_CHUNK_SIZE):
+            chunk = records[i:i + cls.BULK_CHUNK_SIZE]
+            try:
+                results.extend(cls._create_bulk_chunk(chunk, user, annotate))
+            except neomodel.UniqueProperty:
+                # Some pairs were linked concurrently, validate the records again one by one
+                for record in chunk:
+                    try:
+                        results.extend(cls._create_bulk_chunk([record], user, annotate))
+                    except neomodel.UniqueProperty:
+                        results.append({'uid': None, 'status': 'error',
+                                        'error': 'Link was created concurrently, try again'})
+        return results
+
+    @staticmethod
+    def _box_properties(box: Optional[dict]) -> dict:
+        if box is None:
+            return dict()
+        return {'box_' + k: float(box[k]) for k in ['x', 'y', 'h', 'w']}
+
+    @classmethod
+    def _create_bulk_chunk(cls, records: List[dict], user: 'User', annotate: bool) -> List[dict]:
+        image_uids = list({r.get(k) for r in records for k in ['img1_uid', 'img2_uid'] if isinstance(r.get(k), str)})
+        rows, _ = db.cypher_query('''UNWIND {uids} as uid
+                                     MATCH (i:Image {uid: uid})
+                                     OPTIONAL MATCH (c:CHO)-[:IS_SHOWN_BY]->(i)
+                                     RETURN uid, id(c)''',
+                                  dict(uids=image_uids))
+        image_chos = {r[0]: r[1] for r in rows}
+        pair_keys = list({cls.pair_key_of(r['img1_uid'], r['img2_uid']) for r in records
+                          if r.get('img1_uid') in image_chos and r.get('img2_uid') in image_chos})
+        rows, _ = db.cypher_query('''UNWIND {keys} as key
+                                     MATCH (l:VisualLink {pair_key: key})
+                                     RETURN key, l.uid, l.type''',
+                                  dict(keys=pair_keys))
+        existing = {r[0]: (r[1], r[2]) for r in rows}
+
+        results, to_create, to_annotate = [], [], []
+        annotated_property = cls.defined_properties()['annotated']
+        for record in records:
+            # Per record, so that fewer links share the same `annotated` value
+            annotated = datetime.utcnow().replace(tzinfo=pytz.utc)
+            result = {'uid': None, 'status': 'error', 'error': None}
+            results.append(result)
+            img1_uid, img2_uid = record.get('img1_uid'), record.get('img2_uid')
+            if img1_uid not in image_chos or img2_uid not in image_chos:
+                result['error'] = 'Some img do not exist'
+                continue
+            if img1_uid == img2_uid:
+                result['error'] = 'The two images are the same'
+                continue
+            if image_chos[img1_uid] == image_chos[img2_uid]:
+                result['error'] = 'Can not connect two images of the same element'
+                continue
+            if annotate and record.get('type') not in VisualLink.Type.VALID_TYPES:
+                result['error'] = 'Type is invalid : {}'.format(record.get('type'))
+                continue
+            pair = cls.pair_key_of(img1_uid, img2_uid)
+            if pair not in existing:
+                try:
+                    link = cls(pair_key=pair,
+                               type=record['type'] if annotate else VisualLink.Type.PROPOSAL,
+                               annotated=annotated if annotate else None,
+                               prediction_score=record.get('prediction_score'),
+                               spatial_spread=record.get('spatial_spread'))
+                    to_create.append({'properties': link.deflate(link.__properties__, link),
+                                      'img1': img1_uid, 'img2': img2_uid,
+                                      'box1': cls._box_properties(record.get('img1_box')),
+                                      'box2': cls._box_properties(record.get('img2_box'))})
+                except (KeyError, TypeError, ValueError) as e:
+                    result['error'] = 'Invalid record : {}'.format(e)
+                    continue
+                existing[pair] = (link.uid, link.type)
+                result.update(uid=link.uid, status='created')
+                continue
+            uid, link_type = existing[pair]
+            result['uid'] = uid
+            if not annotate:
+                result['status'] = 'exists'
+            elif link_type == VisualLink.Type.PROPOSAL:
+                existing[pair] = (uid, record['type'])
+                to_annotate.append({'uid': uid, 'type': record['type'],
+                                    'annotated': annotated_property.deflate(annotated)})
+                result['status'] = 'annotated'
+            else:
+                result['error'] = 'Link already exists uid:{}, type:{}'.format(uid, link_type)
+
+        created, newly_annotated = [], dict()
+        with db.transaction:
+            if len(to_create) > 0:
+                created, _ = db.cypher_query('''UNWIND {rows} as row
+                                                MATCH (i1:Image {uid: row.img1}), (i2:Image {uid: row.img2}),
+                                                      (u:User {uid: {user_uid}})
+                                                CREATE (l:VisualLink)-[r1:LINKS]->(i1), (l)-[r2:LINKS]->(i2),
+                                                       (l)-[:CREATED_BY]->(u)
+                                                SET l = row.properties, r1 = row.box1, r2 = row.box2
+                                                FOREACH (_ IN CASE WHEN {annotate} THEN [1] ELSE [] END |
+                                                         CREATE (l)-[:ANNOTATED_BY]->(u))
+                                                RETURN id(l), l.type, l.prediction_score, l.spatial_spread,
+                                                       row.img1, row.img2''',
+                                             dict(rows=to_create, user_uid=user.uid, annotate=annotate))
+            if len(to_annotate) > 0:
+                rows, _ = db.cypher_query('''UNWIND {rows} as row
+                                             MATCH (l:VisualLink {uid: row.uid}), (u:User {uid: {user_uid}})
+                                             WHERE l.type = {proposal}
+                                             SET l.type = row.type, l.annotated = row.annotated
+                                             CREATE (l)-[:ANNOTATED_BY]->(u)
+                                             RETURN l.uid, id(l), l.type''',
+                                          dict(rows=to_annotate, user_uid=user.uid, proposal=VisualLink.Type.PROPOSAL))
+                newly_annotated = {r[0]: (r[1], r[2]) for r in rows}
+        for result in results:
+            if result['status'] == 'annotated' and result['uid'] not in newly_annotated:
+                result.update(status='error', error='Link was annotated in the meantime')
+
+        # Keep the in-memory indexes up to date
+        for link_id, link_type, prediction_score, spatial_spread, img1_uid, img2_uid in created:
+            if link_type == VisualLink.Type.PROPOSAL:
+                _random_proposals.add(link_id)
+                proposal_queue.push(link_id, prediction_score, spatial_spread)
+            link_graph.add_link(img1_uid, img2_uid, link_id, link_type)
+        for link_id, link_type in newly_annotated.values():
+            _random_proposals.discard(link_id)
+            proposal_queue.complete(link_id)
+            link_graph.set_type(link_id, link_type)
+        duplicate_ids = [r[0] for r in created if r[1] == VisualLink.Type.DUPLICATE] + \
+                        [link_id for link_id, link_type in newly_annotated.values()
+                         if link_type == VisualLink.Type.DUPLICATE]
+        if len(duplicate_ids) > 0:
+            duplicate_index.add_links(duplicate_ids)
+        for uid in image_uids:
+            node_cache.invalidate((Image.__name__, uid))
+        return results
+
+
+_random_proposals = RandomSampler('VisualLink', "WHERE a.type = '" + VisualLink.Type.PROPOSAL + "'")
 
 
 class PersonalLink(StructuredNode, BaseElement):
+    __do_not_marshall_properties__ = ['pair_key']
+
     # User that proposed or created the link
     creator = RelationshipTo('.user.User', 'CREATED_BY', cardinality=neomodel.One)
 
     type = StringProperty(default='PERSONAL')
 
     images = RelationshipTo('.iiif.Image', 'LINKS')
+    # Sorted uids of the two images followed by the uid of the creator, enforces a single link per pair and user
+    pair_key = StringProperty(unique_index=True)
+
+    @staticmethod
+    def pair_key_of(img1_uid: str, img2_uid: str, user_uid: str) -> str:
+        return _pair_key(img1_uid, img2_uid, user_uid)
 
     @classmethod
-    def get_from_images(cls, img1_uid: str, img2_uid: str, user) -> Union[None, 'VisualLink']:
-        results, _ = db.cypher_query('''MATCH (i2:Image)<-[:LINKS]-(l:'''+str(cls.__name__)+''')-[:LINKS]->(i1:Image), (user:User)<-[CREATED_BY]-(l)
-                                        WHERE i1.uid={img1} and i2.uid={img2} and user.uid={user_uid}
-                                        RETURN l''',
-                                     dict(img1=img1_uid, img2=img2_uid, user_uid=user.uid))
-        if len(results) > 0:
-            return cls.inflate(results[0][0])
-        else:
-            return None
+    def get_from_images(cls, img1_uid: str, img2_uid: str, user) -> Union[None, 'PersonalLink']:
+        return cls.nodes.get_or_none(pair_key=cls.pair_key_of(img1_uid, img2_uid, user.uid))
 
     @classmethod
     def create_link(cls, img1: Image, img2: Image, user: 'User') -> 'PersonalLink':
@@ -174,12 +369,17 @@ class PersonalLink(StructuredNode, BaseElement):
         if link is not None:
             return link
             #raise ValueError('Images are already linked')
-        with db.transaction:
-            link = cls()
-            link.save()
-            link.images.connect(img1)
-            link.images.connect(img2)
-            link.creator.connect(user)
+        try:
+            with db.transaction:
+                link = cls(pair_key=cls.pair_key_of(img1.uid, img2.uid, user.uid))
+                link.save()
+                link.images.connect(img1)
+                link.images.connect(img2)
+                link.creator.connect(user)
+        except neomodel.UniqueProperty:
+            # Created concurrently
+            return cls.get_from_images(img1.uid, img2.uid, user)
+        personal_link_graphs.add_link(user.uid, img1.uid, img2.uid, link.id)
         return link
 
 
@@ -227,6 +427,7 @@ class TripletComparison(StructuredNode, BaseElement):
             comparison.candidates.connect(candidate1)
             comparison.candidates.connect(candidate2)
             comparison.creator.connect(user)
+        _random_triplets.add(comparison.id)
         return comparison
 
     def annotate(self, user: 'User', positive_img: Image, negative_img: Image):
@@ -243,11 +444,11 @@ class TripletComparison(StructuredNode, BaseElement):
             self.annotator.connect(user)
             self.positive.connect(positive_img)
             self.negative.connect(negative_img)
+        _random_triplets.discard(self.id)
 
     @classmethod
     def get_random_proposals(cls, limit=10) -> List['TripletComparison']:
-        results, _ = db.cypher_query('''MATCH (a:TripletComparison) where a.annotated=null
-                                        RETURN a, rand() as r
-                                        ORDER BY r LIMIT {limit}''',
-                                     dict(limit=limit))
-        return [TripletComparison.inflate(r[0]) for r in results]
\ No newline at end of file
+        return _random_triplets.sample(TripletComparison, limit)
+
+
+_random_triplets = RandomSampler('TripletComparison', 'WHERE a.annotated IS NULL')
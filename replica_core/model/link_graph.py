@@ -0,0 +1,244 @@
+from neomodel import db
+import numpy as np
+from collections import OrderedDict
+from threading import RLock
+from typing import List, Dict, Tuple, Optional, Iterator, Callable, Iterable, Hashable
+from ..cache import PeriodicValue, LRUCache
+
+
+def _expand(frontier: List[Hashable], links: Callable[[Hashable], Iterable[Tuple[Hashable, int]]], depth: int,
+            max_nodes_per_hop: int=None) -> List[Hashable]:
+    """Breadth-first expansion, `links(node)` giving the (opposite node, link id) of the links of a node"""
+    visited = OrderedDict.fromkeys(frontier)
+    for _ in range(depth):
+        next_frontier = []
+        for i in frontier:
+            for j, _ in links(i):
+                if j not in visited:
+                    visited[j] = None
+                    next_frontier.append(j)
+                    if max_nodes_per_hop is not None and len(next_frontier) >= max_nodes_per_hop:
+                        break
+            if max_nodes_per_hop is not None and len(next_frontier) >= max_nodes_per_hop:
+                break
+        frontier = next_frontier
+        if len(frontier) == 0:
+            break
+    return list(visited.keys())
+
+
+class _CSRGraph:
+    """
+    Undirected image graph of the VisualLinks, images having compact integer ids (their position in `uids`)
+    and the links of image `i` being at positions `indptr[i]:indptr[i+1]` of `indices` (opposite images),
+    `link_ids` (ids of the VisualLink nodes) and `types` (index in `type_names`, changed in place by `set_type`).
+    """
+    def __init__(self, rows: List[Tuple[str, str, int, str]]):
+        self.uids = []  # type: List[str]
+        self.uid_index = dict()  # type: Dict[str, int]
+        self.type_names = []  # type: List[str]
+        self.type_codes = dict()  # type: Dict[str, int]
+        sources, targets, link_ids, types = [], [], [], []
+        for uid1, uid2, link_id, link_type in rows:
+            sources.append(self.index(uid1))
+            targets.append(self.index(uid2))
+            link_ids.append(link_id)
+            types.append(self.type_code(link_type))
+        nb_csr_nodes = len(self.uids)
+        # Both directions
+        sources, targets = np.array(sources + targets, dtype=np.int32), np.array(targets + sources, dtype=np.int32)
+        order = np.argsort(sources, kind='mergesort')
+        self.indices = targets[order]
+        self.link_ids = np.array(link_ids + link_ids, dtype=np.int64)[order]
+        self.types = np.array(types + types, dtype=np.uint8)[order]
+        self._link_order = np.argsort(self.link_ids, kind='mergesort')
+        self.indptr = np.zeros(nb_csr_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=nb_csr_nodes), out=self.indptr[1:])
+
+    def index(self, uid: str) -> int:
+        """Integer id of the image, a new one is given to unknown images"""
+        i = self.uid_index.get(uid)
+        if i is None:
+            i = self.uid_index[uid] = len(self.uids)
+            self.uids.append(uid)
+        return i
+
+    def type_code(self, link_type: str) -> int:
+        code = self.type_codes.get(link_type)
+        if code is None:
+            code = self.type_codes[link_type] = len(self.type_names)
+            self.type_names.append(link_type)
+        return code
+
+    def set_type(self, link_id: int, code: int):
+        """Changes the type of the two entries of the link, if it is in the arrays"""
+        start = np.searchsorted(self.link_ids, link_id, sorter=self._link_order)
+        positions = self._link_order[start:start + 2]
+        self.types[positions[self.link_ids[positions] == link_id]] = code
+
+
+class LinkGraph:
+    """
+    In-memory adjacency index of the images connected by VisualLinks, serving k-hop neighborhoods without querying
+    the database. It is loaded with a single scan of the links into CSR arrays, links created or annotated
+    afterwards are kept in small overlays, and it is rebuilt every `refresh_interval` seconds to catch up with the
+    writes of other processes. The overlays recorded while a scan runs are applied again to its result.
+    """
+    def __init__(self, refresh_interval=3600):
+        self._lock = RLock()
+        self._graph = PeriodicValue('link_graph', self._scan, refresh_interval, lock=self._lock)
+        self._graph.on_install(self._on_install)
+        # Recorded changes, with the generation of the graph scan at that time
+        self._added = []  # type: List[Tuple[int, str, str, int, str]]  # (generation, uid1, uid2, link id, type)
+        self._types = dict()  # type: Dict[int, Tuple[int, str]]  # link id -> (generation, type)
+        # Changes applied to the current graph
+        self._extra_links = dict()  # type: Dict[int, List[Tuple[int, int, int]]]  # image -> [(image, link id, type)]
+        self._link_types = dict()  # type: Dict[int, int]  # link id -> type code, overrides the extra links
+
+    def configure(self, refresh_interval=None):
+        if refresh_interval is not None:
+            self._graph.interval = refresh_interval
+
+    def load(self):
+        self._graph.get()
+
+    @staticmethod
+    def _scan() -> _CSRGraph:
+        results, _ = db.cypher_query("""MATCH (i1:Image)<-[:LINKS]-(v:VisualLink)-[:LINKS]->(i2:Image)
+                                        WHERE id(i1) < id(i2)
+                                        RETURN i1.uid, i2.uid, id(v), v.type""")
+        return _CSRGraph(results)
+
+    def _on_install(self, graph: _CSRGraph, generation: int):
+        # Changes recorded before the scan started are in it, the other ones might not be
+        self._added = [a for a in self._added if a[0] >= generation]
+        self._types = {link_id: t for link_id, t in self._types.items() if t[0] >= generation}
+        self._extra_links, self._link_types = dict(), dict()
+        scanned = np.isin([a[3] for a in self._added], graph.link_ids)
+        for (_, img1_uid, img2_uid, link_id, link_type), in_scan in zip(self._added, scanned.tolist()):
+            if not in_scan:
+                self._add_extra_link(graph, img1_uid, img2_uid, link_id, link_type)
+        for link_id, (_, link_type) in self._types.items():
+            self._set_type(graph, link_id, link_type)
+
+    def _add_extra_link(self, graph: _CSRGraph, img1_uid: str, img2_uid: str, link_id: int, link_type: str):
+        i1, i2, code = graph.index(img1_uid), graph.index(img2_uid), graph.type_code(link_type)
+        self._extra_links.setdefault(i1, []).append((i2, link_id, code))
+        self._extra_links.setdefault(i2, []).append((i1, link_id, code))
+
+    def add_link(self, img1_uid: str, img2_uid: str, link_id: int, link_type: str):
+        """To be called after a VisualLink was committed"""
+        with self._lock:
+            self._added.append((self._graph.generation, img1_uid, img2_uid, link_id, link_type))
+            graph = self._graph.peek()
+            if graph is not None:
+                self._add_extra_link(graph, img1_uid, img2_uid, link_id, link_type)
+
+    def set_type(self, link_id: int, link_type: str):
+        """To be called after the type of a VisualLink was changed"""
+        with self._lock:
+            self._types[link_id] = (self._graph.generation, link_type)
+            graph = self._graph.peek()
+            if graph is not None:
+                self._set_type(graph, link_id, link_type)
+
+    def _set_type(self, graph: _CSRGraph, link_id: int, link_type: str):
+        code = graph.type_code(link_type)
+        graph.set_type(link_id, code)
+        self._link_types[link_id] = code
+
+    def _links(self, graph: _CSRGraph, i: int, type_codes: Optional[set]) -> Iterator[Tuple[int, int]]:
+        """(opposite image, link id) of the links of image `i` of the given types"""
+        if i + 1 < len(graph.indptr):
+            start, end = graph.indptr[i], graph.indptr[i + 1]
+            neighbors, link_ids = graph.indices[start:end], graph.link_ids[start:end]
+            if type_codes is not None:
+                mask = np.isin(graph.types[start:end], list(type_codes))
+                neighbors, link_ids = neighbors[mask], link_ids[mask]
+            yield from zip(neighbors.tolist(), link_ids.tolist())
+        for j, link_id, code in self._extra_links.get(i, []):
+            if type_codes is None or self._link_types.get(link_id, code) in type_codes:
+                yield j, link_id
+
+    def neighborhood(self, image_uids: List[str], depth=3, max_nodes_per_hop: int=None,
+                     link_types: List[str]=None) -> Tuple[List[str], List[Tuple[str, str, int]]]:
+        """
+        Breadth-first expansion of `depth` hops from the given images
+        :param max_nodes_per_hop: maximum number of new images added at each hop
+        :param link_types: only the links of these types are followed and returned
+        :return: uids of the images (the given ones first, then by hop) and (uid1, uid2, link id) of the links
+                 between them
+        """
+        with self._lock:
+            graph = self._graph.get()
+            type_codes = {graph.type_codes[t] for t in link_types if t in graph.type_codes} \
+                if link_types is not None else None
+            uids = list(OrderedDict.fromkeys(image_uids))
+            visited = _expand([graph.uid_index[uid] for uid in uids if uid in graph.uid_index],
+                              lambda i: self._links(graph, i, type_codes), depth, max_nodes_per_hop)
+            visited_ids = set(visited)
+            requested = set(uids)
+            uids.extend(graph.uids[i] for i in visited if graph.uids[i] not in requested)
+            links = []
+            for i in sorted(visited_ids):
+                for j, link_id in self._links(graph, i, type_codes):
+                    if i < j and j in visited_ids:
+                        links.append((graph.uids[i], graph.uids[j], link_id))
+            return uids, links
+
+
+class PersonalLinkGraphs:
+    """
+    Adjacency of the PersonalLinks of each user, loaded with a single query on first access, updated when the
+    user creates links, and kept for the `max_users` most recent users (for `ttl` seconds to catch up with the
+    writes of other processes).
+    """
+    def __init__(self, max_users=100, ttl=3600):
+        self._lock = RLock()
+        self._graphs = LRUCache('personal_link_graphs', max_size=max_users, ttl=ttl)
+
+    def configure(self, max_users=None, ttl=None):
+        self._graphs.configure(max_size=max_users, ttl=ttl)
+
+    @staticmethod
+    def _load(user_uid: str) -> Dict[str, List[Tuple[str, int]]]:
+        results, _ = db.cypher_query("""MATCH (:User {uid: {user_uid}})<-[:CREATED_BY]-(v:PersonalLink),
+                                              (i1:Image)<-[:LINKS]-(v)-[:LINKS]->(i2:Image)
+                                        WHERE id(i1) < id(i2)
+                                        RETURN i1.uid, i2.uid, id(v)""",
+                                     dict(user_uid=user_uid))
+        adjacency = dict()
+        for uid1, uid2, link_id in results:
+            adjacency.setdefault(uid1, []).append((uid2, link_id))
+            adjacency.setdefault(uid2, []).append((uid1, link_id))
+        return adjacency
+
+    def _get(self, user_uid: str) -> Dict[str, List[Tuple[str, int]]]:
+        adjacency = self._graphs.get(user_uid)
+        if adjacency is None:
+            adjacency = self._load(user_uid)
+            self._graphs.set(user_uid, adjacency)
+        return adjacency
+
+    def add_link(self, user_uid: str, img1_uid: str, img2_uid: str, link_id: int):
+        """To be called after a PersonalLink was committed"""
+        with self._lock:
+            adjacency = self._graphs.get(user_uid)
+            if adjacency is not None:
+                adjacency.setdefault(img1_uid, []).append((img2_uid, link_id))
+                adjacency.setdefault(img2_uid, []).append((img1_uid, link_id))
+
+    def neighborhood(self, user_uid: str, image_uids: List[str],
+                     depth=3) -> Tuple[List[str], List[Tuple[str, str, int]]]:
+        """Same as `LinkGraph.neighborhood` for the personal links of the user"""
+        with self._lock:
+            adjacency = self._get(user_uid)
+            uids = _expand(image_uids, lambda uid: adjacency.get(uid, []), depth)
+            visited = set(uids)
+            links = [(uid1, uid2, link_id) for uid1 in uids for uid2, link_id in adjacency.get(uid1, [])
+                     if uid1 < uid2 and uid2 in visited]
+            return uids, links
+
+
+link_graph = LinkGraph()
+personal_link_graphs = PersonalLinkGraphs()
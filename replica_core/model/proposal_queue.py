@@ -0,0 +1,160 @@
+from neomodel import db
+import heapq
+import time
+import numpy as np
+from threading import RLock
+from typing import List, Tuple, Optional
+from prometheus_client import Gauge, Histogram
+from ..cache import PeriodicValue
+
+QUEUE_DEPTH = Gauge('replica_proposal_queue_depth', 'Number of proposals waiting to be checked out')
+QUEUE_LEASED = Gauge('replica_proposal_queue_leased', 'Number of proposals currently leased to an annotator')
+CHECKOUT_LATENCY = Histogram('replica_proposal_checkout_latency_seconds', 'Latency of a proposal checkout')
+ANNOTATION_LATENCY = Histogram('replica_proposal_annotation_latency_seconds',
+                               'Time between the checkout of a proposal and its annotation',
+                               buckets=(5, 10, 20, 30, 60, 120, 300, 600, 1800, 3600, float('inf')))
+
+
+def _priority(link_id: int, prediction_score: Optional[float], spatial_spread: Optional[float]) -> Tuple:
+    # Smallest first, proposals without a score come last
+    return (-prediction_score if prediction_score is not None else float('inf'),
+            -spatial_spread if spatial_spread is not None else float('inf'),
+            link_id)
+
+
+class _QueueState:
+    """Pending proposals sorted by priority, consumed with a cursor"""
+    def __init__(self, priorities: np.ndarray):
+        self.priorities = priorities  # (n, 3) array, rows sorted by priority
+        self.cursor = 0
+
+    def peek(self) -> Optional[Tuple]:
+        if self.cursor < len(self.priorities):
+            score, spread, link_id = self.priorities[self.cursor].tolist()
+            return score, spread, int(link_id)
+        return None
+
+    def __len__(self):
+        return len(self.priorities) - self.cursor
+
+
+class ProposalQueue:
+    """
+    Annotation work queue of the PROPOSAL VisualLinks, by decreasing `prediction_score` then `spatial_spread`.
+    The pending proposals are loaded with a single scan into a sorted array (refreshed every `refresh_interval`
+    seconds to catch up with the writes of other processes), proposals created or released afterwards go into a
+    heap. Checked out proposals are leased to the annotator for `lease_duration` seconds (at most
+    `max_lease_duration`) and are not served to anyone else in the meantime, expired leases go back into the queue.
+    The proposals pushed or completed while a scan runs are applied again to its result.
+    """
+    def __init__(self, lease_duration=600, max_lease_duration=3600, refresh_interval=3600):
+        self.lease_duration = lease_duration
+        self.max_lease_duration = max_lease_duration
+        self._lock = RLock()
+        self._state = PeriodicValue('proposal_queue', self._scan, refresh_interval, lock=self._lock)
+        self._state.on_install(self._on_install)
+        self._pushed = []  # heap of priorities
+        self._pushed_generations = dict()  # link id -> generation at the time of the last push
+        self._leases = dict()  # link id -> (priority, user uid, expiry, checkout time)
+        self._lease_expiries = []  # heap of (expiry, link id), might contain renewed or completed leases
+        self._done = dict()  # link id -> generation, for the ids completed since the last scan
+        QUEUE_DEPTH.set_function(self.depth)
+        QUEUE_LEASED.set_function(lambda: len(self._leases))
+
+    def configure(self, lease_duration=None, max_lease_duration=None, refresh_interval=None):
+        if lease_duration is not None:
+            self.lease_duration = lease_duration
+        if max_lease_duration is not None:
+            self.max_lease_duration = max_lease_duration
+        if refresh_interval is not None:
+            self._state.interval = refresh_interval
+
+    @staticmethod
+    def _scan() -> _QueueState:
+        results, _ = db.cypher_query("""MATCH (a:VisualLink) WHERE a.type = 'PROPOSAL'
+                                        RETURN id(a), a.prediction_score, a.spatial_spread""")
+        priorities = np.array([_priority(*r) for r in results], dtype=np.float64).reshape(-1, 3)
+        order = np.lexsort((priorities[:, 2], priorities[:, 1], priorities[:, 0]))
+        return _QueueState(priorities[order])
+
+    def _on_install(self, state: _QueueState, generation: int):
+        # Changes recorded before the scan started are in it, the other ones might not be
+        self._pushed = [p for p in self._pushed if self._pushed_generations.get(p[2], -1) >= generation]
+        heapq.heapify(self._pushed)
+        self._pushed_generations = {link_id: g for link_id, g in self._pushed_generations.items()
+                                    if g >= generation}
+        self._done = {link_id: g for link_id, g in self._done.items() if g >= generation}
+
+    def depth(self) -> int:
+        """Number of proposals waiting, does not load the queue"""
+        state = self._state.peek()
+        return (len(state) if state is not None else 0) + len(self._pushed)
+
+    def _push(self, priority: Tuple):
+        self._pushed_generations[priority[2]] = self._state.generation
+        heapq.heappush(self._pushed, priority)
+
+    def _expire_leases(self, now: float):
+        while len(self._lease_expiries) > 0 and self._lease_expiries[0][0] <= now:
+            expiry, link_id = heapq.heappop(self._lease_expiries)
+            lease = self._leases.get(link_id)
+            if lease is not None and lease[2] == expiry:
+                del self._leases[link_id]
+                self._push(lease[0])
+
+    def _pop(self) -> Optional[Tuple]:
+        state = self._state.get()
+        next_scanned = state.peek()
+        if len(self._pushed) > 0 and (next_scanned is None or self._pushed[0] < next_scanned):
+            return heapq.heappop(self._pushed)
+        if next_scanned is not None:
+            state.cursor += 1
+        return next_scanned
+
+    def checkout(self, user_uid: str, nb_proposals: int, lease_duration=None) -> List[int]:
+        """Leases the `nb_proposals` first available proposals to the user, returns their ids"""
+        lease_duration = min(lease_duration or self.lease_duration, self.max_lease_duration)
+        with CHECKOUT_LATENCY.time(), self._lock:
+            now = time.monotonic()
+            self._expire_leases(now)
+            result = []
+            while len(result) < nb_proposals:
+                priority = self._pop()
+                if priority is None:
+                    break
+                link_id = priority[2]
+                if link_id in self._leases or link_id in self._done:
+                    continue
+                self._leases[link_id] = (priority, user_uid, now + lease_duration, now)
+                heapq.heappush(self._lease_expiries, (now + lease_duration, link_id))
+                result.append(link_id)
+            return result
+
+    def release(self, link_id: int, user_uid: str=None):
+        """Puts a leased proposal back into the queue (only if leased by `user_uid` when given)"""
+        with self._lock:
+            lease = self._leases.get(link_id)
+            if lease is not None and (user_uid is None or lease[1] == user_uid):
+                del self._leases[link_id]
+                self._push(lease[0])
+
+    def push(self, link_id: int, prediction_score: float=None, spatial_spread: float=None):
+        """To be called when a link becomes a proposal"""
+        with self._lock:
+            self._done.pop(link_id, None)
+            self._push(_priority(link_id, prediction_score, spatial_spread))
+
+    def complete(self, link_id: int):
+        """To be called when a proposal was annotated"""
+        lease = self.discard(link_id)
+        if lease is not None:
+            ANNOTATION_LATENCY.observe(time.monotonic() - lease[3])
+
+    def discard(self, link_id: int):
+        """The link is not a proposal anymore, returns its lease if any"""
+        with self._lock:
+            self._done[link_id] = self._state.generation
+            return self._leases.pop(link_id, None)
+
+
+proposal_queue = ProposalQueue()
@@ -0,0 +1,133 @@
+from neomodel import db
+import numpy as np
+import traceback
+from threading import Lock, Thread
+from typing import List, Dict, Tuple
+
+
+class RandomSampler:
+    """
+    Serves random nodes in O(k) from a pre-shuffled pool of candidate ids, instead of sorting every candidate
+    by `rand()` on each request.
+    The pool is filled by a single scan of the candidate ids and refilled in the background once mostly consumed,
+    requests finding it exhausted before the refill completes wait for a new pool.
+    An id is served only once per pool, so concurrent requests do not get the same nodes. Ids added afterwards
+    (e.g. new proposals) are served along with the pool, discarded ids (e.g. proposals which were annotated) are
+    skipped, and both are applied again to a pool whose scan might have missed them.
+    """
+    REFILL_THRESHOLD = 0.8
+
+    def __init__(self, label: str, condition: str=''):
+        """
+        :param label: label of the sampled nodes, bound to `a` in the queries
+        :param condition: optional Cypher WHERE clause the sampled nodes must fulfill
+        """
+        self.label = label
+        self.condition = condition
+        self._pool = np.empty(0, dtype=np.int64)
+        self._cursor = 0
+        self._generation = 0  # Number of scans started
+        self._added = []  # type: List[Tuple[int, int]]  # (generation, id)
+        self._discarded = dict()  # type: Dict[int, int]  # id -> generation
+        self._lock = Lock()
+        self._refill_lock = Lock()  # Held during the scans, so that a single one runs at a time
+        self._refilling = False
+        self._filled = False
+
+    def _scan(self) -> Tuple[np.ndarray, int]:
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+        results, _ = db.cypher_query("MATCH (a:{}) {} RETURN id(a)".format(self.label, self.condition))
+        ids = np.array([r[0] for r in results], dtype=np.int64)
+        np.random.shuffle(ids)
+        return ids, generation
+
+    def _set_pool(self, ids: np.ndarray, generation: int):
+        with self._lock:
+            self._pool, self._cursor = ids, 0
+            # Changes recorded before the scan started are in it, the other ones might not be
+            self._added = [(g, _id) for g, _id in self._added if g >= generation]
+            self._discarded = {_id: g for _id, g in self._discarded.items() if g >= generation}
+            self._filled, self._refilling = True, False
+
+    def _refill(self, pool: np.ndarray):
+        """Replaces the pool, unless `pool` was already replaced in the meantime"""
+        with self._refill_lock:
+            if self._pool is pool:
+                self._set_pool(*self._scan())
+
+    def _background_refill(self, pool: np.ndarray):
+        try:
+            self._refill(pool)
+        except Exception:
+            traceback.print_exc()
+            with self._lock:
+                self._refilling = False
+
+    def _nb_from_added(self, k: int) -> int:
+        """Number of ids to take from the added ones, as if they had been shuffled into the rest of the pool"""
+        nb_added, nb_remaining = len(self._added), max(len(self._pool) - self._cursor, 0)
+        if nb_added == 0 or nb_remaining == 0:
+            return min(k, nb_added)
+        return int(np.random.hypergeometric(nb_added, nb_remaining, min(k, nb_added + nb_remaining)))
+
+    def _take_added(self, k: int, result: List[int], seen: set):
+        while len(result) < k and len(self._added) > 0:
+            j = np.random.randint(len(self._added))
+            self._added[j], self._added[-1] = self._added[-1], self._added[j]
+            _, _id = self._added.pop()
+            if _id not in self._discarded and _id not in seen:
+                seen.add(_id)
+                result.append(_id)
+
+    def _take_pool(self, k: int, result: List[int], seen: set):
+        while len(result) < k and self._cursor < len(self._pool):
+            chunk = self._pool[self._cursor:self._cursor + k - len(result)]
+            self._cursor += len(chunk)
+            for _id in chunk.tolist():
+                if _id not in self._discarded and _id not in seen:
+                    seen.add(_id)
+                    result.append(_id)
+
+    def sample_ids(self, k: int) -> List[int]:
+        if not self._filled:
+            self._refill(self._pool)
+        with self._lock:
+            result, seen = [], set()
+            self._take_added(self._nb_from_added(k), result, seen)
+            self._take_pool(k, result, seen)
+            self._take_added(k, result, seen)
+            pool = self._pool
+            exhausted = len(result) < k and self._cursor >= len(pool)
+            if not exhausted and not self._refilling and self._cursor >= self.REFILL_THRESHOLD * len(pool):
+                self._refilling = True
+                Thread(target=self._background_refill, args=(pool,), daemon=True).start()
+        if exhausted:
+            # Never served again from the start, two requests would get the same ids
+            self._refill(pool)
+            with self._lock:
+                self._take_pool(k, result, seen)
+                self._take_added(k, result, seen)
+        return result
+
+    def add(self, node_id: int):
+        """The node became a candidate"""
+        with self._lock:
+            self._discarded.pop(node_id, None)
+            self._added.append((self._generation, node_id))
+
+    def discard(self, node_id: int):
+        """The node is not a candidate anymore"""
+        with self._lock:
+            self._discarded[node_id] = self._generation
+
+    def sample(self, node_class, k: int) -> List:
+        """Up to `k` random nodes, the candidates are checked again against the condition when fetched"""
+        ids = self.sample_ids(k)
+        if len(ids) == 0:
+            return []
+        results, _ = db.cypher_query("MATCH (a:{}) {} id(a) IN {{ids}} RETURN a".format(
+            self.label, self.condition + ' AND' if self.condition else 'WHERE'), dict(ids=ids))
+        nodes = {n.id: n for n in (node_class.inflate(r[0]) for r in results)}
+        return [nodes[_id] for _id in ids if _id in nodes]
@@ -0,0 +1,103 @@
+from neomodel import StructuredNode, db
+from neomodel import StringProperty, DateProperty, DateTimeProperty, JSONProperty, IntegerProperty
+from collections import Counter, defaultdict
+from datetime import datetime, date
+from typing import List, Dict
+import pytz
+from .link import VisualLink
+
+
+class DailyStatistics(StructuredNode):
+    """Counts of the events of a day (UTC), maintained incrementally by `update_daily_statistics`"""
+    date = DateProperty(required=True, unique_index=True)
+    # nb_links (created that day), nb_<type>_links (created that day, type at processing time),
+    # nb_<type>_annotations, nb_new_images (images in a POSITIVE link for the first time, as in the plot)
+    counts = JSONProperty(default=dict)
+    # username -> number of annotations
+    annotations_per_user = JSONProperty(default=dict)
+
+    @classmethod
+    def get_range(cls, start=None, end=None) -> List['DailyStatistics']:
+        """Statistics of the days between the `start` and `end` dates included, by date"""
+        query = "MATCH (s:DailyStatistics) WHERE ({start} IS NULL OR s.date >= {start}) " \
+                "AND ({end} IS NULL OR s.date <= {end}) RETURN s ORDER BY s.date"
+        results, _ = db.cypher_query(query, dict(start=start.isoformat() if start else None,
+                                                 end=end.isoformat() if end else None))
+        return [cls.inflate(r[0]) for r in results]
+
+
+class StatisticsWatermark(StructuredNode):
+    """Timestamp and node id up to which the elements were processed by `update_daily_statistics`"""
+    name = StringProperty(required=True, unique_index=True)
+    value = DateTimeProperty(required=True)
+    last_id = IntegerProperty()
+
+    @classmethod
+    def get_or_default(cls, name: str) -> 'StatisticsWatermark':
+        watermark = cls.nodes.get_or_none(name=name)
+        if watermark is None:
+            watermark = cls(name=name, value=datetime.fromtimestamp(0, pytz.utc))
+        return watermark
+
+
+def _save_days(days: Dict[date, tuple], watermark: StatisticsWatermark):
+    """Adds the counts to the stored ones and moves the watermark, to be called in a transaction"""
+    for day, (counts, annotations_per_user) in days.items():
+        statistics = DailyStatistics.nodes.get_or_none(date=day) or DailyStatistics(date=day)
+        statistics.counts = dict(Counter(statistics.counts) + counts)
+        statistics.annotations_per_user = dict(Counter(statistics.annotations_per_user) + annotations_per_user)
+        statistics.save()
+    watermark.save()
+
+
+def _new_days() -> Dict[date, tuple]:
+    return defaultdict(lambda: (Counter(), Counter()))
+
+
+def update_daily_statistics(page_size=10000):
+    """
+    Aggregates the links created and annotated since the last run into the DailyStatistics nodes, by pages of
+    `page_size` links
+    """
+    watermark = StatisticsWatermark.get_or_default('links_added')
+    while True:
+        links = VisualLink.get_elements_created_since(watermark.value, limit=page_size, after_id=watermark.last_id)
+        if len(links) == 0:
+            break
+        days = _new_days()
+        for link in links:
+            counts, _ = days[link.added.date()]
+            counts['nb_links'] += 1
+            counts['nb_{}_links'.format(link.type)] += 1
+        watermark.value, watermark.last_id = links[-1].added, links[-1].id
+        with db.transaction:
+            _save_days(days, watermark)
+
+    watermark = StatisticsWatermark.get_or_default('links_annotated')
+    while True:
+        links = VisualLink.get_elements_created_since(watermark.value, limit=page_size, property_name='annotated',
+                                                      after_id=watermark.last_id)
+        if len(links) == 0:
+            break
+        results, _ = db.cypher_query("""MATCH (l:VisualLink)-[:ANNOTATED_BY]->(u:User) WHERE id(l) IN {ids}
+                                        RETURN id(l), u.username""", dict(ids=[l.id for l in links]))
+        annotators = dict(results)
+        days = _new_days()
+        for link in links:
+            counts, annotations_per_user = days[link.annotated.date()]
+            counts['nb_{}_annotations'.format(link.type)] += 1
+            if link.id in annotators:
+                annotations_per_user[annotators[link.id]] += 1
+        watermark.value, watermark.last_id = links[-1].annotated, links[-1].id
+        with db.transaction:
+            # Links are processed by annotation time, so the images met for the first time are connected for the
+            # first time. The mark is kept when their links are annotated again.
+            results, _ = db.cypher_query("""MATCH (l:VisualLink)-[:LINKS]->(i:Image)
+                                            WHERE id(l) IN {ids} AND l.type = {type} AND NOT exists(i.first_connected)
+                                            WITH i, min(l.annotated) as first_connected
+                                            SET i.first_connected = first_connected
+                                            RETURN first_connected""",
+                                         dict(ids=[l.id for l in links], type=VisualLink.Type.POSITIVE))
+            for first_connected, in results:
+                days[datetime.fromtimestamp(first_connected, pytz.utc).date()][0]['nb_new_images'] += 1
+            _save_days(days, watermark)
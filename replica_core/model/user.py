@@ -51,10 +51,13 @@ class Group(StructuredNode, BaseElement):
         schema['nb_images'] = fields.Integer(required=True, description='Number of images in the group')
         return schema
 
-    def to_dict(self, level=SerializationLevel.DEFAULT):
-        result = super().to_dict(level)
-        result['nb_images'] = len(self.images)
-        return result
+    @classmethod
+    def to_dicts(cls, nodes: List['Group'], level=SerializationLevel.DEFAULT) -> List[dict]:
+        results = super().to_dicts(nodes, level)
+        nb_images = cls._count_related_nodes(nodes, 'images')
+        for n, result in zip(nodes, results):
+            result['nb_images'] = nb_images.get(n.id, 0)
+        return results
 
     def add_images(self, images: List['Image']):
         already_added_uids = {img.uid for img in self.images.all()}
@@ -75,6 +78,7 @@ class Group(StructuredNode, BaseElement):
                 self.images.connect(image)
         for image in previous_images.values():
             self.images.disconnect(image)
+        self.invalidate_cache()
 
     @classmethod
     def create_group(cls, user: User, label: str, images: List['Image']):
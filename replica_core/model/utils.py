@@ -1,64 +1,69 @@
 import neomodel
 from neomodel import StructuredNode, StructuredRel, db
-from typing import List, Union, Tuple, Optional
+from typing import List, Union, Tuple, Optional, Dict
 from .iiif import Image
 from .link import VisualLink, PersonalLink, CHO
 from .user import User
+from .duplicates import duplicate_index
+from .link_graph import link_graph, personal_link_graphs
 import networkx as nx
 from collections import defaultdict
 
 
-def get_subgraph(image_uids: List[str], graph_depth=3) -> (List[Image], List[Tuple[str, str, VisualLink]]):
-    results, _ = db.cypher_query("""
-                                    MATCH (n:Image) where n.uid IN {image_uids}
-                                    WITH DISTINCT(n) as n_previous
-                                    """ +
-                                 """MATCH (n_previous:Image)<-[]-(:VisualLink)-[]->(n:Image)
-                                    WITH DISTINCT(n) as n_previous
-                                    """ * graph_depth +
-                                 """WITH COLLECT(n_previous) as nodes
-                                    MATCH (n1:Image)<-[]-(v:VisualLink)-[]->(n2:Image) where n1 in nodes and n2 in nodes and id(n1)<id(n2)
-                                    return nodes, collect([n1.uid, n2.uid, v]) as links
-                                    """,
-                                 dict(image_uids=image_uids))
+def resolve_subgraph(link_class: type, image_uids: List[str], link_rows: List[Tuple[str, str, int]]):
+    """Images and links of a subgraph with one query each"""
+    results, _ = db.cypher_query("MATCH (a:Image) WHERE a.uid IN {uids} RETURN a", dict(uids=image_uids))
+    images = {img.uid: img for img in (Image.inflate(r[0]) for r in results)}
+    results, _ = db.cypher_query("MATCH (v:" + link_class.__label__ + ") WHERE id(v) IN {ids} RETURN v",
+                                 dict(ids=[link_id for _, _, link_id in link_rows]))
+    links = {v.id: v for v in (link_class.inflate(r[0]) for r in results)}
 
-    if len(results) > 0:
-        nodes_data, links_data = results[0]
-    else:
-        nodes_data, links_data = [], []
-    nodes, links = [Image.inflate(d) for d in nodes_data], [(uid1, uid2, VisualLink.inflate(d)) for uid1, uid2, d in links_data]
+    nodes = [images[uid] for uid in image_uids if uid in images]
+    return nodes, [(uid1, uid2, links[link_id]) for uid1, uid2, link_id in link_rows if link_id in links]
 
-    missing_image_uids = set(image_uids).difference([img.uid for img in nodes])
-    nodes += Image.get_by_uids(missing_image_uids)
 
-    return nodes, links
+def get_subgraph(image_uids: List[str], graph_depth=3, max_nodes_per_hop: int=None,
+                 link_types: List[str]=None) -> (List[Image], List[Tuple[str, str, VisualLink]]):
+    """
+    Images within `graph_depth` links of the given ones and the links between them, expanded with the in-memory
+    link graph (see `LinkGraph.neighborhood` for the parameters)
+    """
+    image_uids, link_rows = link_graph.neighborhood(image_uids, graph_depth, max_nodes_per_hop, link_types)
+    return resolve_subgraph(VisualLink, image_uids, link_rows)
 
 
-def get_subgraph_personal(image_uids: List[str], user: User, graph_depth=3) -> (List[Image], List[Tuple[str, str, VisualLink]]):
-    results, _ = db.cypher_query("""
-                                    MATCH (n:Image) where n.uid IN {image_uids}
-                                    WITH DISTINCT(n) as n_previous
-                                    """ +
-                                 """MATCH (n_previous:Image)<-[]-(v:PersonalLink)-[]->(n:Image), (user:User)<-[CREATED_BY]-(v) where user.uid={user_uid}
-                                    WITH DISTINCT(n) as n_previous
-                                    """ * graph_depth +
-                                 """WITH COLLECT(n_previous) as nodes
-                                    MATCH (n1:Image)<-[]-(v:PersonalLink)-[]->(n2:Image), (user:User)<-[CREATED_BY]-(v)
-                                    where n1 in nodes and n2 in nodes and id(n1)<id(n2) and user.uid={user_uid}
-                                    return nodes, collect([n1.uid, n2.uid, v]) as links
-                                    """,
-                                 dict(image_uids=image_uids, user_uid=user.uid))
+def get_subgraph_personal(image_uids: List[str], user: User,
+                          graph_depth=3) -> (List[Image], List[Tuple[str, str, PersonalLink]]):
+    """Same as `get_subgraph` with the personal links of the user"""
+    image_uids, link_rows = personal_link_graphs.neighborhood(user.uid, image_uids, graph_depth)
+    return resolve_subgraph(PersonalLink, image_uids, link_rows)
 
-    if len(results) > 0:
-        nodes_data, links_data = results[0]
-    else:
-        nodes_data, links_data = [], []
-    nodes, links = [Image.inflate(d) for d in nodes_data], [(uid1, uid2, PersonalLink.inflate(d)) for uid1, uid2, d in links_data]
 
-    missing_image_uids = set(image_uids).difference([img.uid for img in nodes])
-    nodes += [Image.nodes.get(uid=uid) for uid in missing_image_uids]
-
-    return nodes, links
+def get_database_counts() -> Dict[str, int]:
+    """All the counts of the statistics page in one round trip, the label counts are read from the count store"""
+    results, _ = db.cypher_query("""
+                                    MATCH (n:Collection) RETURN 'nb_collections' as key, COUNT(n) as value
+                                    UNION ALL
+                                    MATCH (n:Collection) WHERE NOT (n)<-[:COLL_CONTAINS]-()
+                                    RETURN 'nb_top_collections' as key, COUNT(n) as value
+                                    UNION ALL
+                                    MATCH (n:CHO) RETURN 'nb_elements' as key, COUNT(n) as value
+                                    UNION ALL
+                                    MATCH (n:Image) RETURN 'nb_images' as key, COUNT(n) as value
+                                    UNION ALL
+                                    MATCH (n:User) RETURN 'nb_users' as key, COUNT(n) as value
+                                    UNION ALL
+                                    MATCH (n:VisualLink) RETURN 'nb_links' as key, COUNT(n) as value
+                                    UNION ALL
+                                    MATCH (n:VisualLink) RETURN 'nb_' + n.type + '_links' as key, COUNT(n) as value
+                                    UNION ALL
+                                    MATCH (n:TripletComparison) WHERE n.annotated IS NOT NULL
+                                    RETURN 'nb_annotated_triplets' as key, COUNT(n) as value
+                                    UNION ALL
+                                    MATCH (n:TripletComparison) WHERE n.annotated IS NULL
+                                    RETURN 'nb_proposal_triplets' as key, COUNT(n) as value
+                                    """)
+    return {key: value for key, value in results}
 
 
 def _filter_duplicates(candidates, edges) -> List:
@@ -93,25 +98,11 @@ def filter_duplicates_cho_uids(cho_uids: List[str]) -> List[str]:
 
 
 def filter_duplicates_image_uids(image_uids: List[str]) -> List[str]:
-    results, _ = db.cypher_query("""
-                                    MATCH (n1:Image)<-[]-(v:VisualLink)-[]->(n2:Image)
-                                    where n1.uid IN {image_uids} and n2.uid IN {image_uids} and id(n1) < id(n2)
-                                    and v.type = 'DUPLICATE'
-                                    return n1.uid, n2.uid
-                                    """,
-                                 dict(image_uids=image_uids))
-    return _filter_duplicates(image_uids, results)
+    return duplicate_index.filter_image_uids(image_uids)
 
 
-def filter_duplicates_cho_ids(cho_ids: List[str]) -> List[str]:
-    results, _ = db.cypher_query("""
-                                    MATCH (c1:CHO)-[]->(n1:Image)<-[]-(v:VisualLink)-[]->(n2:Image)<-[]-(c2:CHO)
-                                    where id(c1) IN {cho_ids} and id(c2) IN {cho_ids} and id(c1) < id(c2)
-                                    and v.type = 'DUPLICATE'
-                                    return id(c1), id(c2)
-                                    """,
-                                 dict(cho_ids=cho_ids))
-    return _filter_duplicates(cho_ids, results)
+def filter_duplicates_cho_ids(cho_ids: List[int]) -> List[int]:
+    return duplicate_index.filter_cho_ids(cho_ids)
 
 
 def filter_duplicates_cho(chos: List[CHO]) -> List[CHO]:
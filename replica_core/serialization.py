@@ -0,0 +1,137 @@
+import json
+from functools import wraps
+from flask import request, current_app, Response
+from flask_restplus import fields, marshal
+from werkzeug.wrappers import BaseResponse
+from typing import Callable
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# Fields whose output for a non-None value is `<conversion>(value)`, subclasses (Date...) are not included
+_CONVERSIONS = {fields.String: 'str', fields.Integer: 'int', fields.Float: 'float', fields.Boolean: 'bool'}
+
+
+def dumps(data) -> str:
+    """JSON encoding with ujson if available"""
+    if ujson is not None:
+        return ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+class _Compiler:
+    """
+    Generates one function per model giving the same output as `marshal(data, model)` for dict data (with plain
+    dicts instead of OrderedDicts) : the values are read and converted inline instead of going through the
+    `output` of each field. Anything else (None values, other data types, custom fields, attributes, masks) is
+    left to the field or to `marshal`.
+    """
+    def __init__(self):
+        self._namespace = {'marshal': marshal}
+        self._functions = dict()  # id(model) -> name of the function
+
+    def _add(self, prefix: str, value) -> str:
+        name = '{}{}'.format(prefix, len(self._namespace))
+        self._namespace[name] = value
+        return name
+
+    def compile(self, model) -> Callable:
+        return self._namespace[self._function(model)]
+
+    def _function(self, model) -> str:
+        name = self._functions.get(id(model))
+        if name is not None:
+            return name
+        model_name = self._add('_model', model)
+        name = self._functions[id(model)] = '_marshal_{}'.format(model_name)
+        resolved = getattr(model, 'resolved', model)
+        lines = ['def {}(obj):'.format(name),
+                 '    if type(obj) is list:',
+                 '        return [{}(d) for d in obj]'.format(name),
+                 '    if type(obj) is not dict:',
+                 '        return marshal(obj, {})'.format(model_name),
+                 '    out = {}']
+        if getattr(model, '__mask__', None):
+            lines.insert(1, '    return marshal(obj, {})'.format(model_name))
+        for key, field in resolved.items():
+            lines.extend('    ' + l for l in self._field_lines(key, field))
+        lines.append('    return out')
+        # Registered before being executed so that recursive models work
+        exec('\n'.join(lines), self._namespace)
+        return name
+
+    def _field_lines(self, key: str, field):
+        if isinstance(field, dict):
+            return ['out[{!r}] = {}(obj)'.format(key, self._function(field))]
+        if isinstance(field, type):
+            field = field()
+        f = self._add('_field', field)
+        generic = 'out[{!r}] = {}.output({!r}, obj)'.format(key, f, key)
+        if field.attribute is not None or '.' in key or hasattr(dict, key) or getattr(field, 'mask', None):
+            return [generic]
+        value = self._value(field, f)
+        if value is None:
+            return [generic]
+        return ['v = obj.get({!r})'.format(key),
+                'if v is None:',
+                '    ' + generic,
+                'else:',
+                '    out[{!r}] = {}'.format(key, value.format(key=key))]
+
+    def _value(self, field, f: str):
+        """Expression of the output for a non-None value `v`, None if the field has to be used"""
+        field_type = type(field)
+        if field_type in _CONVERSIONS and not getattr(field, 'discriminator', False):
+            return '{}(v)'.format(_CONVERSIONS[field_type])
+        if field_type is fields.Raw:
+            return 'v'
+        if field_type is fields.Nested:
+            return '{}(v)'.format(self._function(field.nested))
+        if field_type is fields.List:
+            container = field.container
+            if type(container) is fields.Nested and container.attribute is None and not container.mask:
+                element = '{}(e) if e is not None else {}.container.output(0, (e,))'.format(
+                    self._function(container.nested), f)
+                return '[' + element + ' for e in v] if type(v) is list else ' + f + '.output({key!r}, obj)'
+            return f + '.format(v) if type(v) is list else ' + f + '.output({key!r}, obj)'
+        if field_type.output is fields.Raw.output:
+            return f + '.format(v)'
+        return None
+
+
+_compiler = _Compiler()
+
+
+def compile_model(model) -> Callable:
+    """Serializer giving the same output as `marshal(data, model)`, compiled once per model"""
+    return _compiler.compile(model)
+
+
+def fast_marshal_with(api, model):
+    """
+    Same as `api.marshal_with(model)` (and same documentation) for the resource method, the answer being
+    serialized with the compiled serializer of the model and encoded with `dumps`. The requests with a field mask
+    go through `marshal_with`.
+    """
+    serializer = compile_model(model)
+
+    def decorator(f):
+        marshalled = api.marshal_with(model)(f)
+
+        @wraps(marshalled)
+        def wrapper(*args, **kwargs):
+            if request.headers.get(current_app.config['RESTPLUS_MASK_HEADER']):
+                return marshalled(*args, **kwargs)
+            resp = f(*args, **kwargs)
+            if isinstance(resp, BaseResponse):
+                # login_required errors
+                return resp
+            if isinstance(resp, tuple):
+                data, code = resp[0], resp[1] if len(resp) > 1 else 200
+                headers = resp[2] if len(resp) > 2 else None
+            else:
+                data, code, headers = resp, 200, None
+            return Response(dumps(serializer(data)), status=code, headers=headers, mimetype='application/json')
+        return wrapper
+    return decorator
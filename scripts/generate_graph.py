@@ -3,44 +3,48 @@ sys.path.append('..')
 import core_server
 from replica_core import model
 import numpy as np
-import pandas as pd
 import plotly.plotly as py
 import plotly.graph_objs as go
-from datetime import datetime
+from datetime import datetime, timedelta
 
 
-links = model.VisualLink.nodes.filter(type='POSITIVE').all()
-link_times = [l.added for l in links]
+# Only the links created or annotated since the previous run are processed
+model.update_daily_statistics()
+days = model.DailyStatistics.get_range()
 
-df = pd.DataFrame([(img.uid, l.added) for l in links for img in l.images], columns=['image', 'time'])
-image_times = df.groupby('image').min().time
 
+def cumsum_daily_values(key):
+    """Cumulative daily values, including the days without any event"""
+    if len(days) == 0:
+        return [], np.zeros(0)
+    first_day, last_day = days[0].date, days[-1].date
+    dates = [first_day + timedelta(i) for i in range((last_day - first_day).days + 1)]
+    values = np.zeros(len(dates))
+    for d in days:
+        values[(d.date - first_day).days] = d.counts.get(key, 0)
+    return dates, np.cumsum(values)
 
-def cumsum_time_values(times):
-    df = pd.DataFrame({'date': times, 'count': np.ones(len(times))}).set_index('date')
-    df2 = df.resample('D').count()
-    df2[df2.isnull()] = 0
-    return df2.cumsum().reset_index()
 
-
-df1 = cumsum_time_values(link_times)
-df2 = cumsum_time_values(image_times)
+link_dates, link_counts = cumsum_daily_values('nb_{}_annotations'.format(model.VisualLink.Type.POSITIVE))
+image_dates, image_counts = cumsum_daily_values('nb_new_images')
+nb_links = int(link_counts[-1]) if len(link_counts) > 0 else 0
+nb_images = int(image_counts[-1]) if len(image_counts) > 0 else 0
 
 data = [
     go.Scatter(
-        x=df1['date'],
-        y=df1['count'],
+        x=link_dates,
+        y=link_counts,
         name='Number of connections'
     ),
     go.Scatter(
-        x=df2['date'],
-        y=df2['count'],
+        x=image_dates,
+        y=image_counts,
         name='Number of unique artworks'
     )
 ]
 layout = go.Layout(
     #title="Statistics about the graph annotations.<br>" +\
-    title="<b>{}</b> connections between <b>{}</b> individual artworks<br>".format(len(link_times), len(image_times)) +\
+    title="<b>{}</b> connections between <b>{}</b> individual artworks<br>".format(nb_links, nb_images) +\
     "<i>Graph generated on {}</i>".format(datetime.now().strftime('%Y-%m-%d %H:%M'))
 )
 fig = go.Figure(data=data, layout=layout)
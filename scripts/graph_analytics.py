@@ -0,0 +1,154 @@
+import sys
+sys.path.append('..')
+import core_server
+import argparse
+import numpy as np
+import pandas as pd
+from neomodel import db
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from tqdm import tqdm
+from replica_core import model
+
+# Connected components, degree and PageRank of the images of the link graph, written back on the Image nodes
+# (graph_component, graph_component_size, graph_degree, graph_pagerank) and exported to CSV or Parquet.
+# The links are streamed into compact numpy arrays, so that tens of millions of links fit in memory.
+# Requires scipy and pandas (and pyarrow for Parquet) : `pip install scipy pandas pyarrow`
+
+
+def stream_links(link_types, page_size):
+    """Neo4j ids of the two images of each link of the given types, as two int64 arrays"""
+    nb_links = db.cypher_query("MATCH (v:VisualLink) WHERE v.type IN {types} RETURN count(v)",
+                               dict(types=link_types))[0][0][0]
+    pages, page = [], np.empty((page_size, 2), dtype=np.int64)
+    n = 0
+    # Records are read from the bolt stream as they come instead of being materialized by cypher_query
+    with db.driver.session() as session, tqdm(total=nb_links, desc='Links', unit='links') as pbar:
+        records = session.run("""MATCH (i1:Image)<-[:LINKS]-(v:VisualLink)-[:LINKS]->(i2:Image)
+                                 WHERE v.type IN {types} AND id(i1) < id(i2)
+                                 RETURN id(i1), id(i2)""", dict(types=link_types))
+        for record in records:
+            page[n] = record[0], record[1]
+            n += 1
+            if n == page_size:
+                pages.append(page)
+                page, n = np.empty((page_size, 2), dtype=np.int64), 0
+                pbar.update(page_size)
+        pages.append(page[:n])
+        pbar.update(n)
+    links = np.concatenate(pages)
+    return links[:, 0], links[:, 1]
+
+
+def pagerank(adjacency: sparse.csr_matrix, damping=0.85, tol=1e-6, max_iter=100) -> np.ndarray:
+    nb_nodes = adjacency.shape[0]
+    out_degree = np.asarray(adjacency.sum(axis=1)).ravel()
+    # Row-stochastic transition matrix, every node has at least one link
+    transition = sparse.diags(1. / out_degree).dot(adjacency).T.tocsr()
+    ranks = np.full(nb_nodes, 1. / nb_nodes)
+    for _ in range(max_iter):
+        new_ranks = (1 - damping) / nb_nodes + damping * transition.dot(ranks)
+        converged = np.abs(new_ranks - ranks).sum() < tol
+        ranks = new_ranks
+        if converged:
+            break
+    return ranks
+
+
+def write_back(node_ids, components, component_sizes, degrees, ranks, batch_size, exporter):
+    """Sets the properties of the images in batches, and exports each batch with the image uids"""
+    for start in tqdm(range(0, len(node_ids), batch_size), desc='Write back', unit='batches'):
+        end = start + batch_size
+        rows = [list(r) for r in zip(node_ids[start:end].tolist(), components[start:end].tolist(),
+                                     component_sizes[start:end].tolist(), degrees[start:end].tolist(),
+                                     ranks[start:end].tolist())]
+        results, _ = db.cypher_query("""UNWIND {rows} as row
+                                        MATCH (i:Image) WHERE id(i) = row[0]
+                                        SET i.graph_component = row[1], i.graph_component_size = row[2],
+                                            i.graph_degree = row[3], i.graph_pagerank = row[4]
+                                        RETURN id(i), i.uid""", dict(rows=rows))
+        uids = dict(results)
+        exporter.write(pd.DataFrame([[uids.get(r[0])] + r[1:] for r in rows],
+                                    columns=['image_uid', 'component', 'component_size', 'degree', 'pagerank']))
+
+
+class Exporter:
+    """Writes data frames chunk by chunk to a CSV or Parquet file"""
+    def __init__(self, path, file_format):
+        self.path = path
+        self.file_format = file_format
+        self._parquet_writer = None
+        self._nb_chunks = 0
+
+    def write(self, df: pd.DataFrame):
+        if self.file_format == 'csv':
+            df.to_csv(self.path, mode='a' if self._nb_chunks > 0 else 'w', header=self._nb_chunks == 0, index=False)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(self.path, table.schema)
+            self._parquet_writer.write_table(table)
+        self._nb_chunks += 1
+
+    def close(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-t", "--link-types", default='POSITIVE,DUPLICATE',
+                    help="Comma-separated types of the links of the graph")
+    ap.add_argument("-o", "--output", required=True, help="Prefix of the exported files")
+    ap.add_argument("-f", "--format", choices=['csv', 'parquet'], default='csv')
+    ap.add_argument("-p", "--page-size", type=int, default=1000000, help="Number of links per array page")
+    ap.add_argument("-b", "--batch-size", type=int, default=10000, help="Number of images per write")
+    ap.add_argument("--no-write-back", action='store_true', help="Only export the results")
+    args = vars(ap.parse_args())
+
+    link_types = args['link_types'].split(',')
+    if not set(link_types).issubset(model.VisualLink.Type.ALL_TYPES):
+        raise ValueError('Link types should be in {}'.format(model.VisualLink.Type.ALL_TYPES))
+    sources, targets = stream_links(link_types, args['page_size'])
+    if len(sources) == 0:
+        sys.exit('No link of types {}'.format(link_types))
+
+    # Compact ids of the images
+    node_ids, inverse = np.unique(np.concatenate([sources, targets]), return_inverse=True)
+    del sources, targets
+    nb_nodes, nb_links = len(node_ids), len(inverse) // 2
+    rows = inverse.astype(np.int32)
+    del inverse
+    adjacency = sparse.coo_matrix((np.ones(2 * nb_links, dtype=np.float32),
+                                   (np.concatenate([rows[:nb_links], rows[nb_links:]]),
+                                    np.concatenate([rows[nb_links:], rows[:nb_links]]))),
+                                  shape=(nb_nodes, nb_nodes)).tocsr()
+    del rows
+    print('{} images, {} links'.format(nb_nodes, nb_links))
+
+    nb_components, components = connected_components(adjacency, directed=False)
+    sizes = np.bincount(components)
+    degrees = np.diff(adjacency.indptr)
+    ranks = pagerank(adjacency)
+    print('{} components, the largest has {} images'.format(nb_components, sizes.max()))
+
+    size_distribution = np.bincount(sizes)
+    component_sizes = np.nonzero(size_distribution)[0]
+    exporter = Exporter(args['output'] + '_component_sizes.' + args['format'], args['format'])
+    exporter.write(pd.DataFrame({'component_size': component_sizes,
+                                 'nb_components': size_distribution[component_sizes]}))
+    exporter.close()
+
+    exporter = Exporter(args['output'] + '_images.' + args['format'], args['format'])
+    if args['no_write_back']:
+        for start in range(0, nb_nodes, args['batch_size']):
+            end = start + args['batch_size']
+            exporter.write(pd.DataFrame({'image_uid': model.Image.get_uids_by_ids(node_ids[start:end].tolist()),
+                                         'component': components[start:end],
+                                         'component_size': sizes[components[start:end]],
+                                         'degree': degrees[start:end], 'pagerank': ranks[start:end]}))
+    else:
+        write_back(node_ids, components, sizes[components], degrees, ranks, args['batch_size'], exporter)
+    exporter.close()
@@ -0,0 +1,8 @@
+import sys
+sys.path.append('..')
+import core_server
+from replica_core import model
+
+# Recomputes the denormalized element counts and hierarchy paths of all the collections and elements,
+# needed once on databases populated before these were maintained by the importer.
+model.Collection.rebuild_hierarchy_cache()
@@ -0,0 +1,51 @@
+import sys
+sys.path.append('..')
+import core_server
+import neomodel
+from neomodel import db
+from tqdm import tqdm
+from replica_core import model
+
+# Sets the `pair_key` of the links created before it existed, then creates its uniqueness constraint.
+# Pairs linked several times have to be merged by hand before the constraint can be created.
+
+BATCH_SIZE = 10000
+
+
+def set_pair_keys(label: str, personal: bool):
+    nb_links = db.cypher_query("MATCH (l:" + label + ") RETURN count(l)")[0][0][0]
+    last_id = -1
+    with tqdm(total=nb_links, desc=label) as pbar:
+        while True:
+            results, _ = db.cypher_query("MATCH (l:" + label + ") WHERE id(l) > {last_id} "
+                                         "RETURN id(l) ORDER BY id(l) LIMIT {batch_size}",
+                                         dict(last_id=last_id, batch_size=BATCH_SIZE))
+            ids = [r[0] for r in results]
+            if len(ids) == 0:
+                break
+            db.cypher_query("""UNWIND {ids} as link_id
+                               MATCH (l) WHERE id(l) = link_id
+                               MATCH (l)-[:LINKS]->(i:Image)
+                               WITH l, i.uid as uid ORDER BY uid
+                               WITH l, collect(uid) as uids WHERE size(uids) = 2
+                               """ + ("MATCH (l)-[:CREATED_BY]->(u:User) WITH l, uids + u.uid as uids"
+                                      if personal else "") + """
+                               SET l.pair_key = reduce(key = head(uids), uid IN tail(uids) | key + '|' + uid)""",
+                            dict(ids=ids))
+            last_id = ids[-1]
+            pbar.update(len(ids))
+
+    duplicates, _ = db.cypher_query("MATCH (l:" + label + ") WHERE exists(l.pair_key) "
+                                    "WITH l.pair_key as key, collect(l.uid) as uids WHERE size(uids) > 1 "
+                                    "RETURN key, uids")
+    for key, uids in duplicates:
+        print('{} {} are linking the same pair {}'.format(label, uids, key))
+    return len(duplicates) == 0
+
+
+if __name__ == '__main__':
+    for link_class, personal in [(model.VisualLink, False), (model.PersonalLink, True)]:
+        if set_pair_keys(link_class.__label__, personal):
+            neomodel.install_labels(link_class)
+        else:
+            print('Uniqueness constraint of {} not created'.format(link_class.__label__))
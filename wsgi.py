@@ -1,6 +1,8 @@
-from core_server import app
+from core_server import app, preload_indexes
 from werkzeug.contrib.fixers import ProxyFix
 
+preload_indexes()
+
 if __name__ == "__main__":
     # For proper https forwarding? (see https://github.com/noirbizarre/flask-restplus/issues/54)
     app.wsgi_app = ProxyFix(app.wsgi_app)